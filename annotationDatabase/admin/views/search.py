@@ -6,6 +6,7 @@
 import csv
 
 from django.http      import HttpResponse, HttpResponseRedirect
+from django.http      import StreamingHttpResponse
 from django.shortcuts import render
 
 from annotationDatabase.authentication import auth_controller
@@ -101,16 +102,12 @@ def search_results(request):
 
     if download == "1":
         # The user clicked on our "Download Search Results" button.  Return the
-        # search results as a CSV file to download.
-        response = HttpResponse(content_type='text/csv')
+        # search results as a CSV file to download.  Note that the CSV file is
+        # streamed back to the user as the matching accounts are read from the
+        # database, so this works no matter how many accounts match.
+        response = StreamingHttpResponse(_download_search_results(query),
+                                         content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="results.csv"'
-
-        search_results = _download_search_results(query)
-
-        writer = csv.writer(response)
-        for row in search_results:
-            writer.writerow(row)
-
         return response
 
     response = functions.search(query, page, rpp=15, totals_only=False)
@@ -138,39 +135,57 @@ def search_results(request):
 def _download_search_results(query):
     """ Download the search results for the given search query.
 
-        We return a list of lines of data to return, where each list item is
-        itself a list of the individual values in each row.
+        We yield the CSV-formatted lines of data to return, one line at a
+        time.  Each matching account is listed along with its current value
+        for each of the annotation keys used in the search query.
     """
-    lines = [] # List of list of strings.
-    row = []
-    row.append("Search Query:")
-    row.append(query)
-    lines.append(row)
+    buffer = _LineBuffer()
+    writer = csv.writer(buffer)
+
+    def _line(row):
+        writer.writerow([unicode(value).encode("utf-8") for value in row])
+        return buffer.get_line()
+
+    yield _line(["Search Query:", query])
+
+    response = functions.export_search(query)
+    if not response['success']:
+        yield _line(["Server Error:", response['error']])
+        return
+
+    yield _line(["", "Account"] + response['keys'])
 
     first = True
-    page  = 1
-
-    while True:
-        response = functions.search(query, page)
-        if not response['success']:
-            lines.append(["Server Error:", response['error']])
-            break
-
-        for account in response['accounts']:
-            row = []
-            if first:
-                row.append("Matching Accounts")
-                first = False
-            else:
-                row.append("")
-            row.append(account)
-            lines.append(row)
-
-        if page <= response['num_pages']:
-            page = page + 1
-            continue
+    for row in response['rows']:
+        if first:
+            yield _line(["Matching Accounts"] + row)
+            first = False
         else:
-            break
+            yield _line([""] + row)
+
+#############################################################################
+
+class _LineBuffer(object):
+    """ A file-like object which holds the line written by a csv.writer.
+
+        This lets us use a csv.writer to format one line at a time, without
+        building up the entire CSV file in memory.
+    """
+    def __init__(self):
+        """ Standard initialiser.
+        """
+        self._line = ""
+
+
+    def write(self, s):
+        """ Remember the given string, which is a line of CSV data.
+        """
+        self._line = self._line + s
 
-    return lines
 
+    def get_line(self):
+        """ Return the line of CSV data written so far, and clear the buffer.
+        """
+        line = self._line
+        self._line = ""
+        return line
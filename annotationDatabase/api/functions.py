@@ -8,24 +8,32 @@
     interface.
 """
 import datetime
+import functools
 import operator
+import tempfile
 import time
+import uuid
 
 import simplejson as json
 
-from django.db.models      import Q
+from django.db             import connection, transaction
+from django.db             import IntegrityError, OperationalError
+from django.db.models      import F, Q
 from django.utils.timezone import utc
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.conf           import settings
 
 from annotationDatabase.shared.models import *
-from annotationDatabase.shared.lib    import logicalExpressions
+from annotationDatabase.shared.lib    import logicalExpressions, interning
+from annotationDatabase.shared.lib    import bitmapIndex, typedValues
+from annotationDatabase.shared.lib    import searchCache, streamingQueries
+from annotationDatabase.shared.lib    import annotationSnapshots
 
 from annotationDatabase.api import helpers
 
 #############################################################################
 
-def add(batch):
+def add(batch, in_background=False):
     """ Add a batch of annotations to the system.
 
         The parameters are as follows:
@@ -57,7 +65,14 @@ def add(batch):
                             'value' (required)
 
                                 The value of this annotation for this account,
-                                as a string.
+                                as a string.  Numbers and booleans are also
+                                accepted, and are converted to strings.
+
+            in_background
+
+                If True, the batch will be checked and then queued so that the
+                annotations can be stored in the background by the
+                "process_batch_queue" management command.
 
         If the request was successful, we return a dictionary which looks like
         this:
@@ -66,6 +81,9 @@ def add(batch):
              'batch_num' : 1234}
 
         where 'batch_num' is the number of the newly-posted annotation batch.
+        If the batch was queued to be processed in the background, the
+        returned dictionary will also have a 'status' entry set to "pending";
+        use batch_status() to check on the progress of the batch.
 
         If an error occurred, we return a dictionary which looks like this:
 
@@ -73,6 +91,11 @@ def add(batch):
              'error'   : "..."}
 
         where 'error' is a string describing why the request failed.
+
+        Note that the entire batch is checked before anything is written to
+        the database, and the batch is then stored within a single
+        transaction.  If the request fails, no part of the batch will have
+        been stored.
     """
     if type(batch) is not dict:
         return {'success' : False,
@@ -82,6 +105,10 @@ def add(batch):
         return {'success' : False,
                 'error'   : "batch must include a 'user_id' entry"}
 
+    if not isinstance(batch['user_id'], basestring):
+        return {'success' : False,
+                'error'   : "'user_id' entry must be a string"}
+
     if 'annotations' not in batch:
         return {'success' : False,
                 'error'   : "batch must include an 'annotations' entry"}
@@ -90,66 +117,377 @@ def add(batch):
         return {'success' : False,
                 'error'   : "'annotations' entry must be an array"}
 
-    annotationBatch = AnnotationBatch()
-    annotationBatch.timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
-    annotationBatch.user_id   = batch['user_id']
-    annotationBatch.save()
+    # Check that the annotation entries are all valid before we touch the
+    # database.
 
     for entry in batch['annotations']:
-        if type(entry) is not dict:
+        err_msg = _check_annotation(entry)
+        if err_msg != None:
             return {'success' : False,
-                    'error'   : "annotation entry must be an object"}
+                    'error'   : err_msg}
+
+    if in_background:
+        # Create the batch and add it to our queue, to be stored later.
+
+        with transaction.atomic():
+            annotationBatch = AnnotationBatch()
+            annotationBatch.timestamp = datetime.datetime.utcnow().replace(
+                                                                tzinfo=utc)
+            annotationBatch.user_id   = batch['user_id']
+            annotationBatch.save()
+
+            queuedBatch = QueuedBatch()
+            queuedBatch.batch           = annotationBatch
+            queuedBatch.status          = "pending"
+            queuedBatch.data            = json.dumps(batch['annotations'])
+            queuedBatch.num_annotations = len(batch['annotations'])
+            queuedBatch.num_processed   = 0
+            queuedBatch.queued_at       = annotationBatch.timestamp
+            queuedBatch.save()
+
+        return {'success'   : True,
+                'batch_num' : annotationBatch.id,
+                'status'    : "pending"}
+
+    # If we get here, the batch is acceptable -> store it.  Note that we do
+    # this within a single transaction, so that either the whole batch is
+    # stored or none of it is.
+
+    def _store_batch():
+        annotationBatch = AnnotationBatch()
+        annotationBatch.timestamp = datetime.datetime.utcnow().replace(
+                                                                tzinfo=utc)
+        annotationBatch.user_id   = batch['user_id']
+        annotationBatch.save()
+
+        helpers.add_annotations(annotationBatch, batch['annotations'])
+        return annotationBatch
+
+    annotationBatch = _run_atomically(_store_batch)
 
-        if 'account' not in entry:
-            return {'success' : False,
-                    'error'   : "annotation must include an 'account' entry"}
+    return {'success'   : True,
+            'batch_num' : annotationBatch.id}
 
-        if 'key' not in entry:
-            return {'success' : False,
-                    'error'   : "annotation must include a 'key' entry"}
+#############################################################################
 
-        if 'value' not in entry:
-            return {'success' : False,
-                    'error'   : "annotation must include a 'value' entry"}
+def add_stream(user_id, lines):
+    """ Add a batch of annotations supplied as a stream of JSON lines.
 
-        try:
-            account = Account.objects.get(address=entry['account'])
-        except Account.DoesNotExist:
-            account = Account()
-            account.address = entry['account']
-            account.save()
+        This is an alternative to add() for very large batches.  Rather than
+        requiring the entire batch to be held in memory at once, we check each
+        annotation as it is read and copy it to a temporary file, and then
+        store the annotations from that file a chunk at a time.
 
-        try:
-            annotationKey = AnnotationKey.objects.get(key__iexact=entry['key'])
-        except AnnotationKey.DoesNotExist:
-            annotationKey = AnnotationKey()
-            annotationKey.key = entry['key']
-            annotationKey.save()
+        The parameters are as follows:
 
-        try:
-            annotationValue = AnnotationValue.objects.get(
-                                                value__iexact=entry['value'])
-        except AnnotationValue.DoesNotExist:
-            annotationValue = AnnotationValue()
-            annotationValue.value = entry['value']
-            annotationValue.save()
-
-        annotation = Annotation()
-        annotation.batch     = annotationBatch
-        annotation.account   = account
-        annotation.key       = annotationKey
-        annotation.value     = annotationValue
-        annotation.hidden    = False
-        annotation.hidden_at = None
-        annotation.hidden_by = None
-        annotation.save()
-
-        helpers.set_current_annotation(entry['account'],
-                                       entry['key'],
-                                       entry['value'])
+            'user_id'
 
-    return {'success'   : True,
-            'batch_num' : annotationBatch.id}
+                A string identifying the user who is uploading this batch.
+
+            'lines'
+
+                An iterator which returns the annotations to add, one line at a
+                time.  Each line should be a JSON object with 'account', 'key'
+                and 'value' fields, as described in add(), above.  Blank lines
+                are ignored.
+
+        All the annotations are stored as part of a single annotation batch.
+        Nothing is stored until the entire stream has been read and checked.
+        The annotations are then stored in chunks of
+        settings.ADD_STREAM_CHUNK_SIZE annotations, all within a single
+        transaction, so that either the whole batch is stored or none of it
+        is, and other users never see a partly-stored batch.
+
+        If the request was successful, we return a dictionary which looks like
+        this:
+
+            {'success'         : True,
+             'batch_num'       : 1234,
+             'num_annotations' : 99999}
+
+        where 'batch_num' is the number of the newly-posted annotation batch,
+        and 'num_annotations' is the number of annotations which were stored.
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.  If an
+        invalid line is found, nothing is stored.
+    """
+    if not isinstance(user_id, basestring):
+        return {'success' : False,
+                'error'   : "'user_id' entry must be a string"}
+
+    # The batch's timestamp is the time at which the upload started, so that
+    # any annotations uploaded by someone else while the stream is being
+    # read take precedence over this batch.
+
+    timestamp  = datetime.datetime.utcnow().replace(tzinfo=utc)
+    chunk_size = settings.ADD_STREAM_CHUNK_SIZE
+
+    def _store_stream(spool):
+        annotationBatch = AnnotationBatch()
+        annotationBatch.timestamp = timestamp
+        annotationBatch.user_id   = user_id
+        annotationBatch.save()
+
+        spool.seek(0)
+        chunk = []
+        for line in spool:
+            chunk.append(json.loads(line))
+            if len(chunk) >= chunk_size:
+                helpers.add_annotations(annotationBatch, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            helpers.add_annotations(annotationBatch, chunk)
+
+        return annotationBatch
+
+    spool = tempfile.TemporaryFile()
+    try:
+        # Read and check the entire stream, copying the valid annotations
+        # into our temporary file.
+
+        num_annotations = 0
+        line_num        = 0
+        for line in lines:
+            line_num = line_num + 1
+            if line.strip() == "":
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                err_msg = "Invalid JSON data"
+            else:
+                err_msg = _check_annotation(entry)
+
+            if err_msg != None:
+                return {'success' : False,
+                        'error'   : "line %d: %s" % (line_num, err_msg)}
+
+            spool.write(json.dumps(entry) + "\n")
+            num_annotations = num_annotations + 1
+
+        # If we get here, the whole stream is acceptable -> store it.
+
+        annotationBatch = _run_atomically(_store_stream, spool)
+    finally:
+        spool.close()
+
+    return {'success'         : True,
+            'batch_num'       : annotationBatch.id,
+            'num_annotations' : num_annotations}
+
+#############################################################################
+
+def batch_status(batch_num):
+    """ Return the processing status of the given annotation batch.
+
+        The parameters are as follows:
+
+            'batch_num'
+
+                The number of the desired annotation batch.
+
+        If the request was successful, we return a dictionary which looks like
+        this:
+
+            {'success'         : True,
+             'batch_num'       : 1234,
+             'status'          : "processing",
+             'num_annotations' : 10000,
+             'num_processed'   : 5000}
+
+        where the various entries are as follows:
+
+            'status'
+
+                The current status of the batch.  This will be one of the
+                following strings:
+
+                    "pending"
+
+                        The batch is waiting to be processed.
+
+                    "processing"
+
+                        The batch is currently being processed.
+
+                    "done"
+
+                        All the annotations in the batch have been stored.
+
+                    "failed"
+
+                        The batch could not be stored.  In this case, the
+                        returned dictionary will also have an 'error' entry
+                        describing what went wrong.
+
+            'num_annotations'
+
+                The number of annotations in the batch.
+
+            'num_processed'
+
+                The number of annotations in the batch which have been stored
+                so far.
+
+        Note that batches which were not added in the background are always
+        reported as "done".
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.
+    """
+    try:
+        annotationBatch = AnnotationBatch.objects.get(id=batch_num)
+    except (AnnotationBatch.DoesNotExist, ValueError):
+        return {'success' : False,
+                'error'   : "No such batch"}
+
+    try:
+        queuedBatch = QueuedBatch.objects.get(batch=annotationBatch)
+    except QueuedBatch.DoesNotExist:
+        queuedBatch = None
+
+    if queuedBatch == None:
+        num_annotations = Annotation.objects.filter(
+                                            batch=annotationBatch).count()
+        return {'success'         : True,
+                'batch_num'       : annotationBatch.id,
+                'status'          : "done",
+                'num_annotations' : num_annotations,
+                'num_processed'   : num_annotations}
+
+    response = {'success'         : True,
+                'batch_num'       : annotationBatch.id,
+                'status'          : queuedBatch.status,
+                'num_annotations' : queuedBatch.num_annotations,
+                'num_processed'   : queuedBatch.num_processed}
+
+    if queuedBatch.status == "failed":
+        response['error'] = queuedBatch.error
+
+    return response
+
+#############################################################################
+
+def process_queued_batch():
+    """ Process the next batch waiting in our queue, if any.
+
+        We claim the oldest pending QueuedBatch, and store its annotations a
+        chunk at a time, updating the batch's progress as we go.  Note that
+        this is safe to call from several processes at once; each batch will
+        only be processed by one of them.
+
+        Each chunk renews our claim on the batch.  If a worker dies partway
+        through a batch, its claim expires after QUEUE_LEASE_TIMEOUT seconds,
+        and the batch is then claimed by another worker, which carries on from
+        the last chunk stored.  If we find that another worker has taken over
+        a batch we were processing, we stop without storing anything more.
+
+        Every annotation in the batch is checked before anything is stored,
+        so a batch holding invalid data fails without storing anything.  If
+        storing a chunk fails, the batch is returned to the queue to be tried
+        again, up to QUEUE_MAX_ATTEMPTS times in all; after that, the batch
+        is marked as failed, and 'num_processed' records how many of its
+        annotations were stored.
+
+        We return True if a batch was processed, or False if the queue was
+        empty.
+    """
+    token       = uuid.uuid4().hex
+    queuedBatch = None
+
+    claimable = _claimable_batches().order_by("id")
+    for id in claimable.values_list("id", flat=True)[:10]:
+        # Claim this batch.  If another process got there first, the update
+        # won't match any records and we try the next one.
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        if _claimable_batches().filter(id=id).update(
+                                            status="processing",
+                                            claimed_by=token,
+                                            started_at=now,
+                                            heartbeat_at=now,
+                                            attempts=F("attempts") + 1):
+            queuedBatch = QueuedBatch.objects.get(id=id)
+            break
+
+    if queuedBatch == None:
+        return False
+
+    annotationBatch = queuedBatch.batch
+    chunk_size      = settings.ADD_STREAM_CHUNK_SIZE
+    ourBatch        = QueuedBatch.objects.filter(id=queuedBatch.id,
+                                                 claimed_by=token)
+
+    def _finish(**kwargs):
+        kwargs['finished_at'] = datetime.datetime.utcnow().replace(tzinfo=utc)
+        ourBatch.update(**kwargs)
+
+    # Check the batch's data before storing anything.
+
+    try:
+        entries = json.loads(queuedBatch.data)
+        if type(entries) is not list:
+            raise ValueError("batch data must be a list")
+        for entry in entries:
+            err_msg = _check_annotation(entry)
+            if err_msg != None:
+                raise ValueError(err_msg)
+    except (TypeError, ValueError) as e:
+        _finish(status="failed", error=str(e))
+        return True
+
+    def _store_chunk(chunk, num_processed):
+        # Renew our claim first, so that the QueuedBatch record stays locked
+        # until this chunk has been committed.
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        if not ourBatch.update(num_processed=num_processed, heartbeat_at=now):
+            raise _LostClaim()
+        helpers.add_annotations(annotationBatch, chunk)
+
+    # Note that we start from 'num_processed' so that we can resume a batch
+    # which was interrupted partway through.  The batch's annotations are
+    # stored against the batch's original timestamp; add_annotations() makes
+    # sure that this doesn't overwrite any newer values added while the batch
+    # was waiting in the queue.
+
+    start = queuedBatch.num_processed
+
+    try:
+        while start < len(entries):
+            chunk = entries[start:start+chunk_size]
+            _run_atomically(_store_chunk, chunk, start + len(chunk))
+            start = start + len(chunk)
+    except _LostClaim:
+        return True # Another worker has taken over this batch.
+    except Exception as e:
+        if queuedBatch.attempts >= settings.QUEUE_MAX_ATTEMPTS:
+            _finish(status="failed", error=str(e))
+        else:
+            ourBatch.update(status="pending", claimed_by=None, error=str(e))
+        return True
+
+    _finish(status="done", data=None)
+    return True
+
+#############################################################################
+
+def requeue_abandoned_batches():
+    """ Return any batches whose worker has died back to the queue.
+
+        A batch is only returned to the queue if its worker's claim has
+        expired, so batches which are still being processed are left alone.
+        We return the number of batches which were returned to the queue.
+    """
+    return _abandoned_batches().update(status="pending", claimed_by=None)
 
 #############################################################################
 
@@ -204,61 +542,44 @@ def hide(user_id, batch_num, account=None, annotation=None):
                     'error'   : "No such account"}
 
     if annotation != None:
-        try:
-            annotationKey = AnnotationKey.objects.get(key__iexact=annotation)
-        except AnnotationKey.DoesNotExist:
+        annotationKey = interning.get_key_id(annotation)
+        if annotationKey == None:
             return {'success' : False,
                     'error'   : "No such annotation"}
 
     if account != None and annotation != None:
         annotations_to_hide = Annotation.objects.filter(batch=annotationBatch,
                                                         account=account,
-                                                        key__iexact=annotationKey)
+                                                        key_id=annotationKey)
     elif account != None and annotation == None:
         annotations_to_hide = Annotation.objects.filter(batch=annotationBatch,
                                                         account=account)
     elif account == None and annotation != None:
         annotations_to_hide = Annotation.objects.filter(batch=annotationBatch,
-                                                        key__iexact=annotationKey)
+                                                        key_id=annotationKey)
     elif account == None and annotation == None:
         annotations_to_hide = Annotation.objects.filter(batch=annotationBatch)
 
-    for annotation in annotations_to_hide:
-        annotation.hidden    = True
-        annotation.hidden_at = datetime.datetime.utcnow().replace(tzinfo=utc)
-        annotation.hidden_by = user_id
-        annotation.save()
-
-    # Calculate the most recent value for the annotations which are now hidden.
+    # Hide the annotations, and then recalculate the current value for each
+    # account and key affected by the change.  We do this within a single
+    # transaction so the CurrentAnnotation records always match the visible
+    # annotations.
 
-    annotations_to_recalculate = [] # List of (account, key) tuples.
+    with transaction.atomic(), helpers.recording_changes():
+        annotations_to_recalculate = set(annotations_to_hide.values_list(
+                                                    "account_id", "key_id"))
 
-    for annotation in annotations_to_hide:
-        annotations_to_recalculate.append([annotation.account, annotation.key])
+        annotations_to_hide.update(
+                    hidden=True,
+                    hidden_at=datetime.datetime.utcnow().replace(tzinfo=utc),
+                    hidden_by=user_id)
 
-    for account,key in annotations_to_recalculate:
-        cur_value     = None # initially.
-        cur_timestamp = None # ditto.
-        for annotation in Annotation.objects.filter(account=account,
-                                                    key=key):
-            if annotation.hidden: continue
+        AnnotationBatch.objects.filter(id=annotationBatch.id).update(
+                                                version=F("version") + 1)
 
-            timestamp = annotation.batch.timestamp
-            value     = annotation.value.value
-
-            if cur_value == None:
-                cur_value     = value
-                cur_timestamp = timestamp
-            else:
-                if timestamp > cur_timestamp:
-                    # Use the most recent value.
-                    cur_value     = value
-                    cur_timestamp = timestamp
+        helpers.recalc_current_annotations(annotations_to_recalculate)
 
-        if cur_value != None:
-            helpers.set_current_annotation(account.address, key.key, cur_value)
-        else:
-            helpers.set_current_annotation(account.address, key.key, "")
+    searchCache.flush()
 
     # That's all, folks!
 
@@ -266,7 +587,7 @@ def hide(user_id, batch_num, account=None, annotation=None):
 
 #############################################################################
 
-def list_batches(page=1, rpp=100):
+def list_batches(page=1, rpp=100, cursor=None, include_totals=False):
     """ Return a list of previously posted annotation batches.
 
         The parameters are as follows:
@@ -281,6 +602,19 @@ def list_batches(page=1, rpp=100):
 
                 The number of results to return per page.
 
+            'cursor'
+
+                If this is not None, the results are returned using "cursor"
+                pagination rather than page numbers; see below.  This should be
+                an empty string to retrieve the first page of results, or the
+                'next_cursor' value returned with the previous page.
+
+            'include_totals'
+
+                If True, the totals are returned even when using cursor
+                pagination.  By default, the totals are left out when a cursor
+                is used, as calculating them can be slow.
+
         If the request was successful, we return a dictionary which looks like
         this:
 
@@ -291,6 +625,11 @@ def list_batches(page=1, rpp=100):
         'num_pages' is the number of pages of results that will be returned
         with the given 'rpp' value.
 
+        If a cursor was supplied, the returned dictionary will also include a
+        'next_cursor' entry.  This is the cursor to use to retrieve the next
+        page of results, or None if there are no more results.  In this case,
+        'num_pages' is only included if 'include_totals' was set.
+
         Each entry in the 'batches' list will be a dictionary with the
         following entries:
 
@@ -315,21 +654,42 @@ def list_batches(page=1, rpp=100):
 
         where 'error' is a string describing why the request failed.
     """
-    paginator = Paginator(AnnotationBatch.objects.order_by("-id"), rpp)
+    if cursor != None:
+        try:
+            rows,next_cursor = _get_cursor_page(
+                    AnnotationBatch.objects.values_list("id", "timestamp",
+                                                        "user_id"),
+                    "id", cursor, rpp, descending=True)
+        except ValueError as e:
+            return {'success' : False,
+                    'error'   : str(e)}
+    else:
+        paginator = Paginator(AnnotationBatch.objects.order_by("-id")
+                                     .values_list("id", "timestamp",
+                                                  "user_id"), rpp)
 
-    try:
-        batches_in_page = paginator.page(page)
-    except PageNotAnInteger:
-        batches_in_page = paginator.page(1)
-    except EmptyPage:
-        batches_in_page = []
+        try:
+            rows = paginator.page(page)
+        except PageNotAnInteger:
+            rows = paginator.page(1)
+        except EmptyPage:
+            rows = []
 
     batches = []
-    for batch in batches_in_page:
-        timestamp = int(time.mktime(batch.timestamp.timetuple()))
-        batches.append({'batch_number' : batch.id,
+    for batch_number,timestamp,user_id in rows:
+        timestamp = int(time.mktime(timestamp.timetuple()))
+        batches.append({'batch_number' : batch_number,
                         'timestamp'    : timestamp,
-                        'user_id'      : batch.user_id})
+                        'user_id'      : user_id})
+
+    if cursor != None:
+        response = {'success'     : True,
+                    'batches'     : batches,
+                    'next_cursor' : next_cursor}
+        if include_totals:
+            response['num_pages'] = _num_pages(
+                                        AnnotationBatch.objects.count(), rpp)
+        return response
 
     return {'success'   : True,
             'num_pages' : paginator.num_pages,
@@ -419,16 +779,24 @@ def get(batch_number):
         return {'success' : False,
                 'error'   : "No such batch"}
 
+    # Retrieve the annotations, along with their account addresses, keys and
+    # values, using a single query.
+
+    query = Annotation.objects.filter(batch=annotationBatch).order_by("id")
+
     annotations = []
-    for annotation in Annotation.objects.filter(batch=annotationBatch):
-        annotations.append({'account' : annotation.account.address,
-                            'key'     : annotation.key.key,
-                            'value'   : annotation.value.value,
-                            'hidden'  : annotation.hidden})
-        if annotation.hidden:
-            hidden_at = int(time.mktime(annotation.hidden_at.timetuple()))
-            annotations[-1]['hidden_at'] = hidden_at
-            annotations[-1]['hidden_by'] = annotation.hidden_by
+    for address,key,value,hidden,hidden_at,hidden_by in query.values_list(
+                                    "account__address", "key__key",
+                                    "value__value", "hidden", "hidden_at",
+                                    "hidden_by"):
+        annotations.append({'account' : address,
+                            'key'     : key,
+                            'value'   : value,
+                            'hidden'  : hidden})
+        if hidden:
+            annotations[-1]['hidden_at'] = int(time.mktime(
+                                                    hidden_at.timetuple()))
+            annotations[-1]['hidden_by'] = hidden_by
 
     timestamp = int(time.mktime(annotationBatch.timestamp.timetuple()))
 
@@ -440,7 +808,127 @@ def get(batch_number):
 
 #############################################################################
 
-def list_accounts(page=1, rpp=1000):
+def changes(since=None, rpp=1000):
+    """ Return the changes made to the current annotation values.
+
+        The parameters are as follows:
+
+            'since'
+
+                If this is not None, it should be the 'next_cursor' value
+                returned by a previous call to this function, and only the
+                changes made after the ones returned by that call will be
+                included.  Otherwise, the changes are returned starting with
+                the very first change.
+
+            'rpp'
+
+                The maximum number of changes to return.  At most
+                CHANGES_MAX_RPP changes can be requested at once.
+
+        If the request was successful, we return a dictionary which looks like
+        this:
+
+            {'success'     : True,
+             'changes'     : [...],
+             'next_cursor' : "...",
+             'has_more'    : False}
+
+        where 'changes' is a list of the changes, in the order in which they
+        were made, and 'next_cursor' is the value to pass as 'since' to
+        retrieve the following changes.  'has_more' will be True if there are
+        more changes which can be retrieved straight away.  Note that
+        'next_cursor' is always returned, even if there are no changes, so
+        that the caller can keep polling for new changes.
+
+        Each entry in the 'changes' list will be a dictionary with the
+        following entries:
+
+            'account'
+
+                The address of the account whose annotation was changed.
+
+            'key'
+
+                The annotation key which was changed.
+
+            'value'
+
+                The new current value for this account and annotation key.
+                This will be an empty string if all the annotations for this
+                account and key have been hidden.
+
+            'timestamp'
+
+                The date and time at which the change was made, as an integer
+                number of seconds since midnight on the 1st of January, 1970
+                ("unix time"), in UTC.
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.
+
+        Note that the changes made by rebuilding the CurrentAnnotation table
+        using the "recalc_current_annotations" management command are not
+        included; anyone mirroring the current annotation values should start
+        again from scratch after the table has been rebuilt.
+    """
+    if since == None:
+        since = ""
+
+    try:
+        rpp = int(rpp)
+    except (TypeError, ValueError):
+        return {'success' : False,
+                'error'   : "Invalid rpp value"}
+
+    if rpp > settings.CHANGES_MAX_RPP:
+        return {'success' : False,
+                'error'   : "You can't request more than %d changes at once"
+                            % settings.CHANGES_MAX_RPP}
+
+    try:
+        rows,next_cursor = _get_cursor_page(
+                AnnotationChange.objects.values_list("id", "account__address",
+                                                     "key__key",
+                                                     "value__value",
+                                                     "changed_at"),
+                "id", since, rpp)
+    except ValueError as e:
+        return {'success' : False,
+                'error'   : str(e)}
+
+    # Unlike the other cursors, we always return a cursor to continue from,
+    # even when there are no more changes yet.
+
+    has_more = (next_cursor != None)
+    if not has_more:
+        if len(rows) > 0:
+            next_cursor = helpers.encode_cursor(rows[-1][0])
+        elif since != "":
+            next_cursor = since
+        else:
+            next_cursor = helpers.encode_cursor(0)
+
+    changes = []
+    for id,address,key,value,changed_at in rows:
+        timestamp = int(time.mktime(changed_at.timetuple()))
+        changes.append({'account'   : address,
+                        'key'       : key,
+                        'value'     : value,
+                        'timestamp' : timestamp})
+
+    return {'success'     : True,
+            'changes'     : changes,
+            'next_cursor' : next_cursor,
+            'has_more'    : has_more}
+
+#############################################################################
+
+def list_accounts(page=1, rpp=1000, cursor=None, include_totals=False):
     """ Return a list of Ripple accounts which have annotations.
 
         The parameters are as follows:
@@ -455,6 +943,19 @@ def list_accounts(page=1, rpp=1000):
 
                 The number of results to return per page.
 
+            'cursor'
+
+                If this is not None, the results are returned using "cursor"
+                pagination rather than page numbers; see below.  This should be
+                an empty string to retrieve the first page of results, or the
+                'next_cursor' value returned with the previous page.
+
+            'include_totals'
+
+                If True, the totals are returned even when using cursor
+                pagination.  By default, the totals are left out when a cursor
+                is used, as calculating them can be slow.
+
         If the request was successful, we return a dictionary which looks like
         this:
 
@@ -465,6 +966,11 @@ def list_accounts(page=1, rpp=1000):
         'num_pages' is the number of pages of results that will be returned
         with the given 'rpp' value.
 
+        If a cursor was supplied, the returned dictionary will also include a
+        'next_cursor' entry.  This is the cursor to use to retrieve the next
+        page of results, or None if there are no more results.  In this case,
+        'num_pages' is only included if 'include_totals' was set.
+
         Each entry in the 'accounts' list will be the address of an account, as
         a string.
 
@@ -475,6 +981,23 @@ def list_accounts(page=1, rpp=1000):
 
         where 'error' is a string describing why the request failed.
     """
+    if cursor != None:
+        try:
+            rows,next_cursor = _get_cursor_page(
+                                    Account.objects.values_list("address"),
+                                    "address", cursor, rpp)
+        except ValueError as e:
+            return {'success' : False,
+                    'error'   : str(e)}
+
+        response = {'success'     : True,
+                    'accounts'    : [address for (address,) in rows],
+                    'next_cursor' : next_cursor}
+        if include_totals:
+            response['num_pages'] = _num_pages(Account.objects.count(),
+                                               rpp)
+        return response
+
     paginator = Paginator(Account.objects.order_by("address"), rpp)
 
     try:
@@ -494,7 +1017,7 @@ def list_accounts(page=1, rpp=1000):
 
 #############################################################################
 
-def account(account):
+def account(account, as_of=None):
     """ Return the annotations currently associated with the given account.
 
         The parameters are as follows:
@@ -503,6 +1026,12 @@ def account(account):
 
                 The address of the desired account.
 
+            'as_of'
+
+                If this is not None, it should be a datetime.datetime object.
+                The annotations associated with the account at that moment
+                will be returned, rather than the current annotations.
+
         If the request was successful, we return a dictionary which looks like
         this:
 
@@ -534,18 +1063,126 @@ def account(account):
         return {'success' : False,
                 'error'   : "No such account"}
 
-    current_annotations = CurrentAnnotation.objects.filter(account=account)
+    if as_of != None:
+        rows = [(key, value) for (address,key,value)
+                in _get_annotations_as_of(as_of, [account.id])]
+    else:
+        current_annotations = CurrentAnnotation.objects.filter(account=account)
+        rows = current_annotations.order_by("key__key").values_list(
+                                                    "key__key", "value__value")
 
     annotations = []
-    for annotation in current_annotations.order_by("key__key"):
-        annotations.append({'key'   : annotation.key.key,
-                            'value' : annotation.value.value})
+    for key,value in rows:
+        annotations.append({'key'   : key,
+                            'value' : value})
 
     return {'success'     : True,
             'annotations' : annotations}
 
 #############################################################################
 
+def accounts_bulk(addresses, keys=None, as_of=None):
+    """ Return the annotations currently associated with a set of accounts.
+
+        The parameters are as follows:
+
+            'addresses'
+
+                A list of the addresses of the desired accounts.  At most
+                ACCOUNTS_BULK_MAX_ADDRESSES addresses can be supplied at once.
+
+            'keys'
+
+                If this is not None, it should be a list of annotation keys.
+                Only the current annotations with these keys will be returned.
+
+            'as_of'
+
+                If this is not None, it should be a datetime.datetime object.
+                The annotations associated with the accounts at that moment
+                will be returned, rather than the current annotations.
+
+        If the request was successful, we return a dictionary which looks like
+        this:
+
+            {'success'  : true,
+             'accounts' : {...}}
+
+        where 'accounts' is a dictionary mapping each of the given addresses
+        to a list of the annotations currently associated with that account,
+        in the same format as is returned by the account() function, above.
+        Any account which doesn't exist or doesn't have any (matching)
+        annotations will have an empty list of annotations.
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.
+
+        Note that the annotations for all the accounts are retrieved using a
+        single database query.  If 'as_of' is supplied, the accounts are
+        looked up first, using a separate query.
+    """
+    if type(addresses) not in [list, tuple]:
+        return {'success' : False,
+                'error'   : "'accounts' must be an array"}
+
+    for address in addresses:
+        if not isinstance(address, basestring):
+            return {'success' : False,
+                    'error'   : "Each account must be a string"}
+
+    if len(addresses) > settings.ACCOUNTS_BULK_MAX_ADDRESSES:
+        return {'success' : False,
+                'error'   : "You can't request more than %d accounts at once"
+                            % settings.ACCOUNTS_BULK_MAX_ADDRESSES}
+
+    if keys != None:
+        if type(keys) not in [list, tuple]:
+            return {'success' : False,
+                    'error'   : "'keys' must be an array"}
+
+        for key in keys:
+            if not isinstance(key, basestring):
+                return {'success' : False,
+                        'error'   : "Each key must be a string"}
+
+    accounts = {} # Maps address to list of annotations.
+    for address in addresses:
+        accounts[address] = []
+
+    key_ids = None
+    if keys != None:
+        key_ids = interning.get_key_ids(keys, create=False).values()
+        if len(key_ids) == 0:
+            # None of the requested keys exist, so there's nothing to return.
+            return {'success'  : True,
+                    'accounts' : accounts}
+
+    if as_of != None:
+        account_ids = list(Account.objects.filter(address__in=addresses)
+                                          .values_list("id", flat=True))
+        rows = _get_annotations_as_of(as_of, account_ids, key_ids)
+    else:
+        query = CurrentAnnotation.objects.filter(
+                                            account__address__in=addresses)
+        if key_ids != None:
+            query = query.filter(key_id__in=key_ids)
+        rows = query.order_by("account__address", "key__key") \
+                    .values_list("account__address", "key__key",
+                                 "value__value")
+
+    for address,key,value in rows:
+        accounts[address].append({'key'   : key,
+                                  'value' : value})
+
+    return {'success'  : True,
+            'accounts' : accounts}
+
+#############################################################################
+
 def account_history(account):
     """ Return a complete history of the given account's annotations.
 
@@ -634,37 +1271,45 @@ def account_history(account):
         return {'success' : False,
                 'error'   : "No such account"}
 
+    # Retrieve the account's annotations, along with their keys, values and
+    # batch details, using a single query.  We then group the annotations by
+    # key, using a dictionary so that finding the entry for a key doesn't
+    # depend on how many keys there are.
+
     annotations = []
+    entries     = {} # Maps lowercase key to entry in 'annotations'.
+    timestamps  = {} # Maps batch ID to unix timestamp for that batch.
 
     query = Annotation.objects.filter(account=account).order_by("-id")
-    for annotation in query:
-        found = False
-        for entry in annotations:
-            if entry['key'].lower() == annotation.key.key.lower():
-                found = True
-                break
-
-        if not found:
+    for (key, value, batch_id, batch_timestamp, user_id, hidden, hidden_at,
+         hidden_by) in query.values_list("key__key", "value__value",
+                                         "batch_id", "batch__timestamp",
+                                         "batch__user_id", "hidden",
+                                         "hidden_at", "hidden_by"):
+        entry = entries.get(key.lower())
+        if entry == None:
             # This is the first time we've encountered this annotation key ->
             # create a new history entry for it.
-            entry = {'key'     : annotation.key.key,
+            entry = {'key'     : key,
                      'history' : []}
             annotations.append(entry)
+            entries[key.lower()] = entry
 
-        timetuple = annotation.batch.timestamp.timetuple()
-        timestamp = int(time.mktime(timetuple))
+        timestamp = timestamps.get(batch_id)
+        if timestamp == None:
+            timestamp = int(time.mktime(batch_timestamp.timetuple()))
+            timestamps[batch_id] = timestamp
 
-        history_entry = {'batch_number' : annotation.batch.id,
-                         'value'        : annotation.value.value,
+        history_entry = {'batch_number' : batch_id,
+                         'value'        : value,
                          'timestamp'    : timestamp,
-                         'user_id'      : annotation.batch.user_id,
-                         'hidden'       : annotation.hidden}
+                         'user_id'      : user_id,
+                         'hidden'       : hidden}
 
-        if annotation.hidden:
-            timetuple = annotation.hidden_at.timetuple()
-            hidden_at = int(time.mktime(timetuple))
-            history_entry['hidden_at'] = hidden_at
-            history_entry['hidden_by'] = annotation.hidden_by
+        if hidden:
+            history_entry['hidden_at'] = int(time.mktime(
+                                                    hidden_at.timetuple()))
+            history_entry['hidden_by'] = hidden_by
 
         if len(entry['history']) == 0:
             # This is the first entry for this annotation -> remember it.
@@ -700,7 +1345,8 @@ def account_history(account):
 
 #############################################################################
 
-def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
+def search(query, page=1, rpp=1000, totals_only=False, public_only=False,
+           cursor=None, include_totals=False, debug=False, as_of=None):
     """ Return a list of the accounts which match the given search query
 
         The parameters are as follows:
@@ -732,6 +1378,33 @@ def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
                 public flag is taken from the user template named in our
                 application settings.
 
+            'cursor'
+
+                If this is not None, the results are returned using "cursor"
+                pagination rather than page numbers; see below.  This should be
+                an empty string to retrieve the first page of results, or the
+                'next_cursor' value returned with the previous page.
+
+            'include_totals'
+
+                If True, the totals are returned even when using cursor
+                pagination.  By default, the totals are left out when a cursor
+                is used, as calculating them can be slow.
+
+            'debug'
+
+                If True, the database's plan for running the search query, and
+                its estimated cost, are included in the response.  Note that
+                debug searches always go to the database, rather than using
+                any cached or in-memory search results.
+
+            'as_of'
+
+                If this is not None, it should be a datetime.datetime object.
+                The search query will be matched against the annotation
+                values as they were at that moment, rather than the current
+                annotation values.
+
         The search query consists of one or more query terms, where each query
         term is a string of the form:
 
@@ -755,9 +1428,21 @@ def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
             <=
             >=
             !=
-
-        Note that the '<' and '>' operators perform alphanumeric comparisons as
-        all annotation values are treated as strings.
+            ~
+            %
+
+        The '~' operator performs a wildcard match, where '*' in the value
+        matches any sequence of characters and '?' matches any single
+        character; for example, "name ~ 'bitst*'" matches every name starting
+        with "bitst".  The '%' operator performs a fuzzy match, finding values
+        which are similar to the given value.  Both of these comparisons are
+        case-insensitive.
+
+        If the value is a number (for example, "42" or "-1.5") or a date (for
+        example, "2014-05-01" or "2014-05-01T10:30:00Z"), the '<', '>', '<='
+        and '>=' operators compare the annotation values as numbers or dates,
+        ignoring any annotation values which aren't numbers or dates.
+        Otherwise, these operators perform alphanumeric comparisons.
 
         The search query can consist of just one query term, or it can consist
         of multiple terms, surrounded by parentheses and joined with and, or or
@@ -767,7 +1452,12 @@ def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
             not ((name = "john") or (name = "harry"))
 
         The search query is used to identify those accounts which have current
-        annotation values matching the supplied search term(s).
+        annotation values matching the supplied search term(s).  Each search
+        term is matched separately against the account's current annotations,
+        so "(name = 'john') and (status = 'CURRENT')" matches the accounts
+        which have both annotations.  A "not" expression matches the accounts
+        with at least one current annotation which don't match the negated
+        expression.
 
         If the request was successful, we return a dictionary which looks like
         this:
@@ -786,12 +1476,30 @@ def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
         If the 'totals_only' parameter was set to True, the returned dictionary
         will not include the 'accounts' or 'num_pages' entries.
 
+        If a cursor was supplied, the returned dictionary will also include a
+        'next_cursor' entry.  This is the cursor to use to retrieve the next
+        page of results, or None if there are no more results.  In this case,
+        'num_matches' and 'num_pages' are only included if 'include_totals'
+        was set.
+
+        If the 'debug' parameter was set to True, the returned dictionary will
+        also include 'plan' and 'cost' entries, holding the query plan and the
+        estimated cost of running the search query, as returned by the
+        database's EXPLAIN command.  Under PostgreSQL, the plan is the
+        JSON-format query plan; for other databases, the cost may be None.
+
         If an error occurred, we return a dictionary which looks like this:
 
             {'success' : False,
              'error'   : "..."}
 
         where 'error' is a string describing why the request failed.
+
+        Note that if the SEARCH_MAX_COST setting is non-zero, any search query
+        which the database estimates will cost more than this to run will be
+        rejected, and if the SEARCH_STATEMENT_TIMEOUT setting is non-zero, any
+        search query which takes longer than this many milliseconds to run
+        will be cancelled.  In either case, an error will be returned.
     """
     expression = logicalExpressions.parse(query)
 
@@ -799,69 +1507,253 @@ def search(query, page=1, rpp=1000, totals_only=False, public_only=False):
         return {'success' : False,
                 'error'   : "Syntax error in search query"}
 
-    def expressionConverter(variable, comparison, value):
-        q1 = Q(key__key__iexact=variable)
+    if public_only:
+        # Check that the query only includes public annotations.
+
+        response = _check_public_annotations(expression.get_variables())
+        if response != None:
+            return response
+
+    # See if we have already cached the results of this search.  Note that
+    # the cache key depends on the annotation keys used by the query, and
+    # changes whenever the current values for any of those keys change.
+    # Searches as of a given moment don't use the current values, so they
+    # can't be invalidated in this way and are never cached.
 
-        if comparison == "=":
-            q2 = Q(value__value__iexact=value)
-        elif comparison == "<":
-            q2 = Q(value__value__lt=value)
-        elif comparison == ">":
-            q2 = Q(value__value__gt=value)
-        elif comparison == "<=":
-            q2 = Q(value__value__lte=value)
-        elif comparison == ">=":
-            q2 = Q(value__value__gte=value)
-        elif comparison == "!=":
-            Q2 = ~Q(value__value=value)
-
-        return q1 & q2
+    if debug or as_of != None:
+        return _search(expression, page, rpp, totals_only, cursor,
+                       include_totals, as_of, debug=debug)
+
+    cache_key = searchCache.make_key(expression, (page, rpp, totals_only,
+                                                  public_only, cursor,
+                                                  include_totals))
+
+    response = searchCache.get(cache_key)
+    if response != None:
+        return response
+
+    response = _search(expression, page, rpp, totals_only, cursor,
+                       include_totals, as_of)
+    if response['success']:
+        searchCache.put(cache_key, response)
+
+    return response
+
+#############################################################################
+
+def export_search(query):
+    """ Return every account which matches the given search query.
+
+        This is intended for exporting a large set of search results.  Rather
+        than returning a page of results at a time, we return a generator
+        which reads through every matching account using a single database
+        query, along with the matching account's current value for each of
+        the annotation keys used in the search query.
+
+        The search query is the same as for the search() function, above.
+
+        If the search query is valid, we return a dictionary which looks like
+        this:
+
+            {'success' : True,
+             'keys'    : [...],
+             'rows'    : <generator>}
+
+        where 'keys' is a list of the annotation keys used in the search
+        query, and 'rows' is a generator yielding a list for each matching
+        account, in order of account address.  Each list will hold the
+        account's address, followed by the account's current value for each
+        of the annotation keys, in the same order as 'keys'.  If the account
+        doesn't have a value for a key, an empty string will be used.
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.
+
+        Note that the database query is run in its own transaction as the
+        generator is read, so under PostgreSQL the matching rows are read
+        through using a server-side cursor rather than loading them all into
+        memory at once.
+    """
+    expression = logicalExpressions.parse(query)
+
+    if expression == None:
+        return {'success' : False,
+                'error'   : "Syntax error in search query"}
+
+    keys = []
+    seen = set()
+    for key in expression.get_variables():
+        if AnnotationKey.normalize(key) not in seen:
+            keys.append(key)
+            seen.add(AnnotationKey.normalize(key))
+
+    # Build a query which finds the matching accounts, and uses an outer join
+    # to pick up the account's current value for each of the keys.
+
+    account_table = Account._meta.db_table
+    current_table = CurrentAnnotation._meta.db_table
+    value_table   = AnnotationValue._meta.db_table
+
+    columns = ["a.address"]
+    joins   = []
+    params  = []
+
+    for i,key in enumerate(keys):
+        key_id = interning.get_key_id(key)
+        if key_id == None:
+            columns.append("''")
+            continue
+
+        columns.append("v%d.value" % i)
+        joins.append(("LEFT JOIN %s c%d ON c%d.account_id = a.id" +
+                      " AND c%d.key_id = %%s") %
+                     (current_table, i, i, i))
+        joins.append("LEFT JOIN %s v%d ON v%d.id = c%d.value_id" %
+                     (value_table, i, i, i))
+        params.append(key_id)
+
+    search_sql,search_params = expression.to_sql(_search_term_sql,
+                                                 _search_universe_sql())
+
+    sql = ("SELECT " + ", ".join(columns) +
+           " FROM " + account_table + " a " + " ".join(joins) +
+           " WHERE a.id IN (" + search_sql + ")" +
+           " ORDER BY a.address")
+    params.extend(search_params)
+
+    def _rows():
+        with transaction.atomic():
+            for row in streamingQueries.stream_rows("export_search",
+                                                    sql, params):
+                values = []
+                for value in row:
+                    if value == None:
+                        value = ""
+                    values.append(value)
+                yield values
+
+    return {'success' : True,
+            'keys'    : keys,
+            'rows'    : _rows()}
+
+#############################################################################
+
+def facets(keys, query=None, public_only=False):
+    """ Return the number of accounts with each current value for some keys.
+
+        The parameters are as follows:
+
+            'keys'
+
+                A list of the annotation keys to count the values for.
+
+            'query'
+
+                An optional search query, in the same format as for the
+                search() function, above.  If this is supplied, only the
+                accounts matching the search query will be counted.
+
+            'public_only'
+
+                If True, the keys and the search query will be limited to
+                publically-available annotations.  Any attempt to use a private
+                annotation will result in an error.
+
+        If the request was successful, we return a dictionary which looks like
+        this:
+
+            {'success' : True,
+             'facets'  : {...}}
+
+        where 'facets' is a dictionary mapping each of the given keys to a
+        dictionary which maps each current value for that key to the number of
+        (matching) accounts which currently have that value.  Accounts whose
+        annotations for a key have all been hidden are not counted.
+
+        If an error occurred, we return a dictionary which looks like this:
+
+            {'success' : False,
+             'error'   : "..."}
+
+        where 'error' is a string describing why the request failed.
+
+        Note that the counts for all the keys are calculated using a single
+        grouped query.
+    """
+    if type(keys) not in [list, tuple] or len(keys) == 0:
+        return {'success' : False,
+                'error'   : "You must supply at least one annotation key"}
+
+    if query not in [None, ""]:
+        expression = logicalExpressions.parse(query)
+        if expression == None:
+            return {'success' : False,
+                    'error'   : "Syntax error in search query"}
+    else:
+        expression = None
 
     if public_only:
-        # Check that the query only includes public annotations.
+        variables = list(keys)
+        if expression != None:
+            variables.extend(expression.get_variables())
 
-        response = get_template(settings.PUBLIC_TEMPLATE_NAME)
-        if not response['success']:
+        response = _check_public_annotations(variables)
+        if response != None:
             return response
 
-        is_public = {} # Maps annotation key to boolean.
-        for annotation in response['template']:
-            is_public[annotation['annotation']] = annotation['public']
+    key_ids = interning.get_key_ids(keys, create=False) # normalized key -> ID.
 
-        for annotation in expression.get_variables():
-            if not is_public.get(annotation, False):
-                return {'success' : False,
-                        'error'   : "%s is a private annotation" % annotation}
+    results    = {} # Maps key to {value: count} dictionary.
+    key_for_id = {} # Maps key ID to key.
+    for key in keys:
+        results[key] = {}
+        key_id = key_ids.get(AnnotationKey.normalize(key))
+        if key_id != None:
+            key_for_id[key_id] = key
 
-    query       = expression.to_django_query(converter=expressionConverter)
-    results     = CurrentAnnotation.objects.filter(query).distinct("account")
-    num_matches = results.count()
+    if len(key_for_id) == 0:
+        return {'success' : True,
+                'facets'  : results}
 
-    if totals_only:
-        return {'success'     : True,
-                'num_matches' : num_matches}
+    # Count the accounts with each (key, value) combination, and then look up
+    # the value strings for the counted values.
 
-    paginator = Paginator(results.order_by("account.address"), rpp)
+    current_table = CurrentAnnotation._meta.db_table
+    value_table   = AnnotationValue._meta.db_table
 
-    try:
-        annotations_in_page = paginator.page(page)
-    except PageNotAnInteger:
-        annotations_in_page = paginator.page(1)
-    except EmptyPage:
-        annotations_in_page = []
+    where  = "key_id IN (" + ", ".join(["%s"] * len(key_for_id)) + ")"
+    params = list(key_for_id.keys())
 
-    accounts = []
-    for annotation in annotations_in_page:
-        accounts.append(annotation.account.address)
+    if expression != None:
+        search_sql,search_params = expression.to_sql(_search_term_sql,
+                                                     _search_universe_sql())
+        where = where + " AND account_id IN (" + search_sql + ")"
+        params.extend(search_params)
 
-    return {'success'     : True,
-            'num_matches' : num_matches,
-            'num_pages'   : paginator.num_pages,
-            'accounts'    : accounts}
+    sql = ("SELECT c.key_id, v.value, c.num_accounts FROM" +
+           " (SELECT key_id, value_id, COUNT(*) AS num_accounts FROM " +
+           current_table + " WHERE " + where +
+           " GROUP BY key_id, value_id) c" +
+           " JOIN " + value_table + " v ON v.id = c.value_id" +
+           " WHERE v.value != ''")
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+    for key_id,value,num_accounts in cursor.fetchall():
+        results[key_for_id[key_id]][value] = num_accounts
+
+    return {'success' : True,
+            'facets'  : results}
 
 #############################################################################
 
-def public_annotations(annotation, page=1, rpp=100):
+def public_annotations(annotation, page=1, rpp=100, cursor=None,
+                       include_totals=False):
     """ Return a list of accounts which have the given public annotation.
 
         The parameters are as follows:
@@ -879,6 +1771,19 @@ def public_annotations(annotation, page=1, rpp=100):
 
                 The number of results to return per page.
 
+            'cursor'
+
+                If this is not None, the results are returned using "cursor"
+                pagination rather than page numbers; see below.  This should be
+                an empty string to retrieve the first page of results, or the
+                'next_cursor' value returned with the previous page.
+
+            'include_totals'
+
+                If True, the totals are returned even when using cursor
+                pagination.  By default, the totals are left out when a cursor
+                is used, as calculating them can be slow.
+
         We find all matching accounts which have values for the given public
         annotation key.
 
@@ -896,6 +1801,12 @@ def public_annotations(annotation, page=1, rpp=100):
         value) tuple.  'account' will be the address of the matching Ripple
         account, and 'value' will be the value of the public annotation.
 
+        If a cursor was supplied, the returned dictionary will also include a
+        'next_cursor' entry.  This is the cursor to use to retrieve the next
+        page of results, or None if there are no more results.  In this case,
+        'num_accounts' and 'num_pages' are only included if 'include_totals'
+        was set.
+
         If an error occurred, we return a dictionary which looks like this:
 
             {'success' : False,
@@ -918,7 +1829,28 @@ def public_annotations(annotation, page=1, rpp=100):
         return {'success' : False,
                 'error'   : "%s is not a public annotation" % annotation}
 
-    results      = CurrentAnnotation.objects.filter(key__key=annotation)
+    results = CurrentAnnotation.objects.filter(
+                                key_id=interning.get_key_id(annotation))
+
+    if cursor != None:
+        try:
+            rows,next_cursor = _get_cursor_page(
+                    results.values_list("account__address", "value__value"),
+                    "account__address", cursor, rpp)
+        except ValueError as e:
+            return {'success' : False,
+                    'error'   : str(e)}
+
+        response = {'success'     : True,
+                    'accounts'    : [(address, value)
+                                     for address,value in rows],
+                    'next_cursor' : next_cursor}
+        if include_totals:
+            num_accounts = results.count()
+            response['num_accounts'] = num_accounts
+            response['num_pages']    = _num_pages(num_accounts, rpp)
+        return response
+
     num_accounts = results.count()
 
     paginator = Paginator(results.order_by("account__address"), rpp)
@@ -1090,16 +2022,9 @@ def set_template(template_name, template):
                         'error'   : "choice template entry type must have a " +
                                     "'choices' field"}
 
-        try:
-            annotationKey = AnnotationKey.objects.get(
-                                    key=src_entry['annotation'])
-        except AnnotationKey.DoesNotExist:
-            annotationKey = AnnotationKey()
-            annotationKey.key = src_entry['annotation']
-            annotationKey.save()
-
         entry = AnnotationTemplateEntry()
-        entry.annotation = annotationKey
+        entry.annotation_id = interning.get_key_id(src_entry['annotation'],
+                                                   create=True)
         entry.label      = src_entry['label']
         entry.public     = src_entry['public']
         entry.type       = src_entry['type']
@@ -1135,6 +2060,8 @@ def set_template(template_name, template):
 
     template = AnnotationTemplate()
     template.name = template_name
+    if existing_template != None:
+        template.version = existing_template.version + 1
     template.save()
 
     for entry in entries:
@@ -1345,3 +2272,542 @@ def list_templates(page=1, rpp=100):
             'num_pages' : paginator.num_pages,
             'templates' : templates}
 
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+class _LostClaim(Exception):
+    """ An exception raised when another worker has taken over our batch.
+    """
+    pass
+
+#############################################################################
+
+def _abandoned_batches():
+    """ Return the QueuedBatches whose worker's claim has expired.
+    """
+    cutoff = (datetime.datetime.utcnow().replace(tzinfo=utc) -
+              datetime.timedelta(seconds=settings.QUEUE_LEASE_TIMEOUT))
+
+    return QueuedBatch.objects.filter(Q(heartbeat_at__lt=cutoff) |
+                                      Q(heartbeat_at__isnull=True),
+                                      status="processing")
+
+
+def _claimable_batches():
+    """ Return the QueuedBatches which a worker can claim.
+
+        This includes the pending batches, and any batches whose worker's
+        claim has expired.
+    """
+    return QueuedBatch.objects.filter(
+                        Q(status="pending") |
+                        Q(id__in=_abandoned_batches().values("id")))
+
+#############################################################################
+
+def _check_annotation(entry):
+    """ Check that the given annotation entry is valid.
+
+        'entry' should be a single annotation entry, as supplied to add().  If
+        the entry is valid, we return None.  Otherwise, we return a string
+        describing what is wrong with the entry.
+
+        Note that numbers and booleans are accepted for the 'account', 'key'
+        and 'value' fields, and are converted to strings in place, as they
+        always have been.
+    """
+    if type(entry) is not dict:
+        return "annotation entry must be an object"
+
+    if 'account' not in entry:
+        return "annotation must include an 'account' entry"
+
+    if 'key' not in entry:
+        return "annotation must include a 'key' entry"
+
+    if 'value' not in entry:
+        return "annotation must include a 'value' entry"
+
+    for field in ["account", "key", "value"]:
+        if isinstance(entry[field], (bool, int, long, float)):
+            entry[field] = unicode(entry[field])
+        elif not isinstance(entry[field], basestring):
+            return "annotation '%s' entry must be a string" % field
+
+    return None
+
+#############################################################################
+
+def _check_public_annotations(annotations):
+    """ Check that the given annotation keys are all public.
+
+        We return None if every annotation key in the given list is marked as
+        public in the public template, or a dictionary with 'success' and
+        'error' entries describing the problem if they are not.
+    """
+    response = get_template(settings.PUBLIC_TEMPLATE_NAME)
+    if not response['success']:
+        return response
+
+    is_public = {} # Maps annotation key to boolean.
+    for annotation in response['template']:
+        is_public[annotation['annotation']] = annotation['public']
+
+    for annotation in annotations:
+        if not is_public.get(annotation, False):
+            return {'success' : False,
+                    'error'   : "%s is a private annotation" % annotation}
+
+    return None
+
+#############################################################################
+
+def _search(expression, page, rpp, totals_only, cursor, include_totals,
+            as_of=None, debug=False):
+    """ Run a search query, without using the search cache.
+
+        The parameters are the same as for search(), except that the query
+        has already been parsed into a LogicalExpression and checked.  We
+        return the search response.
+    """
+    # If we have an in-memory index of the current annotations, try using it
+    # to answer this query without going to the database.
+
+    if (bitmapIndex.is_enabled() and (cursor == None or totals_only)
+                                 and as_of == None and not debug):
+        response = bitmapIndex.search(expression, page, rpp, totals_only)
+        if response != None:
+            return response
+
+    # Compile the search query into a single SQL statement which finds the
+    # matching account IDs.  Each search term becomes a separate set of
+    # account IDs, and these sets are combined using INTERSECT, UNION and
+    # EXCEPT.
+
+    # If we are searching the annotation values as of a given moment, each
+    # search term uses those values in place of the CurrentAnnotation table.
+
+    sql,params = expression.to_sql(
+                        functools.partial(_search_term_sql, as_of=as_of),
+                        _search_universe_sql(as_of))
+
+    results = Account.objects.extra(
+                    where=[Account._meta.db_table + ".id IN (" + sql + ")"],
+                    params=params)
+
+    # Ask the database how expensive the query will be, and refuse to run it
+    # if it is over our budget.
+
+    plan = None
+    cost = None
+    if debug or settings.SEARCH_MAX_COST > 0:
+        plan,cost = _explain_query(results.values_list("id"))
+
+        if (settings.SEARCH_MAX_COST > 0 and cost != None
+                                          and cost > settings.SEARCH_MAX_COST):
+            response = {'success' : False,
+                        'error'   : "Search query is too complex"}
+            if debug:
+                response['plan'] = plan
+                response['cost'] = cost
+            return response
+
+    # Run the query, stopping it if it takes too long.
+
+    try:
+        response = _run_with_statement_timeout(_get_search_results, results,
+                                               page, rpp, totals_only, cursor,
+                                               include_totals)
+    except OperationalError as e:
+        if not _is_query_cancelled(e):
+            raise
+        response = {'success' : False,
+                    'error'   : "Search query took too long to run"}
+
+    if debug:
+        response['plan'] = plan
+        response['cost'] = cost
+
+    return response
+
+#############################################################################
+
+def _get_search_results(results, page, rpp, totals_only, cursor,
+                        include_totals):
+    """ Retrieve the results of a search query from the database.
+
+        'results' is a QuerySet of the matching Account records.  The other
+        parameters are the same as for search().  We return the search
+        response.
+    """
+    if cursor != None and not totals_only:
+        try:
+            rows,next_cursor = _get_cursor_page(
+                                            results.values_list("address"),
+                                            "address", cursor, rpp)
+        except ValueError as e:
+            return {'success' : False,
+                    'error'   : str(e)}
+
+        response = {'success'     : True,
+                    'accounts'    : [address for (address,) in rows],
+                    'next_cursor' : next_cursor}
+        if include_totals:
+            num_matches = results.count()
+            response['num_matches'] = num_matches
+            response['num_pages']   = _num_pages(num_matches, rpp)
+        return response
+
+    num_matches = results.count()
+
+    if totals_only:
+        return {'success'     : True,
+                'num_matches' : num_matches}
+
+    paginator = Paginator(results.order_by("address").values_list("address",
+                                                                  flat=True),
+                          rpp)
+
+    try:
+        accounts_in_page = paginator.page(page)
+    except PageNotAnInteger:
+        accounts_in_page = paginator.page(1)
+    except EmptyPage:
+        accounts_in_page = []
+
+    accounts = []
+    for address in accounts_in_page:
+        accounts.append(address)
+
+    return {'success'     : True,
+            'num_matches' : num_matches,
+            'num_pages'   : paginator.num_pages,
+            'accounts'    : accounts}
+
+#############################################################################
+
+def _search_term_sql(variable, comparison, value, as_of=None):
+    """ Convert a single search term into SQL.
+
+        This is the converter function passed to LogicalExpression.to_sql().
+        We return an (sql, params) tuple, where 'sql' is an SQL statement
+        returning the IDs of the accounts whose current value for the given
+        annotation key matches the given comparison.
+
+        Each term only touches the CurrentAnnotation records for a single
+        annotation key, so the database can use the (key, value) index to find
+        the matching accounts.
+
+        If 'as_of' is not None, we match against the annotation values as of
+        that moment, calculated for just this annotation key, rather than the
+        CurrentAnnotation table.
+    """
+    value_table = AnnotationValue._meta.db_table
+
+    key_id = interning.get_key_id(variable)
+    if key_id == None:
+        # There are no annotations with this key, so nothing can match.
+        return ("SELECT account_id AS id FROM " +
+                CurrentAnnotation._meta.db_table + " WHERE 1 = 0", [])
+
+    if as_of == None:
+        current_table = CurrentAnnotation._meta.db_table
+        source_params = []
+    else:
+        sql,source_params = annotationSnapshots.values_sql(as_of,
+                                                           key_ids=[key_id])
+        current_table = "(" + sql + ")"
+
+    if comparison in ["=", "!="]:
+        value_id = interning.get_value_id(value)
+
+        if comparison == "=":
+            if value_id == None:
+                where  = "1 = 0"
+                params = []
+            else:
+                where  = "c.key_id = %s AND c.value_id = %s"
+                params = [key_id, value_id]
+        else:
+            if value_id == None:
+                where  = "c.key_id = %s"
+                params = [key_id]
+            else:
+                where  = "c.key_id = %s AND c.value_id != %s"
+                params = [key_id, value_id]
+
+        return ("SELECT c.account_id AS id FROM " + current_table + " c" +
+                " WHERE " + where, source_params + params)
+
+    if comparison in ["~", "%"]:
+        # Wildcard and fuzzy matches are done against the normalized value, so
+        # they are case-insensitive.  Under PostgreSQL, these can use the
+        # "text_pattern_ops" and trigram indexes on the normalized value.  The
+        # fuzzy match uses the pg_trgm "%" similarity operator; other
+        # databases fall back to a substring match.
+
+        if comparison == "~":
+            where = "v.normalized_value LIKE %s ESCAPE '\\'"
+            value = logicalExpressions.wildcard_to_like(
+                                        AnnotationValue.normalize(value))
+        elif connection.vendor == "postgresql":
+            where = "v.normalized_value %% %s"
+            value = AnnotationValue.normalize(value)
+        else:
+            where = "v.normalized_value LIKE %s ESCAPE '\\'"
+            value = "%" + logicalExpressions.wildcard_to_like(
+                                        AnnotationValue.normalize(value)) + "%"
+
+        return ("SELECT c.account_id AS id FROM " + current_table + " c" +
+                " JOIN " + value_table + " v ON v.id = c.value_id" +
+                " WHERE c.key_id = %s AND " + where,
+                source_params + [key_id, value])
+
+    # The remaining comparisons ("<", ">", "<=" and ">=") compare the value
+    # itself.  If the value being compared against is a number or a date, we
+    # compare against the annotation values parsed in the same way, so that
+    # the comparison works as expected and can use the index on the typed
+    # column.  Otherwise, we compare the values as strings.  Note that the
+    # comparison has already been checked by the SimpleExpression object, so
+    # it is safe to include it in the SQL.
+
+    numeric_value = typedValues.parse_number(value)
+    date_value    = typedValues.parse_date(value)
+
+    if numeric_value != None:
+        column = "v.numeric_value"
+        value  = numeric_value
+    elif date_value != None:
+        column = "v.date_value"
+        value  = date_value
+    else:
+        column = "v.value"
+
+    return ("SELECT c.account_id AS id FROM " + current_table + " c" +
+            " JOIN " + value_table + " v ON v.id = c.value_id" +
+            " WHERE c.key_id = %s AND " + column + " " + comparison + " %s",
+            source_params + [key_id, value])
+
+
+def _search_universe_sql(as_of=None):
+    """ Return the SQL used to find every searchable account.
+
+        This is passed to LogicalExpression.to_sql(), and is used to find the
+        accounts which don't match a negated search term.  If 'as_of' is not
+        None, we find the accounts which had annotations at that moment.
+    """
+    if as_of != None:
+        sql,params = annotationSnapshots.values_sql(as_of)
+        return ("SELECT DISTINCT account_id AS id FROM (" + sql + ") c",
+                params)
+
+    return ("SELECT DISTINCT account_id AS id FROM " +
+            CurrentAnnotation._meta.db_table, [])
+
+#############################################################################
+
+def _get_annotations_as_of(as_of, account_ids, key_ids=None):
+    """ Return the annotations for a set of accounts as of a given moment.
+
+        'as_of' is a datetime.datetime object, 'account_ids' is a list of
+        Account record IDs, and 'key_ids', if supplied, is a list of the
+        AnnotationKey record IDs to include.
+
+        We return a list of (address, key, value) tuples, sorted by address
+        and key, holding the annotation values for the given accounts at that
+        moment.
+    """
+    if len(account_ids) == 0:
+        return []
+
+    sql,params = annotationSnapshots.values_sql(as_of, account_ids=account_ids,
+                                                key_ids=key_ids)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT a.address, k.key, v.value" +
+                   " FROM (" + sql + ") c" +
+                   " JOIN " + Account._meta.db_table + " a" +
+                   " ON a.id = c.account_id" +
+                   " JOIN " + AnnotationKey._meta.db_table + " k" +
+                   " ON k.id = c.key_id" +
+                   " JOIN " + AnnotationValue._meta.db_table + " v" +
+                   " ON v.id = c.value_id" +
+                   " ORDER BY a.address, k.key", params)
+    return cursor.fetchall()
+
+#############################################################################
+
+def _get_cursor_page(query, field, cursor, rpp, descending=False):
+    """ Return a single page of results using cursor ("keyset") pagination.
+
+        The parameters are as follows:
+
+            'query'
+
+                A values_list() QuerySet to retrieve the results from.  The
+                first value in each row must be the value of 'field'.
+
+            'field'
+
+                The name of the unique field the results are sorted by.  This
+                is either "id", for a record ID, or the name of a text field
+                such as an account address.
+
+            'cursor'
+
+                The cursor supplied by the caller.  This is either an empty
+                string for the first page of results, or a cursor returned
+                with the previous page.
+
+            'rpp'
+
+                The number of results to return in each page.
+
+            'descending'
+
+                If True, the results are sorted in descending order.
+
+        Rather than skipping over the earlier pages of results, we use the
+        cursor to go straight to the first result after the previous page, so
+        each page takes the same amount of work no matter how far through the
+        results we are.
+
+        We return a (rows, next_cursor) tuple, where 'rows' is the list of rows
+        in this page of results, and 'next_cursor' is the cursor to use for the
+        next page, or None if there are no more results.  If the cursor or the
+        'rpp' value is invalid, we raise a ValueError.
+    """
+    try:
+        rpp = max(1, int(rpp))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid rpp value")
+
+    if cursor != "":
+        if field == "id":
+            last_value = helpers.decode_cursor(cursor, (int, long))
+        else:
+            last_value = helpers.decode_cursor(cursor, basestring)
+        if descending:
+            query = query.filter(**{field + "__lt" : last_value})
+        else:
+            query = query.filter(**{field + "__gt" : last_value})
+
+    if descending:
+        query = query.order_by("-" + field)
+    else:
+        query = query.order_by(field)
+
+    # Retrieve one extra row, so we know if there is another page.
+
+    rows = list(query[:rpp+1])
+    if len(rows) > rpp:
+        rows        = rows[:rpp]
+        next_cursor = helpers.encode_cursor(rows[-1][0])
+    else:
+        next_cursor = None
+
+    return (rows, next_cursor)
+
+#############################################################################
+
+def _num_pages(count, rpp):
+    """ Return the number of pages needed to show 'count' results.
+
+        This matches the number of pages calculated by Django's Paginator,
+        including returning one page if there are no results.
+    """
+    rpp = max(1, int(rpp))
+    return max(1, (count + rpp - 1) // rpp)
+
+#############################################################################
+
+def _explain_query(query):
+    """ Ask the database how it will run the given QuerySet.
+
+        We return a (plan, cost) tuple, where 'plan' is the query plan
+        returned by the database, and 'cost' is the database's estimate of the
+        total cost of running the query.  Under PostgreSQL, the plan is the
+        parsed JSON-format output of the EXPLAIN command, and the cost is in
+        PostgreSQL's arbitrary cost units.  For other databases, we return the
+        plan as a list of strings, and the cost will be None.
+    """
+    sql,params = query.query.sql_with_params()
+
+    cursor = connection.cursor()
+
+    if connection.vendor == "postgresql":
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return (plan, plan[0]['Plan']['Total Cost'])
+    elif connection.vendor == "sqlite":
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return ([row[-1] for row in cursor.fetchall()], None)
+    else:
+        return (None, None)
+
+#############################################################################
+
+def _run_with_statement_timeout(func, *args):
+    """ Call the given function, limiting how long each query can run for.
+
+        Under PostgreSQL, we call the function within a transaction which has
+        its "statement_timeout" set to the SEARCH_STATEMENT_TIMEOUT setting,
+        so that any query which takes longer than this (in milliseconds) is
+        cancelled.  For other databases, or if SEARCH_STATEMENT_TIMEOUT is
+        zero, we simply call the function.
+
+        We return whatever the function returns.
+    """
+    if (connection.vendor != "postgresql" or
+            settings.SEARCH_STATEMENT_TIMEOUT <= 0):
+        return func(*args)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL statement_timeout = %s",
+                       [int(settings.SEARCH_STATEMENT_TIMEOUT)])
+        return func(*args)
+
+#############################################################################
+
+def _is_query_cancelled(err):
+    """ Return True if the given database error is a cancelled query.
+
+        This is the error raised when a query runs longer than the statement
+        timeout.
+    """
+    cause = getattr(err, "__cause__", None)
+    return getattr(cause, "pgcode", None) == "57014" # query_canceled.
+
+#############################################################################
+
+def _run_atomically(func, *args):
+    """ Call the given function within a single database transaction.
+
+        We return whatever the function returns.  Any AnnotationChange records
+        are written at the end of the transaction; see
+        helpers.recording_changes().
+
+        If the transaction fails because of a clash with another process (for
+        example, two processes adding the same new annotation value at once,
+        or our interning cache holding the ID of an account which another
+        process has deleted), we clear our cached record IDs and try once more.
+    """
+    for attempt in range(2):
+        try:
+            with transaction.atomic(), helpers.recording_changes():
+                result = func(*args)
+            searchCache.flush()
+            return result
+        except IntegrityError:
+            interning.clear()
+            if attempt > 0:
+                raise
+        except:
+            interning.clear()
+            raise
@@ -3,10 +3,23 @@
     This module implements various helper functions for the Annotation
     Database's "api" application.
 """
+import base64
+import contextlib
+import datetime
 import sys
+import threading
 import uuid
 
+import simplejson as json
+
+from django.conf           import settings
+from django.db             import connection
+from django.db.models      import F, Max
+from django.utils.timezone import utc
+
 from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib    import interning, bitmapIndex
+from annotationDatabase.shared.lib    import searchCache
 
 #############################################################################
 
@@ -62,35 +75,433 @@ def set_current_annotation(account, key, value):
         and key, and if so update it to the new value.  Otherwise, we create a
         CurrentAnnotation record for this account and key combination.
     """
-    try:
-        annotation_account = Account.objects.get(address=account)
-    except Account.DoesNotExist:
-        annotation_account = Account()
-        annotation_account.address = account
-        annotation_account.save()
+    account_id = interning.get_account_id(account, create=True)
+    key_id     = interning.get_key_id(key, create=True)
+    value_id   = interning.get_value_id(value, create=True)
+
+    set_current_annotations({(account_id, key_id) : value_id})
+
+
+#############################################################################
+
+def add_annotations(batch, entries):
+    """ Store a list of annotations as part of the given annotation batch.
+
+        The parameters are as follows:
+
+            'batch'
+
+                The AnnotationBatch object to add the annotations to.  This
+                must already have been saved into the database.
+
+            'entries'
+
+                A list of annotations to store.  Each list item should be a
+                dictionary with 'account', 'key' and 'value' entries, as
+                described in annotationDatabase.api.functions.add().  Note that
+                the entries must already have been validated.
+
+        This is the bulk equivalent of creating an Annotation record for each
+        entry and then calling set_current_annotation() for it.  Rather than
+        working on one annotation at a time, we resolve all the accounts, keys
+        and values used by the entries at once, insert the Annotation records
+        in bulk, and then update the CurrentAnnotation records as a set.  This
+        means that the number of database queries we make doesn't depend on
+        the number of entries.
+
+        Note that a batch's annotations may be stored some time after the
+        batch was created, for example when the batch was queued or streamed.
+        If another batch with a later timestamp has already set the current
+        value for an account and key, that value is left alone, so that the
+        CurrentAnnotation records always hold the value from the most recent
+        batch.
+    """
+    account_ids = interning.get_account_ids(
+                                    [entry['account'] for entry in entries])
+    key_ids     = interning.get_key_ids(
+                                    [entry['key'] for entry in entries])
+    value_ids   = interning.get_value_ids(
+                                    [entry['value'] for entry in entries])
+
+    annotations = []
+    current     = {} # Maps (account_id, key_id) tuple to value_id.
+
+    for entry in entries:
+        account_id = account_ids[entry['account']]
+        key_id     = key_ids[entry['key'].lower()]
+        value_id   = value_ids[entry['value'].lower()]
+
+        annotation = Annotation()
+        annotation.batch_id   = batch.id
+        annotation.account_id = account_id
+        annotation.key_id     = key_id
+        annotation.value_id   = value_id
+        annotation.hidden     = False
+        annotation.hidden_at  = None
+        annotation.hidden_by  = None
+        annotations.append(annotation)
+
+        # Note that if the same account and key appear more than once in the
+        # batch, the last entry wins.
+
+        current[(account_id, key_id)] = value_id
+
+    Annotation.objects.bulk_create(annotations)
+
+    AnnotationBatch.objects.filter(id=batch.id).update(
+                                                version=F("version") + 1)
+
+    # Skip any accounts and keys which have a visible annotation in a more
+    # recent batch.
+
+    newer = Annotation.objects.filter(
+                        account_id__in=set([a for a,k in current]),
+                        key_id__in=set([k for a,k in current]),
+                        hidden=False,
+                        batch__timestamp__gt=batch.timestamp)
+
+    for account_id,key_id in newer.values_list("account_id", "key_id"):
+        current.pop((account_id, key_id), None)
+
+    set_current_annotations(current)
+
+#############################################################################
+
+def set_current_annotations(annotations):
+    """ Create or update a set of CurrentAnnotation records.
+
+        'annotations' should be a dictionary mapping (account_id, key_id)
+        tuples to the value_id to use as the current value for that account
+        and key.
+
+        This is the bulk equivalent of calling set_current_annotation() for
+        each entry.  We replace any existing CurrentAnnotation records for the
+        given account and key combinations in a fixed number of queries.
+
+        Each current value which actually changes is also recorded in the
+        AnnotationChange table, within the same transaction, so that the
+        changes can be read back in order using the "/changes" endpoint.  If
+        we are called within a recording_changes() block, the changes are
+        written at the end of that block.
+    """
+    if not annotations:
+        return
+
+    account_ids = set([account_id for account_id,key_id in annotations])
+    key_ids     = set([key_id     for account_id,key_id in annotations])
+
+    ids_to_replace = []
+    old_values     = {} # Maps (account_id, key_id) tuple to old value_id.
+    for id,account_id,key_id,value_id in CurrentAnnotation.objects.filter(
+                                            account_id__in=account_ids,
+                                            key_id__in=key_ids).values_list(
+                                            "id", "account_id", "key_id",
+                                            "value_id"):
+        if (account_id, key_id) in annotations:
+            ids_to_replace.append(id)
+            old_values[(account_id, key_id)] = value_id
+
+    if ids_to_replace:
+        CurrentAnnotation.objects.filter(id__in=ids_to_replace).delete()
+
+    new_annotations = []
+    for (account_id, key_id),value_id in annotations.items():
+        annotation = CurrentAnnotation()
+        annotation.account_id = account_id
+        annotation.key_id     = key_id
+        annotation.value_id   = value_id
+        new_annotations.append(annotation)
+
+    CurrentAnnotation.objects.bulk_create(new_annotations)
+
+    _record_changes(annotations, old_values)
+
+    # Let this process's in-memory search index know that it is out of date,
+    # and invalidate any cached search results which used these keys.  If we
+    # added a current value for an account and key which didn't have one
+    # before, the set of accounts being searched may also have changed.
+
+    bitmapIndex.changed()
+    searchCache.changed(key_ids,
+                        new_accounts=len(ids_to_replace) < len(annotations))
+
+#############################################################################
+
+def recalc_current_annotations(annotations):
+    """ Recalculate the current value for a set of accounts and keys.
+
+        'annotations' should be a set of (account_id, key_id) tuples.  For each
+        of these, we find the most recent visible (that is, not hidden)
+        Annotation, and make its value the current value for that account and
+        key.  If there are no visible annotations for an account and key, the
+        current value is set to an empty string.
+
+        Rather than working through the annotations one at a time, we find the
+        latest visible value for all the given accounts and keys with a single
+        query, and then update the CurrentAnnotation records as a set.
+    """
+    if not annotations:
+        return
+
+    account_ids = set([account_id for account_id,key_id in annotations])
+    key_ids     = set([key_id     for account_id,key_id in annotations])
+
+    query = Annotation.objects.filter(account_id__in=account_ids,
+                                      key_id__in=key_ids,
+                                      hidden=False)
+
+    if connection.vendor == "postgresql":
+        # Let the database pick out the latest value for each account and key.
+        query = query.order_by("account", "key",
+                               "-batch__timestamp", "-id") \
+                     .distinct("account", "key")
+    else:
+        query = query.order_by("-batch__timestamp", "-id")
+
+    current = {} # Maps (account_id, key_id) tuple to value_id.
+    for account_id,key_id,value_id in query.values_list("account_id",
+                                                        "key_id",
+                                                        "value_id"):
+        if (account_id, key_id) in annotations:
+            current.setdefault((account_id, key_id), value_id)
+
+    missing = [annotation for annotation in annotations
+               if annotation not in current]
+    if missing:
+        empty_value_id = interning.get_value_id("", create=True)
+        for annotation in missing:
+            current[annotation] = empty_value_id
+
+    set_current_annotations(current)
+
+#############################################################################
+
+def account_etag(address):
+    """ Return the ETag to use for the annotations of the given account.
+
+        The ETag is based on the ID of the most recent AnnotationChange record
+        for the account, which acts as a version number for the account's
+        current annotations.  Rebuilding or fixing the CurrentAnnotation table
+        can change the current annotations without adding AnnotationChange
+        records, so we include the table's generation number as well.
+
+        Note that this ETag can't be used for the annotations as of a given
+        moment: adding annotations to an older batch, or hiding an annotation
+        in one, can change those values without changing the current values.
+
+        We return the ETag as a string, or None if the account doesn't exist.
+    """
+    rows = Account.objects.filter(address=address) \
+                          .annotate(version=Max("annotationchange__id")) \
+                          .values_list("id", "version")
+    if len(rows) == 0:
+        return None
+
+    account_id,version = rows[0]
+    return "account-%d-%d-%d" % (account_id,
+                                 CurrentAnnotationMark.current_generation(),
+                                 version or 0)
+
+#############################################################################
 
+def batch_etag(batch_number):
+    """ Return the ETag to use for the given annotation batch.
+
+        We return the ETag as a string, or None if the batch doesn't exist.
+    """
     try:
-        annotation_key = AnnotationKey.objects.get(key__iexact=key)
-    except AnnotationKey.DoesNotExist:
-        annotation_key = AnnotationKey()
-        annotation_key.key = key
-        annotation_key.save()
+        batch_number = int(batch_number)
+    except ValueError:
+        return None
+
+    rows = AnnotationBatch.objects.filter(id=batch_number) \
+                                  .values_list("version", flat=True)
+    if len(rows) == 0:
+        return None
+
+    return "batch-%d-%d" % (batch_number, rows[0])
+
+#############################################################################
+
+def template_etag(template_name):
+    """ Return the ETag to use for the given annotation template.
+
+        We return the ETag as a string, or None if the template doesn't
+        exist.
+    """
+    rows = AnnotationTemplate.objects.filter(name=template_name) \
+                                     .values_list("id", "version")
+    if len(rows) == 0:
+        return None
+
+    template_id,version = rows[0]
+    return "template-%d-%d" % (template_id, version)
+
+#############################################################################
 
+def public_annotations_etag():
+    """ Return the ETag to use for the list of public annotations.
+
+        The list of public annotations depends on the public template and on
+        the current annotation values, so the ETag combines the template's
+        ETag with the generation number of the CurrentAnnotation table and the
+        ID of the most recent AnnotationChange record.  We return the ETag as
+        a string, or None if there is no public template.
+    """
+    template = template_etag(settings.PUBLIC_TEMPLATE_NAME)
+    if template == None:
+        return None
+
+    last_change_id = AnnotationChange.objects.aggregate(
+                                                last_id=Max("id"))['last_id']
+    return "public-%s-%d-%d" % (template,
+                                CurrentAnnotationMark.current_generation(),
+                                last_change_id or 0)
+
+#############################################################################
+
+def encode_cursor(value):
+    """ Encode the given value as an opaque pagination cursor.
+
+        'value' should be the sort key of the last item in the current page of
+        results, for example an account address or a batch number.  We return
+        a string which can be passed back to us to retrieve the next page of
+        results.
+    """
+    return base64.urlsafe_b64encode(json.dumps(value))
+
+#############################################################################
+
+def decode_cursor(cursor, value_type):
+    """ Decode a pagination cursor previously created by encode_cursor().
+
+        'value_type' is the type (or tuple of types) the value stored in the
+        cursor must have, for example int for a record ID or basestring for an
+        account address.  Because the cursor is supplied by the caller, it may
+        hold any JSON value at all; checking the type here stops a bad cursor
+        from making the database query fail.
+
+        We return the value stored in the cursor.  If the cursor is invalid, we
+        raise a ValueError.
+    """
     try:
-        annotation_value = AnnotationValue.objects.get(value__iexact=value)
-    except AnnotationValue.DoesNotExist:
-        annotation_value = AnnotationValue()
-        annotation_value.value = value
-        annotation_value.save()
+        value = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+    if isinstance(value, bool) or not isinstance(value, value_type):
+        raise ValueError("Invalid cursor")
 
+    return value
+
+@contextlib.contextmanager
+def recording_changes():
+    """ Write the AnnotationChange records at the end of a block of code.
+
+        This should wrap all the work done within a transaction, like this:
+
+            with transaction.atomic(), helpers.recording_changes():
+                ...
+
+        Any changes to the current annotation values made within the block
+        are collected, and then written to the AnnotationChange table in a
+        single insert at the end of the block, just before the transaction
+        commits.
+
+        Writing the AnnotationChange records locks the AnnotationChange table
+        until the transaction finishes, so that the changes are committed in
+        the same order as their record IDs.  This means that transactions
+        which change the current values can only commit one at a time.  By
+        writing the changes last, each transaction only holds the lock while
+        inserting its AnnotationChange records and committing, rather than
+        while doing all of its other work, so processes storing annotations
+        in parallel still do the bulk of their work at the same time.
+
+        If the block raises an exception, the collected changes are thrown
+        away.
+    """
+    pending = _pending_changes()
+    pending['depth'] += 1
     try:
-        annotation = CurrentAnnotation.objects.get(account=annotation_account,
-                                                   key=annotation_key)
-    except CurrentAnnotation.DoesNotExist:
-        annotation = CurrentAnnotation()
-        annotation.account = annotation_account
-        annotation.key     = annotation_key
+        yield
+        if pending['depth'] == 1:
+            _write_changes(pending['changes'])
+    finally:
+        pending['depth'] -= 1
+        if pending['depth'] == 0:
+            pending['changes'] = []
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The AnnotationChange records collected by the current thread's
+# recording_changes() block, if any.
+
+_thread_data = threading.local()
+
+#############################################################################
+
+def _pending_changes():
+    """ Return the dictionary of pending changes for the current thread.
+    """
+    if not hasattr(_thread_data, "pending"):
+        _thread_data.pending = {'depth'   : 0,
+                                'changes' : []}
+    return _thread_data.pending
+
+#############################################################################
+
+def _record_changes(annotations, old_values):
+    """ Add an AnnotationChange record for each changed current value.
+
+        'annotations' maps (account_id, key_id) tuples to the new value_id for
+        that account and key, and 'old_values' maps (account_id, key_id)
+        tuples to the previous value_id, where there was one.
+
+        If we are within a recording_changes() block, the records are written
+        at the end of that block.  Otherwise, they are written straight away.
+    """
+    changed_at = datetime.datetime.utcnow().replace(tzinfo=utc)
+
+    changes = []
+    for (account_id, key_id),value_id in sorted(annotations.items()):
+        if old_values.get((account_id, key_id)) == value_id:
+            continue # No change.
+
+        change = AnnotationChange()
+        change.account_id = account_id
+        change.key_id     = key_id
+        change.value_id   = value_id
+        change.changed_at = changed_at
+        changes.append(change)
+
+    pending = _pending_changes()
+    if pending['depth'] > 0:
+        pending['changes'].extend(changes)
+    else:
+        _write_changes(changes)
+
+#############################################################################
+
+def _write_changes(changes):
+    """ Write the given list of AnnotationChange records to the database.
+
+        Under PostgreSQL, we lock the AnnotationChange table until the current
+        transaction finishes.  This makes sure the changes are committed in
+        the same order as their record IDs, so that someone reading through
+        the changes never skips over a change which is committed later on.
+        Because the lock is held until the transaction finishes, this should
+        be the last thing the transaction does; see recording_changes().
+    """
+    if not changes:
+        return
 
-    annotation.value = annotation_value
-    annotation.save()
+    if connection.vendor == "postgresql":
+        cursor = connection.cursor()
+        cursor.execute("LOCK TABLE " + AnnotationChange._meta.db_table +
+                       " IN EXCLUSIVE MODE")
 
+    AnnotationChange.objects.bulk_create(changes)
@@ -3,17 +3,65 @@
     This module implements the various unit tests for the Ripple Annotation
     Database's "api" application.
 """
+import StringIO
+import datetime
+import decimal
+
 import simplejson as json
 
 import django.test
+from django.core.cache      import get_cache
+from django.core.management import call_command
+from django.db              import connection, transaction
+from django.test.utils      import CaptureQueriesContext, override_settings
+from django.utils            import timezone
 
 from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib    import interning, currentAnnotations
+from annotationDatabase.shared.lib    import logicalExpressions, bitmapIndex
+from annotationDatabase.shared.lib    import annotationSnapshots
 
 from annotationDatabase.api import functions, helpers
 
 #############################################################################
 
-class AddTestCase(django.test.TestCase):
+class APITestCase(django.test.TestCase):
+    """ Base class for our API unit tests.
+
+        Each test runs in a transaction which is rolled back when the test
+        finishes, so we throw away any record IDs cached by the interning
+        module before each test, along with any in-memory search index and
+        cached search results.
+    """
+    def setUp(self):
+        interning.clear()
+        bitmapIndex.clear()
+        get_cache("search").clear()
+
+
+    def _add_batches(self, num_batches, addresses):
+        """ Add a number of annotation batches for the given accounts.
+
+            Each batch sets a "name" and "status" annotation for each account.
+            We return the batch number of the last batch.
+        """
+        for i in range(num_batches):
+            annotations = []
+            for address in addresses:
+                annotations.append(dict(account=address, key="name",
+                                        value="name %d" % i))
+                annotations.append(dict(account=address, key="status",
+                                        value="status %d" % (i % 2)))
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : annotations})
+            if not response['success']:
+                self.fail(response['error'])
+
+        return response['batch_num']
+
+#############################################################################
+
+class AddTestCase(APITestCase):
     """ Unit tests for the "/add" API endpoint.
     """
     def test_add_in_body(self):
@@ -135,9 +183,544 @@ class AddTestCase(django.test.TestCase):
 
         self.assertEqual(annotation.value.value, "2")
 
+
+    def test_add_query_count(self):
+        """ Check that the number of queries made by "/add" is constant.
+        """
+        def _count_queries(num_annotations, prefix):
+            annotations = []
+            for i in range(num_annotations):
+                annotations.append(dict(account="%s%d" % (prefix, i),
+                                        key="%skey%d" % (prefix, i % 3),
+                                        value="%svalue%d" % (prefix, i)))
+
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.add({'user_id'     : "erik",
+                                          'annotations' : annotations})
+            if not response['success']:
+                self.fail(response['error'])
+
+            return len(queries)
+
+        self.assertEqual(_count_queries(5,  "ra"), _count_queries(50, "rb"))
+
+
+    def test_add_uses_interned_ids(self):
+        """ Check that "/add" doesn't look up known keys and values again.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner", value="erik"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        for query in queries:
+            self.assertFalse("shared_annotationkey" in query['sql'])
+            self.assertFalse("shared_annotationvalue" in query['sql'])
+
+
+    def test_add_duplicate_entries(self):
+        """ Check that the last entry for an account and key wins.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="status", value="1"),
+                     dict(account="r123", key="STATUS", value="2"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        annotation = CurrentAnnotation.objects.get(account__address="r123")
+        self.assertEqual(annotation.key.key,     "status")
+        self.assertEqual(annotation.value.value, "2")
+        self.assertEqual(Annotation.objects.count(), 2)
+
+
+    def test_add_invalid_batch_writes_nothing(self):
+        """ Check that a rejected batch doesn't leave anything behind.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner", value="erik"),
+                     dict(account="r124", key="owner"),
+                 ]
+                }
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.add(batch)
+
+        self.assertFalse(response['success'])
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(AnnotationBatch.objects.count(), 0)
+        self.assertEqual(Account.objects.count(), 0)
+
+
+    def test_add_converts_numbers_to_strings(self):
+        """ Check that numeric annotation values are accepted, as strings.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="age",    value=42),
+                     dict(account="r123", key="rating", value=4.5),
+                     dict(account="r123", key="owner",  value=None),
+                 ]
+                }
+
+        response = functions.add(batch)
+        self.assertFalse(response['success'])
+        self.assertEqual(response['error'],
+                         "annotation 'value' entry must be a string")
+
+        del batch['annotations'][-1]
+        batch['auth_token'] = helpers.get_auth_token_for_testing()
+
+        response = self.client.post("/add", data=json.dumps(batch),
+                                    content_type="application/json")
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertItemsEqual(
+            CurrentAnnotation.objects.values_list("key__key", "value__value"),
+            [("age", "42"), ("rating", "4.5")])
+
+
+    def test_add_is_atomic(self):
+        """ Check that a failure while storing a batch rolls back the batch.
+        """
+        def _fail(annotations):
+            raise RuntimeError("Simulated failure")
+
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner", value="erik"),
+                 ]
+                }
+
+        orig_set_current_annotations = helpers.set_current_annotations
+        helpers.set_current_annotations = _fail
+        try:
+            self.assertRaises(RuntimeError, functions.add, batch)
+        finally:
+            helpers.set_current_annotations = orig_set_current_annotations
+
+        self.assertEqual(AnnotationBatch.objects.count(), 0)
+        self.assertEqual(Annotation.objects.count(), 0)
+        self.assertEqual(Account.objects.count(), 0)
+
+
+    def test_add_normalizes_keys_and_values(self):
+        """ Check that keys and values are matched case-insensitively.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="Owner", value="Erik"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        interning.clear()
+
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r124", key="OWNER", value="ERIK"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(AnnotationKey.objects.count(),   1)
+        self.assertEqual(AnnotationValue.objects.count(), 1)
+
+        self.assertEqual(AnnotationKey.objects.get().normalized_key, "owner")
+        self.assertEqual(AnnotationValue.objects.get().normalized_value,
+                         "erik")
+
+#############################################################################
+
+class AddStreamTestCase(APITestCase):
+    """ Unit tests for the "/add_stream" API endpoint.
+    """
+    def _post_stream(self, auth_token, annotations, extra_lines=[]):
+        """ Post the given annotations to "/add_stream".
+
+            We return the decoded response.
+        """
+        lines = [json.dumps({'user_id'    : "erik",
+                             'auth_token' : auth_token})]
+        for annotation in annotations:
+            lines.append(json.dumps(annotation))
+        lines.extend(extra_lines)
+
+        response = self.client.post("/add_stream", data="\n".join(lines),
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json")
+
+        return json.loads(response.content)
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2)
+    def test_add_stream(self):
+        """ Test the "/add_stream" endpoint.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        annotations = []
+        for i in range(5):
+            annotations.append(dict(account="r%d" % i, key="owner",
+                                    value="erik"))
+
+        response = self._post_stream(auth_token, annotations)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertItemsEqual(response.keys(),
+                              ['success', 'batch_num', 'num_annotations'])
+        self.assertEqual(response['num_annotations'], 5)
+
+        batch_num = response['batch_num']
+        self.assertEqual(AnnotationBatch.objects.count(), 1)
+        self.assertEqual(Annotation.objects.filter(batch_id=batch_num).count(),
+                         5)
+        self.assertEqual(CurrentAnnotation.objects.count(), 5)
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2)
+    def test_add_stream_invalid_line(self):
+        """ Check that an invalid line means nothing is stored.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r1", key="owner",
+                                           value="tom")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        annotations = []
+        for i in range(3):
+            annotations.append(dict(account="r%d" % i, key="owner",
+                                    value="erik"))
+
+        response = self._post_stream(auth_token, annotations,
+                                     extra_lines=["{not json"])
+        self.assertFalse(response['success'])
+        self.assertTrue(response['error'].startswith("line 4:"))
+
+        annotation = CurrentAnnotation.objects.get(account__address="r1")
+        self.assertEqual(annotation.value.value, "tom")
+
+        self.assertEqual(AnnotationBatch.objects.count(), 1)
+        self.assertEqual(Annotation.objects.count(), 1)
+        self.assertEqual(Annotation.objects.filter(hidden=True).count(), 0)
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2)
+    def test_add_stream_database_error(self):
+        """ Check that a database error while storing a chunk stores nothing.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r1", key="owner",
+                                           value="tom")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        lines = []
+        for i in range(5):
+            lines.append(json.dumps(dict(account="r%d" % i, key="owner",
+                                         value="erik")))
+
+        # Make the second chunk fail.
+
+        add_annotations = helpers.add_annotations
+        calls = []
+
+        def _add_annotations(batch, entries):
+            calls.append(len(entries))
+            if len(calls) == 2:
+                raise RuntimeError("Database failure")
+            add_annotations(batch, entries)
+
+        helpers.add_annotations = _add_annotations
+        try:
+            self.assertRaises(RuntimeError, functions.add_stream,
+                              "erik", lines)
+        finally:
+            helpers.add_annotations = add_annotations
+
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(AnnotationBatch.objects.count(), 1)
+        self.assertEqual(Annotation.objects.count(), 1)
+
+        annotation = CurrentAnnotation.objects.get(account__address="r1")
+        self.assertEqual(annotation.value.value, "tom")
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=1)
+    def test_add_stream_keeps_newer_values(self):
+        """ Check that a stream doesn't overwrite values added since it began.
+        """
+        def _lines():
+            yield json.dumps(dict(account="r1", key="owner", value="stream"))
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : [
+                                          dict(account="r1", key="owner",
+                                               value="new")]})
+            if not response['success']:
+                self.fail(response['error'])
+            yield json.dumps(dict(account="r1", key="owner", value="stream"))
+
+        response = functions.add_stream("erik", _lines())
+        if not response['success']:
+            self.fail(response['error'])
+
+        annotation = CurrentAnnotation.objects.get(account__address="r1")
+        self.assertEqual(annotation.value.value, "new")
+        self.assertEqual(currentAnnotations.verify()['wrong'], 0)
+
+
+    def test_add_stream_invalid_first_line(self):
+        """ Check that a stream which fails straight away adds no batch.
+        """
+        response = functions.add_stream("erik", ["{not json"])
+        self.assertFalse(response['success'])
+        self.assertEqual(AnnotationBatch.objects.count(), 0)
+
+
+    def test_add_stream_requires_auth_token(self):
+        """ Check that "/add_stream" rejects an invalid auth token.
+        """
+        response = self._post_stream("bad token", [])
+        self.assertFalse(response['success'])
+        self.assertEqual(AnnotationBatch.objects.count(), 0)
+
+#############################################################################
+
+class AddInBackgroundTestCase(APITestCase):
+    """ Unit tests for adding batches with "/add?async=1".
+    """
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2)
+    def test_add_in_background(self):
+        """ Test queueing a batch and then processing it.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        batch = {'user_id'     : "erik",
+                 'auth_token'  : auth_token,
+                 'annotations' : [
+                     dict(account="r123", key="owner", value="erik"),
+                     dict(account="r124", key="owner", value="erik"),
+                     dict(account="r125", key="owner", value="erik"),
+                 ]
+                }
+
+        response = self.client.post("/add?async=1", data=json.dumps(batch),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertItemsEqual(response.keys(),
+                              ['success', 'batch_num', 'status'])
+        self.assertEqual(response['status'], "pending")
+        self.assertEqual(Annotation.objects.count(), 0)
+
+        batch_num = response['batch_num']
+
+        self.assertTrue(functions.process_queued_batch())
+        self.assertFalse(functions.process_queued_batch())
+
+        response = self.client.get("/batch_status/%d" % batch_num,
+                                   data={'auth_token' : auth_token})
+        self.assertEqual(response.status_code, 200)
+
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['status'],          "done")
+        self.assertEqual(response['num_annotations'], 3)
+        self.assertEqual(response['num_processed'],   3)
+
+        self.assertEqual(Annotation.objects.filter(batch_id=batch_num).count(),
+                         3)
+        self.assertEqual(CurrentAnnotation.objects.count(), 3)
+
+
+    def test_add_in_background_keeps_newer_values(self):
+        """ Check that a queued batch doesn't overwrite newer values.
+        """
+        for value,in_background in [("old", True), ("new", False)]:
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : [
+                                          dict(account="r123", key="owner",
+                                               value=value)]},
+                                     in_background=in_background)
+            if not response['success']:
+                self.fail(response['error'])
+
+        self.assertTrue(functions.process_queued_batch())
+
+        response = functions.account("r123")
+        self.assertEqual(response['annotations'],
+                         [{'key' : "owner", 'value' : "new"}])
+        self.assertEqual(currentAnnotations.verify()['wrong'], 0)
+
+
+    def test_add_in_background_invalid_data(self):
+        """ Check that a queued batch with invalid data is marked as failed.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="owner",
+                                           value="erik")]},
+                                 in_background=True)
+        if not response['success']:
+            self.fail(response['error'])
+
+        QueuedBatch.objects.update(data="{not json")
+
+        self.assertTrue(functions.process_queued_batch())
+        self.assertEqual(QueuedBatch.objects.get().status, "failed")
+
+
+    def _queue_batch(self, num_annotations=3):
+        """ Queue a batch of annotations, returning its QueuedBatch.
+        """
+        annotations = []
+        for i in range(num_annotations):
+            annotations.append(dict(account="r%d" % i, key="owner",
+                                    value="erik"))
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : annotations},
+                                 in_background=True)
+        if not response['success']:
+            self.fail(response['error'])
+
+        return QueuedBatch.objects.get(batch_id=response['batch_num'])
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2, QUEUE_LEASE_TIMEOUT=600)
+    def test_add_in_background_reclaims_abandoned_batch(self):
+        """ Check that a batch abandoned by a dead worker is taken over.
+        """
+        queuedBatch = self._queue_batch()
+
+        # Pretend that a worker claimed the batch, stored the first chunk and
+        # then died.
+
+        long_ago = timezone.now() - datetime.timedelta(seconds=601)
+        QueuedBatch.objects.filter(id=queuedBatch.id).update(
+                                                status="processing",
+                                                claimed_by="dead worker",
+                                                heartbeat_at=long_ago,
+                                                num_processed=2,
+                                                attempts=1)
+
+        self.assertTrue(functions.process_queued_batch())
+
+        queuedBatch = QueuedBatch.objects.get(id=queuedBatch.id)
+        self.assertEqual(queuedBatch.status,        "done")
+        self.assertEqual(queuedBatch.num_processed, 3)
+        self.assertEqual(queuedBatch.attempts,      2)
+        self.assertEqual(Annotation.objects.count(), 1) # Resumed at entry 2.
+
+
+    @override_settings(QUEUE_LEASE_TIMEOUT=600)
+    def test_add_in_background_respects_live_claim(self):
+        """ Check that a batch being processed isn't taken over or requeued.
+        """
+        queuedBatch = self._queue_batch()
+
+        QueuedBatch.objects.filter(id=queuedBatch.id).update(
+                                                status="processing",
+                                                claimed_by="live worker",
+                                                heartbeat_at=timezone.now())
+
+        self.assertFalse(functions.process_queued_batch())
+        self.assertEqual(functions.requeue_abandoned_batches(), 0)
+
+        long_ago = timezone.now() - datetime.timedelta(seconds=601)
+        QueuedBatch.objects.filter(id=queuedBatch.id).update(
+                                                heartbeat_at=long_ago)
+
+        self.assertEqual(functions.requeue_abandoned_batches(), 1)
+        self.assertEqual(QueuedBatch.objects.get(id=queuedBatch.id).status,
+                         "pending")
+
+
+    @override_settings(ADD_STREAM_CHUNK_SIZE=2, QUEUE_MAX_ATTEMPTS=2)
+    def test_add_in_background_retries_failed_chunk(self):
+        """ Check that a chunk which fails to store is retried, not hidden.
+        """
+        queuedBatch = self._queue_batch()
+
+        num_calls          = [0]
+        orig_add_annotations = helpers.add_annotations
+
+        def failing_add_annotations(batch, annotations):
+            num_calls[0] = num_calls[0] + 1
+            if num_calls[0] > 1:
+                raise RuntimeError("Simulated failure")
+            return orig_add_annotations(batch, annotations)
+
+        helpers.add_annotations = failing_add_annotations
+        try:
+            self.assertTrue(functions.process_queued_batch())
+            queuedBatch = QueuedBatch.objects.get(id=queuedBatch.id)
+            self.assertEqual(queuedBatch.status,        "pending")
+            self.assertEqual(queuedBatch.num_processed, 2)
+
+            self.assertTrue(functions.process_queued_batch())
+            queuedBatch = QueuedBatch.objects.get(id=queuedBatch.id)
+            self.assertEqual(queuedBatch.status,        "failed")
+            self.assertEqual(queuedBatch.num_processed, 2)
+        finally:
+            helpers.add_annotations = orig_add_annotations
+
+        # The first chunk is kept rather than being hidden.
+
+        self.assertEqual(Annotation.objects.count(), 2)
+        self.assertEqual(Annotation.objects.filter(hidden=True).count(), 0)
+        self.assertFalse(functions.process_queued_batch())
+
+
+    def test_add_in_background_validates_batch(self):
+        """ Check that an invalid batch is rejected before being queued.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [dict(account="r123", key="owner")]}
+
+        response = functions.add(batch, in_background=True)
+        self.assertFalse(response['success'])
+        self.assertEqual(QueuedBatch.objects.count(), 0)
+
 #############################################################################
 
-class HideTestCase(django.test.TestCase):
+class HideTestCase(APITestCase):
     """ Unit tests for the "/hide" API endpoint.
     """
     def test_hide(self):
@@ -279,9 +862,43 @@ class HideTestCase(django.test.TestCase):
 
         self.assertEqual(annotation.value.value, "101")
 
+
+    def test_hide_query_count(self):
+        """ Check that the number of queries made by "/hide" is constant.
+        """
+        def _count_queries(num_accounts, prefix):
+            old_annotations = []
+            new_annotations = []
+            for i in range(num_accounts):
+                old_annotations.append(dict(account="%s%d" % (prefix, i),
+                                            key="owner", value="old"))
+                new_annotations.append(dict(account="%s%d" % (prefix, i),
+                                            key="owner", value="new"))
+
+            functions.add({'user_id' : "erik", 'annotations' : old_annotations})
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : new_annotations})
+            if not response['success']:
+                self.fail(response['error'])
+
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.hide("erik", response['batch_num'])
+            if not response['success']:
+                self.fail(response['error'])
+
+            for i in range(num_accounts):
+                annotation = CurrentAnnotation.objects.get(
+                                        account__address="%s%d" % (prefix, i),
+                                        key__key="owner")
+                self.assertEqual(annotation.value.value, "old")
+
+            return len(queries)
+
+        self.assertEqual(_count_queries(3, "ra"), _count_queries(30, "rb"))
+
 #############################################################################
 
-class ListTestCase(django.test.TestCase):
+class ListTestCase(APITestCase):
     """ Unit tests for the "/list" endpoint.
     """
     def test_list(self):
@@ -323,9 +940,43 @@ class ListTestCase(django.test.TestCase):
 
         self.assertTrue(found)
 
+
+    def test_list_with_cursor(self):
+        """ Test the "/list" endpoint using cursor pagination.
+        """
+        batch_nums = []
+        for i in range(3):
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : [
+                                          dict(account="r123", key="owner",
+                                               value="erik")]})
+            if not response['success']:
+                self.fail(response['error'])
+            batch_nums.append(response['batch_num'])
+
+        response = functions.list_batches(rpp=2, cursor="")
+        self.assertEqual([batch['batch_number']
+                          for batch in response['batches']],
+                         [batch_nums[2], batch_nums[1]])
+
+        response = functions.list_batches(rpp=2,
+                                          cursor=response['next_cursor'])
+        self.assertEqual([batch['batch_number']
+                          for batch in response['batches']],
+                         [batch_nums[0]])
+        self.assertEqual(response['next_cursor'], None)
+
+        # A cursor holding the wrong type of value should be rejected rather
+        # than making the query fail.
+
+        for value in [[1], "abc", True, None]:
+            response = functions.list_batches(
+                                    rpp=2, cursor=helpers.encode_cursor(value))
+            self.assertFalse(response['success'])
+
 #############################################################################
 
-class GetTestCase(django.test.TestCase):
+class GetTestCase(APITestCase):
     """ Unit tests for the "/get" endpoint.
     """
     def test_get(self):
@@ -362,9 +1013,133 @@ class GetTestCase(django.test.TestCase):
         self.assertEqual(response['user_id'], "erik")
         self.assertEqual(len(response['annotations']), 2)
 
+    def test_get_query_count(self):
+        """ Check that the number of queries made by "/get" is constant.
+        """
+        def _count_queries(num_accounts, prefix):
+            batch_num = self._add_batches(1, ["%s%d" % (prefix, i)
+                                              for i in range(num_accounts)])
+
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.get(batch_num)
+            if not response['success']:
+                self.fail(response['error'])
+            self.assertEqual(len(response['annotations']), num_accounts * 2)
+
+            return len(queries)
+
+        self.assertEqual(_count_queries(2, "ra"), _count_queries(20, "rb"))
+
 #############################################################################
 
-class AccountsTestCase(django.test.TestCase):
+class ChangesTestCase(APITestCase):
+    """ Unit tests for the "/changes" endpoint.
+    """
+    def test_changes(self):
+        """ Test the "/changes" endpoint.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        batch_num = self._add_batches(2, ["r123"])
+
+        response = self.client.get("/changes",
+                                   data={'auth_token' : auth_token,
+                                         'rpp'        : 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json")
+
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertItemsEqual([(change['account'], change['key'],
+                                change['value'])
+                               for change in response['changes']],
+                              [("r123", "name",   "name 0"),
+                               ("r123", "status", "status 0")])
+        self.assertTrue(response['has_more'])
+
+        response = functions.changes(response['next_cursor'], rpp=2)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertItemsEqual([(change['account'], change['key'],
+                                change['value'])
+                               for change in response['changes']],
+                              [("r123", "name",   "name 1"),
+                               ("r123", "status", "status 1")])
+        self.assertFalse(response['has_more'])
+
+        # Uploading the same values again doesn't change anything, while
+        # hiding an annotation does.
+
+        cursor = response['next_cursor']
+        functions.add({'user_id'     : "erik",
+                       'annotations' : [dict(account="r123", key="name",
+                                             value="name 1")]})
+
+        response = functions.changes(cursor)
+        self.assertEqual(response['changes'], [])
+        self.assertEqual(response['next_cursor'], cursor)
+
+        functions.hide("erik", batch_num, account="r123",
+                       annotation="status")
+
+        response = functions.changes(cursor)
+        self.assertEqual([(change['account'], change['key'], change['value'])
+                          for change in response['changes']],
+                         [("r123", "status", "status 0")])
+
+        response = functions.changes("not a cursor")
+        self.assertFalse(response['success'])
+
+        response = self.client.get("/changes",
+                                   data={'auth_token' : auth_token,
+                                         'since'      :
+                                            helpers.encode_cursor([1])})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(json.loads(response.content)['success'])
+
+        # Within a recording_changes() block, the changes are only written at
+        # the end of the block, and are thrown away if the block fails.
+
+        key_id     = interning.get_key_id("status")
+        account_id = interning.get_account_id("r123")
+        num_changes = AnnotationChange.objects.count()
+
+        with helpers.recording_changes():
+            helpers.set_current_annotations({
+                (account_id, key_id) : interning.get_value_id("x", True)})
+            self.assertEqual(AnnotationChange.objects.count(), num_changes)
+        self.assertEqual(AnnotationChange.objects.count(), num_changes + 1)
+
+        try:
+            with transaction.atomic(), helpers.recording_changes():
+                helpers.set_current_annotations({
+                    (account_id, key_id) : interning.get_value_id("y", True)})
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(AnnotationChange.objects.count(), num_changes + 1)
+
+        helpers.set_current_annotations({
+                (account_id, key_id) : interning.get_value_id("z", True)})
+        self.assertEqual(AnnotationChange.objects.count(), num_changes + 2)
+
+        # The number of changes which can be requested at once is limited.
+
+        with override_settings(CHANGES_MAX_RPP=1):
+            response = functions.changes(cursor, rpp=2)
+            self.assertFalse(response['success'])
+
+            response = functions.changes(cursor, rpp=1)
+            if not response['success']:
+                self.fail(response['error'])
+            self.assertEqual(len(response['changes']), 1)
+
+#############################################################################
+
+class AccountsTestCase(APITestCase):
     """ Unit tests for the "/accounts" endpoint.
     """
     def test_accounts(self):
@@ -401,9 +1176,110 @@ class AccountsTestCase(django.test.TestCase):
         self.assertTrue("r123" in response['accounts'])
         self.assertTrue("r124" in response['accounts'])
 
+
+    def test_accounts_with_cursor(self):
+        """ Test the "/accounts" endpoint using cursor pagination.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        annotations = []
+        for i in range(5):
+            annotations.append(dict(account="r%d" % i, key="owner",
+                                    value="erik"))
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : annotations})
+        if not response['success']:
+            self.fail(response['error'])
+
+        accounts = []
+        cursor   = ""
+        while True:
+            response = self.client.get("/accounts",
+                                       data={'auth_token' : auth_token,
+                                             'rpp'        : 2,
+                                             'cursor'     : cursor})
+            response = json.loads(response.content)
+            if not response['success']:
+                self.fail(response['error'])
+
+            self.assertItemsEqual(response.keys(),
+                                  ['success', 'accounts', 'next_cursor'])
+            accounts.extend(response['accounts'])
+
+            cursor = response['next_cursor']
+            if cursor == None:
+                break
+
+        self.assertEqual(accounts, ["r0", "r1", "r2", "r3", "r4"])
+
+        response = self.client.get("/accounts",
+                                   data={'auth_token'     : auth_token,
+                                         'rpp'            : 2,
+                                         'cursor'         : "",
+                                         'include_totals' : "1"})
+        response = json.loads(response.content)
+        self.assertEqual(response['num_pages'], 3)
+
+        response = functions.list_accounts(cursor="not a cursor")
+        self.assertFalse(response['success'])
+
+        response = functions.list_accounts(cursor=helpers.encode_cursor(123))
+        self.assertFalse(response['success'])
+
 #############################################################################
 
-class AccountTestCase(django.test.TestCase):
+class AccountsBulkTestCase(APITestCase):
+    """ Unit tests for the "/accounts/bulk" endpoint.
+    """
+    def test_accounts_bulk(self):
+        """ Test the "/accounts/bulk" endpoint.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        self._add_batches(1, ["r123", "r124"])
+
+        response = self.client.post("/accounts/bulk",
+                                    data=json.dumps({
+                                        'auth_token' : auth_token,
+                                        'accounts'   : ["r123", "r124",
+                                                        "r999"]}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json")
+
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['accounts'],
+                         {'r123' : [{'key' : "name",   'value' : "name 0"},
+                                    {'key' : "status", 'value' : "status 0"}],
+                          'r124' : [{'key' : "name",   'value' : "name 0"},
+                                    {'key' : "status", 'value' : "status 0"}],
+                          'r999' : []})
+
+        # Check that the annotations can be limited to the given keys, using
+        # a single query.
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.accounts_bulk(["r123", "r124"],
+                                               keys=["STATUS"])
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['accounts'],
+                         {'r123' : [{'key' : "status", 'value' : "status 0"}],
+                          'r124' : [{'key' : "status", 'value' : "status 0"}]})
+        self.assertEqual(len(queries), 1)
+
+        with override_settings(ACCOUNTS_BULK_MAX_ADDRESSES=1):
+            response = functions.accounts_bulk(["r123", "r124"])
+        self.assertFalse(response['success'])
+
+#############################################################################
+
+class AccountTestCase(APITestCase):
     """ Unit tests for the "/account" endpoint.
     """
     def test_account(self):
@@ -442,9 +1318,24 @@ class AccountTestCase(django.test.TestCase):
 
         self.assertTrue(found)
 
+    def test_account_query_count(self):
+        """ Check that the number of queries made by "/account" is constant.
+        """
+        self._add_batches(1, ["r123"])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.account("r123")
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['annotations'],
+                         [{'key' : "name",   'value' : "name 0"},
+                          {'key' : "status", 'value' : "status 0"}])
+        self.assertEqual(len(queries), 2)
+
 #############################################################################
 
-class AccountHistoryTestCase(django.test.TestCase):
+class AccountHistoryTestCase(APITestCase):
     """ Unit tests for the "/account_history" endpoint.
     """
     def test_account_history(self):
@@ -493,9 +1384,67 @@ class AccountHistoryTestCase(django.test.TestCase):
 
         self.assertTrue(found)
 
+    def test_account_history_query_count(self):
+        """ Check that "/account_history" makes a constant number of queries.
+        """
+        def _count_queries(num_batches, address):
+            self._add_batches(num_batches, [address])
+
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.account_history(address)
+            if not response['success']:
+                self.fail(response['error'])
+
+            history = {}
+            for entry in response['annotations']:
+                history[entry['key']] = entry['history']
+            self.assertEqual(len(history['name']), num_batches)
+            self.assertEqual(history['name'][0]['value'],
+                             "name %d" % (num_batches - 1))
+
+            return len(queries)
+
+        self.assertEqual(_count_queries(2, "ra"), _count_queries(20, "rb"))
+
 #############################################################################
 
-class SearchTestCase(django.test.TestCase):
+class ParseTestCase(APITestCase):
+    """ Unit tests for parsing search queries.
+    """
+    def test_parse(self):
+        """ Check that search queries are parsed correctly.
+        """
+        expression = logicalExpressions.parse(
+                        "(name = 'erik') and not (age < '20' or age > '40')")
+        self.assertEqual(expression.to_string(),
+                         "(name = 'erik') and (not ((age < '20') or " +
+                         "(age > '40')))")
+        self.assertItemsEqual(expression.get_variables(),
+                              ["name", "age", "age"])
+
+        self.assertEqual(logicalExpressions.parse("name = "), None)
+
+        expression = logicalExpressions.parse("(name ~ 'er*') or " +
+                                              "(name % 'eric')")
+        self.assertEqual(expression.to_string(),
+                         "(name ~ 'er*') or (name % 'eric')")
+
+        self.assertEqual(logicalExpressions.wildcard_to_like("a_b*c?%"),
+                         "a\\_b%c_\\%")
+
+
+    def test_parse_is_cached(self):
+        """ Check that parsing the same query twice uses the cache.
+        """
+        expression = logicalExpressions.parse("name = 'erik'")
+        self.assertTrue(logicalExpressions.parse("name = 'erik'") is expression)
+
+        self.assertEqual(logicalExpressions.parse("name ="), None)
+        self.assertEqual(logicalExpressions.parse("name ="), None)
+
+#############################################################################
+
+class SearchTestCase(APITestCase):
     """ Unit tests for the "/search" endpoint.
     """
     def test_search(self):
@@ -556,9 +1505,662 @@ class SearchTestCase(django.test.TestCase):
                               ['success', 'num_matches'])
         self.assertEqual(response['num_matches'], 2)
 
+
+    def test_search_multiple_keys(self):
+        """ Check that search terms are matched against separate annotations.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner",  value="erik"),
+                     dict(account="r123", key="status", value="active"),
+                     dict(account="r124", key="owner",  value="erik"),
+                     dict(account="r124", key="status", value="closed"),
+                     dict(account="r125", key="owner",  value="john"),
+                     dict(account="r125", key="age",    value="30"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        def _search(query):
+            response = functions.search(query)
+            if not response['success']:
+                self.fail(response['error'])
+            return response['accounts']
+
+        self.assertEqual(_search("(owner='erik') and (status='active')"),
+                         ["r123"])
+        self.assertEqual(_search("(owner='john') or (status='closed')"),
+                         ["r124", "r125"])
+        self.assertEqual(_search("not (owner='erik')"), ["r125"])
+        self.assertEqual(_search("(owner='erik') and not (status='active')"),
+                         ["r124"])
+        self.assertEqual(_search("status != 'active'"), ["r124"])
+        self.assertEqual(_search("age > '25'"), ["r125"])
+        self.assertEqual(_search("owner = 'nobody'"), [])
+        self.assertEqual(_search("unknown = 'x'"), [])
+
+
+    def test_search_with_cursor(self):
+        """ Test the "/search" endpoint using cursor pagination.
+        """
+        annotations = []
+        for i in range(5):
+            annotations.append(dict(account="r%d" % i, key="owner",
+                                    value="erik" if i != 2 else "john"))
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : annotations})
+        if not response['success']:
+            self.fail(response['error'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.search("owner='erik'", rpp=3, cursor="")
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['accounts'], ["r0", "r1", "r3"])
+        for query in queries:
+            self.assertFalse("COUNT(" in query['sql'])
+
+        response = functions.search("owner='erik'", rpp=3,
+                                    cursor=response['next_cursor'],
+                                    include_totals=True)
+        self.assertEqual(response['accounts'],    ["r4"])
+        self.assertEqual(response['next_cursor'], None)
+        self.assertEqual(response['num_matches'], 4)
+
+
+    def test_search_typed_values(self):
+        """ Check that numbers and dates are compared as numbers and dates.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="balance", value="9"),
+                     dict(account="r124", key="balance", value="10.5"),
+                     dict(account="r125", key="balance", value="abc"),
+                     dict(account="r123", key="joined",  value="2014-01-15"),
+                     dict(account="r124", key="joined",
+                          value="2014-03-01T10:00:00Z"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        value = AnnotationValue.objects.get(value="10.5")
+        self.assertEqual(value.numeric_value, 10.5)
+        self.assertEqual(value.date_value,    None)
+
+        def _search(query):
+            response = functions.search(query)
+            if not response['success']:
+                self.fail(response['error'])
+            return response['accounts']
+
+        self.assertEqual(_search("balance > '9'"),      ["r124"])
+        self.assertEqual(_search("balance >= '9'"),     ["r123", "r124"])
+        self.assertEqual(_search("balance < '1e2'"),    ["r123", "r124"])
+        self.assertEqual(_search("balance > 'aaa'"),    ["r125"])
+        self.assertEqual(_search("joined < '2014-02-01'"), ["r123"])
+        self.assertEqual(_search("joined >= '2014-02-01 00:00'"), ["r124"])
+
+
+    def test_search_large_numbers(self):
+        """ Check that large numbers are compared without losing precision.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="balance",
+                          value="9007199254740992"),
+                     dict(account="r124", key="balance",
+                          value="9007199254740993"),
+                     dict(account="r125", key="balance", value="1e400"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        value = AnnotationValue(value="9007199254740993")
+        value.update_derived_fields()
+        self.assertEqual(value.numeric_value,
+                         decimal.Decimal("9007199254740993"))
+
+        # Numbers too large to store are treated as strings.
+
+        value = AnnotationValue.objects.get(value="1e400")
+        self.assertEqual(value.numeric_value, None)
+
+        # Note that SQLite stores decimal values as floating-point numbers, so
+        # we can only check the comparison against a real database.
+
+        if connection.vendor != "sqlite":
+            response = functions.search("balance > '9007199254740992'")
+            if not response['success']:
+                self.fail(response['error'])
+            self.assertEqual(response['accounts'], ["r124"])
+
+
+    @override_settings(SEARCH_BITMAP_KEYS="owner,status")
+    def test_search_bitmap_index(self):
+        """ Check that searches can be answered using the bitmap index.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner",  value="erik"),
+                     dict(account="r123", key="status", value="active"),
+                     dict(account="r124", key="owner",  value="erik"),
+                     dict(account="r124", key="status", value="closed"),
+                     dict(account="r125", key="owner",  value="john"),
+                     dict(account="r125", key="age",    value="30"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        bitmapIndex.load()
+
+        def _search(query, totals_only=False):
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.search(query, totals_only=totals_only)
+            if not response['success']:
+                self.fail(response['error'])
+            return response, len(queries)
+
+        response,num_queries = _search("(owner='erik') and (status='active')",
+                                       totals_only=True)
+        self.assertEqual(response['num_matches'], 1)
+        self.assertEqual(num_queries, 0)
+
+        response,num_queries = _search("not (owner='erik') or " +
+                                       "(status != 'active')")
+        self.assertEqual(response['accounts'], ["r124", "r125"])
+
+        # Changing an annotation should be picked up by the index straight
+        # away.
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r124", key="status",
+                                           value="active")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        response,num_queries = _search("status = 'active'")
+        self.assertEqual(response['accounts'], ["r123", "r124"])
+
+        # Queries which the index can't answer should fall back to the
+        # database.
+
+        response,num_queries = _search("age > '25'")
+        self.assertEqual(response['accounts'], ["r125"])
+
+
+    @override_settings(SEARCH_BITMAP_KEYS="owner,status")
+    def test_bitmap_index_matches_database_after_hide(self):
+        """ Check that the bitmap index agrees with the database after a hide.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="owner",
+                                           value="erik"),
+                                      dict(account="r124", key="owner",
+                                           value="john"),
+                                      dict(account="r125", key="status",
+                                           value="active")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        bitmapIndex.load()
+
+        functions.hide("erik", response['batch_num'], account="r124")
+
+        for query in ["owner != 'erik'",
+                      "owner != ''",
+                      "owner = ''",
+                      "not (owner = 'erik')",
+                      "not (status = 'active')",
+                      "not (owner = 'erik') and not (status = 'active')"]:
+            database = functions.search(query, debug=True)
+            if not database['success']:
+                self.fail(database['error'])
+
+            index = bitmapIndex.search(logicalExpressions.parse(query))
+            self.assertNotEqual(index, None)
+            self.assertEqual(index['accounts'], database['accounts'], query)
+
+
+    @override_settings(SEARCH_BITMAP_KEYS="owner", SEARCH_BITMAP_MAX_ENTRIES=3)
+    def test_bitmap_index_too_large(self):
+        """ Check that an index which gets too large falls back to the database.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="owner",
+                                           value="erik")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        index = bitmapIndex.BitmapIndex(["owner"])
+        index.load()
+        self.assertNotEqual(index.evaluate(logicalExpressions.parse(
+                                                        "owner = 'erik'")),
+                            None)
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r124", key="owner",
+                                           value="erik")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        index.refresh()
+        self.assertRaises(bitmapIndex._Unsupported, index.evaluate,
+                          logicalExpressions.parse("owner = 'erik'"))
+
+
+    def test_bitmap_index_refresh(self):
+        """ Check that the bitmap index follows the AnnotationChange records.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="status",
+                                           value="active")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        index = bitmapIndex.BitmapIndex(["status"])
+        index.load()
+        self.assertTrue(index.is_up_to_date())
+        self.assertFalse(index.is_stale())
+
+        # A change is picked up from the AnnotationChange records, regardless
+        # of the ID of the CurrentAnnotation record which holds it.
+
+        account_id = interning.get_account_id("r123")
+        key_id     = interning.get_key_id("status")
+        value_id   = interning.get_value_id("closed", create=True)
+
+        CurrentAnnotation.objects.filter(account_id=account_id,
+                                         key_id=key_id) \
+                                 .update(value=value_id)
+        AnnotationChange.objects.create(account_id=account_id,
+                                        key_id=key_id,
+                                        value_id=value_id,
+                                        changed_at=timezone.now())
+
+        self.assertFalse(index.is_up_to_date())
+        index.refresh()
+        self.assertTrue(index.is_up_to_date())
+        self.assertEqual(index._convert("status", "=", "closed"),
+                         set([account_id]))
+
+        # Rebuilding the CurrentAnnotation table means the index has to be
+        # loaded again from scratch.
+
+        currentAnnotations.rebuild()
+        self.assertTrue(index.is_stale())
+
+
+    @override_settings(SEARCH_CACHE_TIMEOUT=60)
+    def test_search_cache(self):
+        """ Check that search results are cached and invalidated correctly.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner",  value="erik"),
+                     dict(account="r123", key="status", value="active"),
+                     dict(account="r124", key="owner",  value="john"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        def _search(query):
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.search(query)
+            if not response['success']:
+                self.fail(response['error'])
+            return response['accounts'], len(queries)
+
+        def _add(account, key, value):
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : [
+                                          dict(account=account, key=key,
+                                               value=value)]})
+            if not response['success']:
+                self.fail(response['error'])
+
+        self.assertEqual(_search("owner = 'erik'")[0], ["r123"])
+        self.assertEqual(_search("owner = 'erik'"), (["r123"], 0))
+        self.assertEqual(_search("not (owner = 'erik')")[0], ["r124"])
+
+        # Changing an existing value for another key shouldn't invalidate
+        # either search.
+
+        _add("r123", "status", "closed")
+
+        self.assertEqual(_search("owner = 'erik'"), (["r123"], 0))
+        self.assertEqual(_search("not (owner = 'erik')"), (["r124"], 0))
+
+        # Adding a new account should only invalidate the negated search.
+
+        _add("r125", "status", "active")
+
+        self.assertEqual(_search("owner = 'erik'"), (["r123"], 0))
+        self.assertEqual(_search("not (owner = 'erik')")[0], ["r124", "r125"])
+
+        # Changing the searched-for key should invalidate the search, whether
+        # it was changed by adding or hiding an annotation.
+
+        _add("r124", "owner", "erik")
+
+        self.assertEqual(_search("owner = 'erik'")[0], ["r123", "r124"])
+
+        batch_num = AnnotationBatch.objects.order_by("-id")[0].id
+        functions.hide("erik", batch_num)
+
+        self.assertEqual(_search("owner = 'erik'")[0], ["r123"])
+
+        # Two different queries which would look the same if the quotes in
+        # their values weren't escaped must be cached separately.
+
+        self.assertEqual(_search("owner = \"x') or (owner = 'erik\"" +
+                                 " or owner = 'john'")[0], ["r124"])
+        self.assertEqual(_search("owner = 'x' or " +
+                                 "owner = \"erik') or (owner = 'john\"")[0],
+                         [])
+
+        # Searches as of a given moment are never cached.
+
+        as_of = timezone.now()
+        for i in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                response = functions.search("owner = 'erik'", as_of=as_of)
+            self.assertEqual(response['accounts'], ["r123"])
+            self.assertNotEqual(len(queries), 0)
+
+
+    def test_search_wildcards(self):
+        """ Check that wildcard and fuzzy searches work.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="name", value="Bitstamp"),
+                     dict(account="r124", key="name", value="bitstamp_2"),
+                     dict(account="r125", key="name", value="SnapSwap"),
+                     dict(account="r126", key="name", value="bit100"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        def _search(query):
+            response = functions.search(query)
+            if not response['success']:
+                self.fail(response['error'])
+            return response['accounts']
+
+        self.assertEqual(_search("name ~ 'bitst*'"), ["r123", "r124"])
+        self.assertEqual(_search("name ~ 'BIT*'"), ["r123", "r124", "r126"])
+        self.assertEqual(_search("name ~ 'bitstamp?2'"), ["r124"])
+        self.assertEqual(_search("name ~ 'bitstamp_*'"), ["r124"])
+        self.assertEqual(_search("name ~ 'bit'"), [])
+        self.assertEqual(_search("name % 'swap'"), ["r125"])
+
+    def test_search_debug(self):
+        """ Check that authenticated clients can see the search query plan.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="owner",
+                                           value="erik")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        response = self.client.get("/search",
+                                   data={'auth_token' : auth_token,
+                                         'query'      : 'owner="erik"',
+                                         'debug'      : "1"})
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['accounts'], ["r123"])
+        self.assertTrue("plan" in response)
+        self.assertTrue("cost" in response)
+
+        # The query plan shouldn't be shown to unauthenticated clients.
+
+        response = functions.search('owner="erik"', public_only=False)
+        self.assertFalse("plan" in response)
+
+        response = self.client.get("/search",
+                                   data={'query' : 'owner="erik"',
+                                         'debug' : "1"})
+        response = json.loads(response.content)
+        self.assertFalse("plan" in response)
+
+
+    def test_export_search(self):
+        """ Check that search results can be exported with a single query.
+        """
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner",  value="erik"),
+                     dict(account="r123", key="status", value="active"),
+                     dict(account="r124", key="owner",  value="erik"),
+                     dict(account="r125", key="owner",  value="john"),
+                     dict(account="r125", key="status", value="active"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.export_search("(owner = 'erik') or " +
+                                               "(status = 'active')")
+            if not response['success']:
+                self.fail(response['error'])
+            rows = list(response['rows'])
+
+        self.assertEqual(response['keys'], ["owner", "status"])
+        self.assertEqual(rows, [["r123", "erik", "active"],
+                                ["r124", "erik", ""],
+                                ["r125", "john", "active"]])
+        self.assertEqual(len([query for query in queries
+                              if "SAVEPOINT" not in query['sql']]), 1)
+
+        response = functions.export_search("owner = ")
+        self.assertFalse(response['success'])
+
+#############################################################################
+
+class FacetsTestCase(APITestCase):
+    """ Unit tests for the "/facets" endpoint.
+    """
+    def test_facets(self):
+        """ Test the "/facets" endpoint.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        batch = {'user_id'     : "erik",
+                 'annotations' : [
+                     dict(account="r123", key="owner",  value="erik"),
+                     dict(account="r123", key="status", value="active"),
+                     dict(account="r124", key="owner",  value="erik"),
+                     dict(account="r124", key="status", value="closed"),
+                     dict(account="r125", key="owner",  value="john"),
+                     dict(account="r125", key="status", value="active"),
+                 ]
+                }
+
+        response = functions.add(batch)
+        if not response['success']:
+            self.fail(response['error'])
+
+        response = self.client.get("/facets",
+                                   data={'auth_token' : auth_token,
+                                         'keys'       : "owner,status,age"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json")
+
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['facets'],
+                         {'owner'  : {'erik' : 2, 'john' : 1},
+                          'status' : {'active' : 2, 'closed' : 1},
+                          'age'    : {}})
+
+        # Check that the counts can be limited to the accounts matching a
+        # search query, using a single query.
+
+        with CaptureQueriesContext(connection) as queries:
+            response = functions.facets(["owner"], query="status='active'")
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['facets'],
+                         {'owner' : {'erik' : 1, 'john' : 1}})
+        self.assertEqual(len(queries), 1)
+
+        response = functions.facets(["owner"], query="status=")
+        self.assertFalse(response['success'])
+
 #############################################################################
 
-class SetTemplateTestCase(django.test.TestCase):
+class AsOfTestCase(APITestCase):
+    """ Unit tests for retrieving the annotation values as of a given moment.
+    """
+    def test_as_of(self):
+        """ Test the "as_of" parameter, with and without a snapshot.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+
+        batch_2 = self._add_batches(2, ["r123", "r124"])
+        batch_1 = batch_2 - 1
+
+        functions.hide("erik", batch_2, account="r123")
+
+        as_of_1 = annotationSnapshots.parse_as_of("batch:%d" % batch_1)
+        as_of_2 = annotationSnapshots.parse_as_of("batch:%d" % batch_2)
+
+        self.assertEqual(as_of_1,
+                         AnnotationBatch.objects.get(id=batch_1).timestamp)
+        self.assertEqual(annotationSnapshots.parse_as_of("batch:0"), None)
+        self.assertEqual(annotationSnapshots.parse_as_of("yesterday"), None)
+
+        for use_snapshot in [False, True]:
+            if use_snapshot:
+                annotationSnapshots.take_snapshot(as_of_1)
+
+            # The hidden annotation was still visible as of the second batch.
+
+            response = functions.account("r123", as_of=as_of_1)
+            self.assertEqual(response['annotations'],
+                             [{'key' : "name",   'value' : "name 0"},
+                              {'key' : "status", 'value' : "status 0"}])
+
+            response = functions.account("r123", as_of=as_of_2)
+            self.assertEqual(response['annotations'],
+                             [{'key' : "name",   'value' : "name 1"},
+                              {'key' : "status", 'value' : "status 1"}])
+
+            response = functions.account("r123")
+            self.assertEqual(response['annotations'],
+                             [{'key' : "name",   'value' : "name 0"},
+                              {'key' : "status", 'value' : "status 0"}])
+
+            response = functions.accounts_bulk(["r124", "r999"],
+                                               keys=["status"], as_of=as_of_1)
+            self.assertEqual(response['accounts'],
+                             {'r124' : [{'key' : "status",
+                                         'value' : "status 0"}],
+                              'r999' : []})
+
+            response = functions.search("status = 'status 0'", as_of=as_of_1)
+            self.assertEqual(response['accounts'], ["r123", "r124"])
+
+            response = functions.search("not (status = 'status 0')",
+                                        as_of=as_of_2)
+            self.assertEqual(response['accounts'], ["r123", "r124"])
+
+            response = functions.search("status = 'status 0'")
+            self.assertEqual(response['accounts'], ["r123"])
+
+        response = self.client.get("/account/r124",
+                                   data={'auth_token' : auth_token,
+                                         'as_of'      : "batch:%d" % batch_1})
+        response = json.loads(response.content)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self.assertEqual(response['annotations'],
+                         [{'key' : "name",   'value' : "name 0"},
+                          {'key' : "status", 'value' : "status 0"}])
+
+        response = self.client.get("/search",
+                                   data={'auth_token' : auth_token,
+                                         'query'      : "name = 'name 0'",
+                                         'as_of'      : "tomorrow"})
+        response = json.loads(response.content)
+        self.assertFalse(response['success'])
+
+
+    def test_as_of_queued_after_snapshot(self):
+        """ Check that annotations added after a snapshot aren't missed.
+
+            A queued batch gets its timestamp when it is queued, so its
+            annotations can be added after a snapshot taken later than that
+            timestamp.
+        """
+        self._add_batches(1, ["r123"])
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="status",
+                                           value="queued")]},
+                                 in_background=True)
+        if not response['success']:
+            self.fail(response['error'])
+
+        as_of    = timezone.now()
+        snapshot = annotationSnapshots.take_snapshot(as_of)
+        self.assertTrue(functions.process_queued_batch())
+
+        self.assertTrue(AnnotationBatch.objects.get(
+                            id=response['batch_num']).timestamp <= as_of)
+        self.assertTrue(Annotation.objects.filter(
+                            id__gt=snapshot.last_annotation_id).exists())
+
+        response = functions.account("r123", as_of=as_of)
+        self.assertEqual(response['annotations'],
+                         [{'key' : "name",   'value' : "name 0"},
+                          {'key' : "status", 'value' : "queued"}])
+
+        response = functions.search("status = 'queued'", as_of=as_of)
+        self.assertEqual(response['accounts'], ["r123"])
+
+#############################################################################
+
+class SetTemplateTestCase(APITestCase):
     """ Unit tests for the "/set_template" endpoint.
     """
     def test_set_template_in_body(self):
@@ -641,7 +2243,7 @@ class SetTemplateTestCase(django.test.TestCase):
 
 #############################################################################
 
-class GetTemplateTestCase(django.test.TestCase):
+class GetTemplateTestCase(APITestCase):
     """ Unit tests for the "/get_template" endpoint.
     """
     def test_get_template(self):
@@ -688,3 +2290,259 @@ class GetTemplateTestCase(django.test.TestCase):
 
         self.assertItemsEqual(response.keys(), ['success', 'template'])
 
+
+#############################################################################
+
+class ConditionalGetTestCase(APITestCase):
+    """ Unit tests for the ETag support in the read-only endpoints.
+    """
+    def _check_etag(self, url, params, change):
+        """ Check that the given URL supports conditional GET requests.
+
+            We retrieve the URL, check that a repeated request with a matching
+            "If-None-Match" header returns a 304 response, and then call
+            'change' and check that the ETag has changed.
+        """
+        response = self.client.get(url, data=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['success'])
+        etag = response['ETag']
+
+        response = self.client.get(url, data=params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        change()
+
+        response = self.client.get(url, data=params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+    def test_etags(self):
+        """ Test the ETags returned by the read-only endpoints.
+        """
+        auth_token = helpers.get_auth_token_for_testing()
+        template   = [{'annotation' : "name",
+                       'label'      : "Name",
+                       'public'     : True,
+                       'type'       : "field"}]
+
+        batch_num = self._add_batches(1, ["r123"])
+        response = functions.set_template("public", template)
+        if not response['success']:
+            self.fail(response['error'])
+
+        self._check_etag("/account/r123", {'auth_token' : auth_token},
+                         lambda: self._add_batches(2, ["r123"]))
+
+        self._check_etag("/get/%d" % batch_num, {'auth_token' : auth_token},
+                         lambda: functions.hide("erik", batch_num))
+
+        self._check_etag("/get_template/public", {'auth_token' : auth_token},
+                         lambda: functions.set_template("public", template))
+
+        with override_settings(PUBLIC_TEMPLATE_NAME="public"):
+            self._check_etag("/public_annotations", {'annotation' : "name"},
+                             lambda: self._add_batches(1, ["r124"]))
+
+        # Rebuilding the CurrentAnnotation table doesn't record any
+        # AnnotationChanges, but may still change the current annotations.
+
+        def _corrupt_and_rebuild():
+            CurrentAnnotation.objects.filter(account__address="r123").update(
+                    value=interning.get_value_id("wrong", create=True))
+            currentAnnotations.rebuild()
+
+        self._check_etag("/account/r123", {'auth_token' : auth_token},
+                         _corrupt_and_rebuild)
+
+        with override_settings(PUBLIC_TEMPLATE_NAME="public"):
+            self._check_etag("/public_annotations", {'annotation' : "name"},
+                             currentAnnotations.rebuild)
+
+        # The annotations as of a given moment can change without changing
+        # the current annotations, so no ETag is returned for these.
+
+        response = self.client.get("/account/r123",
+                                   data={'auth_token' : auth_token,
+                                         'as_of'      : "batch:%d" % batch_num})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+
+        # Without a valid authentication token, no ETag is returned.
+
+        response = self.client.get("/account/r123")
+        self.assertFalse(response.has_header("ETag"))
+
+#############################################################################
+
+class CurrentAnnotationsTestCase(APITestCase):
+    """ Base class for the CurrentAnnotation management command unit tests.
+    """
+    def _setup_annotations(self):
+        """ Add some annotations, hide some of them, and scramble the table.
+
+            We return a dictionary mapping (address, key) tuples to the value
+            which should be in the rebuilt CurrentAnnotation table.
+        """
+        for value in ["one", "two", "three"]:
+            response = functions.add({'user_id'     : "erik",
+                                      'annotations' : [
+                                          dict(account="r123", key="name",
+                                               value=value),
+                                          dict(account="r124", key="name",
+                                               value=value),
+                                          dict(account="r125", key="owner",
+                                               value=value)]})
+            if not response['success']:
+                self.fail(response['error'])
+            batch_num = response['batch_num']
+
+        functions.hide("erik", batch_num, account="r123")
+        functions.hide("erik", batch_num, account="r125")
+        for batch in AnnotationBatch.objects.all():
+            functions.hide("erik", batch.id, account="r125")
+
+        CurrentAnnotation.objects.filter(account__address="r123").delete()
+        CurrentAnnotation.objects.filter(account__address="r124").update(
+                    value=AnnotationValue.objects.get(value="one"))
+
+        return {("r123", "name")  : "two",
+                ("r124", "name")  : "three",
+                ("r125", "owner") : ""}
+
+
+    def _get_current_annotations(self):
+        """ Return the contents of the CurrentAnnotation table.
+        """
+        annotations = {}
+        for address,key,value in CurrentAnnotation.objects.values_list(
+                                "account__address", "key__key", "value__value"):
+            annotations[(address, key)] = value
+        return annotations
+
+#############################################################################
+
+class RecalcCurrentAnnotationsTestCase(CurrentAnnotationsTestCase):
+    """ Unit tests for the "recalc_current_annotations" management command.
+    """
+    def test_recalc(self):
+        """ Test a single-statement rebuild of the CurrentAnnotation table.
+        """
+        expected = self._setup_annotations()
+
+        call_command("recalc_current_annotations", stdout=StringIO.StringIO())
+
+        self.assertEqual(self._get_current_annotations(), expected)
+
+
+    def test_recalc_in_chunks(self):
+        """ Test a chunked rebuild of the CurrentAnnotation table.
+        """
+        expected = self._setup_annotations()
+
+        call_command("recalc_current_annotations", chunked=True, chunk_size=1,
+                     stdout=StringIO.StringIO())
+
+        self.assertEqual(self._get_current_annotations(), expected)
+
+
+    def test_recalc_in_chunks_concurrently(self):
+        """ Check that two chunked rebuilds running at once don't collide.
+        """
+        expected = self._setup_annotations()
+
+        # Start a second rebuild while the first one is calculating its first
+        # chunk.
+
+        orig_rebuild_chunk = currentAnnotations._rebuild_chunk
+        started            = [False]
+
+        def rebuild_chunk(chunk):
+            if not started[0]:
+                started[0] = True
+                currentAnnotations.rebuild_in_chunks(chunk_size=1)
+            orig_rebuild_chunk(chunk)
+
+        currentAnnotations._rebuild_chunk = rebuild_chunk
+        try:
+            currentAnnotations.rebuild_in_chunks(chunk_size=1)
+        finally:
+            currentAnnotations._rebuild_chunk = orig_rebuild_chunk
+
+        self.assertTrue(started[0])
+        self.assertEqual(self._get_current_annotations(), expected)
+
+
+    def test_recalc_incremental(self):
+        """ Test an incremental update of the CurrentAnnotation table.
+        """
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="name",
+                                           value="one"),
+                                      dict(account="r124", key="name",
+                                           value="one")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        call_command("recalc_current_annotations", stdout=StringIO.StringIO())
+
+        # Change r123, and then mess up the current values for both accounts.
+        # Only r123 should be fixed by the incremental update, as r124 hasn't
+        # changed since the high-water mark was recorded.
+
+        response = functions.add({'user_id'     : "erik",
+                                  'annotations' : [
+                                      dict(account="r123", key="name",
+                                           value="two")]})
+        if not response['success']:
+            self.fail(response['error'])
+
+        CurrentAnnotation.objects.all().update(
+                    value=AnnotationValue.objects.get(value=""))
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command("recalc_current_annotations", incremental=True,
+                         stdout=StringIO.StringIO())
+
+        self.assertEqual(self._get_current_annotations(),
+                         {("r123", "name") : "two",
+                          ("r124", "name") : ""})
+        for query in queries:
+            self.assertFalse("ROW_NUMBER" in query['sql'])
+
+#############################################################################
+
+class VerifyCurrentAnnotationsTestCase(CurrentAnnotationsTestCase):
+    """ Unit tests for the "verify_current_annotations" management command.
+    """
+    def test_verify(self):
+        """ Check that mismatches are found and fixed.
+        """
+        expected = self._setup_annotations()
+
+        # Add a CurrentAnnotation record which doesn't have any annotations.
+
+        extra = CurrentAnnotation()
+        extra.account = Account.objects.create(address="r999")
+        extra.key     = AnnotationKey.objects.get(key="owner")
+        extra.value   = AnnotationValue.objects.get(value="one")
+        extra.save()
+
+        results = currentAnnotations.verify(chunk_size=2)
+        self.assertEqual(results, {'checked' : 3,
+                                   'missing' : 1,
+                                   'extra'   : 1,
+                                   'wrong'   : 1})
+
+        call_command("verify_current_annotations", fix=True, quiet=True,
+                     stdout=StringIO.StringIO())
+
+        self.assertEqual(self._get_current_annotations(), expected)
+
+        results = currentAnnotations.verify()
+        self.assertEqual(results, {'checked' : 3,
+                                   'missing' : 0,
+                                   'extra'   : 0,
+                                   'wrong'   : 0})
@@ -8,9 +8,15 @@ from django.conf.urls import patterns, include, url
 #############################################################################
 
 urlpatterns = patterns('annotationDatabase.api.views',
+    url(r'^add_stream',  "add_stream"),
+    url(r'^add_stream/', "add_stream"),
+
     url(r'^add',  "add"),
     url(r'^add/', "add"),
 
+    url(r'^batch_status/(?P<batch_num>[^/]+)',  'batch_status'),
+    url(r'^batch_status/(?P<batch_num>[^/]+)/', 'batch_status'),
+
     url(r'^hide',  "hide"),
     url(r'^hide/', "hide"),
 
@@ -20,6 +26,12 @@ urlpatterns = patterns('annotationDatabase.api.views',
     url(r'^get/(?P<batch_number>[^/]+)',  'get'),
     url(r'^get/(?P<batch_number>[^/]+)/', 'get'),
 
+    url(r'^changes',  "changes"),
+    url(r'^changes/', "changes"),
+
+    url(r'^accounts/bulk',  "accounts_bulk"),
+    url(r'^accounts/bulk/', "accounts_bulk"),
+
     url(r'^accounts',  "accounts"),
     url(r'^accounts/', "accounts"),
 
@@ -32,6 +44,9 @@ urlpatterns = patterns('annotationDatabase.api.views',
     url(r'^search',  "search"),
     url(r'^search/', "search"),
 
+    url(r'^facets',  "facets"),
+    url(r'^facets/', "facets"),
+
     url(r'^set_template/(?P<template_name>[^/]+)',  'set_template'),
     url(r'^set_template/(?P<template_name>[^/]+)/', 'set_template'),
 
@@ -5,12 +5,21 @@
 
     Note that these are just wrappers around the equivalent functions provided
     by the annotationDatabase.api.functions module.
+
+    The views which return a single account, batch or template, along with the
+    list of public annotations, support conditional GET requests.  Each of
+    these responses includes an ETag header based on a version number for the
+    underlying data, and a request with a matching "If-None-Match" header is
+    answered with a "304 Not Modified" response before the data is
+    retrieved.
 """
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.http                  import HttpResponse, HttpResponseNotAllowed
+from django.views.decorators.http import condition
 
 import simplejson as json
 
-from annotationDatabase.api import functions, helpers
+from annotationDatabase.api        import functions, helpers
+from annotationDatabase.shared.lib import annotationSnapshots
 
 #############################################################################
 
@@ -43,13 +52,86 @@ def add(request):
                                         'error'   : 'Invalid JSON data'}),
                             content_type="application/json")
 
+    if type(batch) is not dict:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Batch must be an ' +
+                                                    'object'}),
+                            content_type="application/json")
+
     if not helpers.auth_token_valid(batch.get("auth_token")):
         return HttpResponse(json.dumps({'success' : False,
                                         'error'   : 'Invalid or missing ' +
                                                     'authentication token'}),
                             content_type="application/json")
 
-    response = functions.add(batch)
+    in_background = (request.GET.get("async") == "1")
+
+    response = functions.add(batch, in_background=in_background)
+
+    return HttpResponse(json.dumps(response), content_type="application/json")
+
+#############################################################################
+
+def add_stream(request):
+    """ Respond to the "/add_stream" URL.
+
+        The body of the request should consist of newline-delimited JSON.  The
+        first line is a header object with 'user_id' and 'auth_token' fields,
+        and each following line is a single annotation to add.  We read the
+        request body a line at a time, so the batch never has to be held in
+        memory all at once.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        header = json.loads(request.readline())
+    except ValueError:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid JSON header'}),
+                            content_type="application/json")
+
+    if type(header) is not dict:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Header must be an ' +
+                                                    'object'}),
+                            content_type="application/json")
+
+    if not helpers.auth_token_valid(header.get("auth_token")):
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid or missing ' +
+                                                    'authentication token'}),
+                            content_type="application/json")
+
+    if "user_id" not in header:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Missing required ' +
+                                                    '"user_id" field'}),
+                            content_type="application/json")
+
+    response = functions.add_stream(header['user_id'], request)
+
+    return HttpResponse(json.dumps(response), content_type="application/json")
+
+#############################################################################
+
+def batch_status(request, batch_num):
+    """ Respond to the "/batch_status/{batch_num}" URL.
+    """
+    if request.method == "GET":
+        params = request.GET
+    elif request.method == "POST":
+        params = request.POST
+    else:
+        return HttpResponseNotAllowed(["GET", "POST"])
+
+    if not helpers.auth_token_valid(params.get("auth_token")):
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid or missing ' +
+                                                    'authentication token'}),
+                            content_type="application/json")
+
+    response = functions.batch_status(batch_num)
 
     return HttpResponse(json.dumps(response), content_type="application/json")
 
@@ -112,15 +194,28 @@ def list(request):
                                                     'authentication token'}),
                             content_type="application/json")
 
-    page = params.get("page", 1)
-    rpp  = params.get("rpp",  100)
+    page           = params.get("page", 1)
+    rpp            = params.get("rpp",  100)
+    cursor         = params.get("cursor")
+    include_totals = (params.get("include_totals") == "1")
 
-    response = functions.list_batches(page, rpp)
+    response = functions.list_batches(page, rpp, cursor=cursor,
+                                      include_totals=include_totals)
 
     return HttpResponse(json.dumps(response), content_type="application/json")
 
 #############################################################################
 
+def _batch_etag(request, batch_number):
+    """ Return the ETag for the "/get/{batch_number}" URL.
+    """
+    if (request.method != "GET" or
+            not helpers.auth_token_valid(request.GET.get("auth_token"))):
+        return None
+    return helpers.batch_etag(batch_number)
+
+
+@condition(etag_func=_batch_etag)
 def get(request, batch_number):
     """ Respond to the "/get/{batch_number}" URL.
     """
@@ -142,6 +237,31 @@ def get(request, batch_number):
 
 #############################################################################
 
+def changes(request):
+    """ Respond to the "/changes" URL.
+    """
+    if request.method == "GET":
+        params = request.GET
+    elif request.method == "POST":
+        params = request.POST
+    else:
+        return HttpResponseNotAllowed(["GET", "POST"])
+
+    if not helpers.auth_token_valid(params.get("auth_token")):
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid or missing ' +
+                                                    'authentication token'}),
+                            content_type="application/json")
+
+    since = params.get("since")
+    rpp   = params.get("rpp", 1000)
+
+    response = functions.changes(since, rpp)
+
+    return HttpResponse(json.dumps(response), content_type="application/json")
+
+#############################################################################
+
 def accounts(request):
     """ Respond to the "/account/{account}" URL.
     """
@@ -158,14 +278,83 @@ def accounts(request):
                                                     'authentication token'}),
                             content_type="application/json")
 
-    page = params.get("page", 1)
-    rpp  = params.get("rpp",  100)
+    page           = params.get("page", 1)
+    rpp            = params.get("rpp",  100)
+    cursor         = params.get("cursor")
+    include_totals = (params.get("include_totals") == "1")
 
-    response = functions.list_accounts(page, rpp)
+    response = functions.list_accounts(page, rpp, cursor=cursor,
+                                       include_totals=include_totals)
     return HttpResponse(json.dumps(response), content_type="application/json")
 
 #############################################################################
 
+def accounts_bulk(request):
+    """ Respond to the "/accounts/bulk" URL.
+
+        The body of the request should be a JSON object with 'auth_token' and
+        'accounts' fields, and an optional 'keys' field.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        params = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid JSON data'}),
+                            content_type="application/json")
+
+    if type(params) is not dict:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Request must be an ' +
+                                                    'object'}),
+                            content_type="application/json")
+
+    if not helpers.auth_token_valid(params.get("auth_token")):
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Invalid or missing ' +
+                                                    'authentication token'}),
+                            content_type="application/json")
+
+    if "accounts" not in params:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Missing required ' +
+                                                    '"accounts" field'}),
+                            content_type="application/json")
+
+    as_of = None
+    if params.get("as_of") not in [None, ""]:
+        as_of = annotationSnapshots.parse_as_of(unicode(params['as_of']))
+        if as_of == None:
+            return HttpResponse(json.dumps({'success' : False,
+                                            'error'   : 'Invalid "as_of" ' +
+                                                        'field'}),
+                                content_type="application/json")
+
+    response = functions.accounts_bulk(params['accounts'],
+                                       keys=params.get("keys"),
+                                       as_of=as_of)
+
+    return HttpResponse(json.dumps(response), content_type="application/json")
+
+#############################################################################
+
+def _account_etag(request, account):
+    """ Return the ETag for the "/account/{account}" URL.
+
+        The ETag only covers the account's current annotations, so we don't
+        return one when the annotations as of a given moment are requested.
+    """
+    if (request.method != "GET" or
+            not helpers.auth_token_valid(request.GET.get("auth_token"))):
+        return None
+    if request.GET.get("as_of", "") != "":
+        return None
+    return helpers.account_etag(account)
+
+
+@condition(etag_func=_account_etag)
 def account(request, account):
     """ Respond to the "/account/{account}" URL.
     """
@@ -182,7 +371,16 @@ def account(request, account):
                                                     'authentication token'}),
                             content_type="application/json")
 
-    response = functions.account(account)
+    as_of = None
+    if params.get("as_of", "") != "":
+        as_of = annotationSnapshots.parse_as_of(params['as_of'])
+        if as_of == None:
+            return HttpResponse(json.dumps({'success' : False,
+                                            'error'   : 'Invalid "as_of" ' +
+                                                        'parameter'}),
+                                content_type="application/json")
+
+    response = functions.account(account, as_of=as_of)
 
     return HttpResponse(json.dumps(response), content_type="application/json")
 
@@ -257,8 +455,69 @@ def search(request):
     else:
         totals_only = False
 
+    cursor         = params.get("cursor")
+    include_totals = (params.get("include_totals") == "1")
+
+    # Only authenticated clients are allowed to see the query plan.
+
+    debug = (not public_only) and (params.get("debug") == "1")
+
+    as_of = None
+    if params.get("as_of", "") != "":
+        as_of = annotationSnapshots.parse_as_of(params['as_of'])
+        if as_of == None:
+            return HttpResponse(json.dumps({'success' : False,
+                                            'error'   : 'Invalid "as_of" ' +
+                                                        'parameter'}),
+                                content_type="application/json")
+
     response = functions.search(query=query, page=page, rpp=rpp,
                                 totals_only=totals_only,
+                                public_only=public_only,
+                                cursor=cursor,
+                                include_totals=include_totals,
+                                debug=debug,
+                                as_of=as_of)
+
+    return HttpResponse(json.dumps(response), content_type="application/json")
+
+#############################################################################
+
+def facets(request):
+    """ Respond to the "/facets" URL.
+    """
+    if request.method == "GET":
+        params = request.GET
+    elif request.method == "POST":
+        params = request.POST
+    else:
+        return HttpResponseNotAllowed(["GET", "POST"])
+
+    if "auth_token" not in params:
+        public_only = True
+    else:
+        public_only = False
+
+    if not public_only:
+        if not helpers.auth_token_valid(params.get("auth_token")):
+            return HttpResponse(json.dumps({'success' : False,
+                                            'error'   : 'Invalid or missing ' +
+                                                        'authentication ' +
+                                                        'token'}),
+                                content_type="application/json")
+
+    if "keys" not in params:
+        return HttpResponse(json.dumps({'success' : False,
+                                        'error'   : 'Missing required ' +
+                                                    '"keys" parameter'}),
+                            content_type="application/json")
+
+    keys = []
+    for key in params['keys'].split(","):
+        if key.strip() != "":
+            keys.append(key.strip())
+
+    response = functions.facets(keys, query=params.get("query"),
                                 public_only=public_only)
 
     return HttpResponse(json.dumps(response), content_type="application/json")
@@ -307,6 +566,16 @@ def set_template(request, template_name):
 
 #############################################################################
 
+def _template_etag(request, template_name):
+    """ Return the ETag for the "/get_template/{template}" URL.
+    """
+    if (request.method != "GET" or
+            not helpers.auth_token_valid(request.GET.get("auth_token"))):
+        return None
+    return helpers.template_etag(template_name)
+
+
+@condition(etag_func=_template_etag)
 def get_template(request, template_name):
     """ Respond to the "/get_template/{template}" URL.
     """
@@ -329,6 +598,15 @@ def get_template(request, template_name):
 
 #############################################################################
 
+def _public_annotations_etag(request):
+    """ Return the ETag for the "/public_annotations" URL.
+    """
+    if request.method != "GET":
+        return None
+    return helpers.public_annotations_etag()
+
+
+@condition(etag_func=_public_annotations_etag)
 def public_annotations(request):
     """ Respond to the "public_annotations" URL.
     """
@@ -345,11 +623,15 @@ def public_annotations(request):
                                                     '"annotation" ' +
                                                     'parameter'}),
                             content_type="application/json")
-    annotation = params['annotation']
-    page       = params.get("page", 1)
-    rpp        = params.get("rpp",  100)
-
-    response = functions.public_annotations(annotation, page=page, rpp=rpp)
+    annotation     = params['annotation']
+    page           = params.get("page", 1)
+    rpp            = params.get("rpp",  100)
+    cursor         = params.get("cursor")
+    include_totals = (params.get("include_totals") == "1")
+
+    response = functions.public_annotations(annotation, page=page, rpp=rpp,
+                                            cursor=cursor,
+                                            include_totals=include_totals)
 
     return HttpResponse(json.dumps(response), content_type="application/json")
     
@@ -38,6 +38,24 @@ import_setting("LOGGING_DESTINATION",          "file")
 import_setting("PUBLIC_SIGNUP_PASSWORD",       "")
 import_setting("PUBLIC_TEMPLATE_NAME",         "")
 import_setting("PUBLIC_CONFLICT_EMAIL",        "")
+import_setting("INTERN_CACHE_SIZE",            100000)
+import_setting("ADD_STREAM_CHUNK_SIZE",        5000)
+import_setting("QUEUE_LEASE_TIMEOUT",          600)
+import_setting("QUEUE_MAX_ATTEMPTS",           3)
+import_setting("SEARCH_PARSE_CACHE_SIZE",      1000)
+import_setting("SEARCH_BITMAP_KEYS",           "")
+import_setting("SEARCH_BITMAP_REFRESH_INTERVAL", 1.0)
+import_setting("SEARCH_BITMAP_MAX_AGE",        3600)
+import_setting("SEARCH_BITMAP_MAX_PAGE_IDS",   10000)
+import_setting("SEARCH_BITMAP_MAX_ENTRIES",    10000000)
+import_setting("SEARCH_CACHE_TIMEOUT",         0)
+import_setting("SEARCH_CACHE_BACKEND",
+               "django.core.cache.backends.locmem.LocMemCache")
+import_setting("SEARCH_CACHE_LOCATION",        "search")
+import_setting("SEARCH_MAX_COST",              0.0)
+import_setting("SEARCH_STATEMENT_TIMEOUT",     0)
+import_setting("ACCOUNTS_BULK_MAX_ADDRESSES",  1000)
+import_setting("CHANGES_MAX_RPP",              1000)
 
 #############################################################################
 
@@ -112,6 +130,19 @@ STATIC_URL = '/static/'
 
 DATABASES = {'default': dj_database_url.config(default=DATABASE_URL)}
 
+# Set up our caches.  The "search" cache holds the cached search results, if
+# SEARCH_CACHE_TIMEOUT is set.
+
+CACHES = {
+    'default' : {
+        'BACKEND' : "django.core.cache.backends.locmem.LocMemCache",
+    },
+    'search' : {
+        'BACKEND'  : SEARCH_CACHE_BACKEND,
+        'LOCATION' : SEARCH_CACHE_LOCATION,
+    },
+}
+
 # Enable static file handling:
 
 STATIC_URL = "/static/"
@@ -0,0 +1,276 @@
+""" annotationDatabase.shared.lib.annotationSnapshots
+
+    This module calculates the annotation values as they were at a given
+    moment in the past.
+
+    The value an account had for a given key at time T is the value of the
+    most recent Annotation for that account and key which was uploaded at or
+    before T, ignoring any annotations which had been hidden by then.  This is
+    calculated using the same window query used to rebuild the
+    CurrentAnnotation table, restricted to the batches uploaded at or before
+    T.
+
+    Because this means scanning the annotation history, we can optionally
+    keep "snapshots" of the annotation values, taken periodically by running
+    the "take_annotation_snapshot" management command.  To calculate the
+    values as of time T, we start with the latest snapshot taken at or before
+    T, and only run the window query for the accounts and keys which were
+    annotated, or had an annotation hidden, between the time the snapshot was
+    taken and T.  Because a batch's timestamp is set when the upload starts,
+    queued and streamed uploads can add annotations with a timestamp before
+    the snapshot after it was taken; we find these using the highest
+    Annotation record ID recorded with the snapshot.
+
+    The set of changed accounts and keys is found using the indexes on the
+    annotation record ID, batch and "hidden_at" columns, and is then joined
+    against the snapshot and the annotation history, so that we never have to
+    check every annotation in the history to see if it has changed.
+"""
+import datetime
+
+from django.db             import connection, transaction
+from django.utils.timezone import utc
+
+from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib    import interning, currentAnnotations
+
+#############################################################################
+
+def parse_as_of(s):
+    """ Parse the given string as a moment in time.
+
+        The string can either be a timestamp, as the number of seconds since
+        the 1st of January 1970 ("unix time") in UTC, or a string of the form
+        "batch:N", where N is a batch number.  In the latter case, we use the
+        time at which that batch was uploaded.
+
+        We return a timezone-aware datetime.datetime object, or None if the
+        string is invalid or refers to a batch which doesn't exist.
+    """
+    s = s.strip()
+
+    if s.startswith("batch:"):
+        try:
+            batch_num = int(s[len("batch:"):])
+        except ValueError:
+            return None
+
+        try:
+            batch = AnnotationBatch.objects.get(id=batch_num)
+        except AnnotationBatch.DoesNotExist:
+            return None
+
+        return batch.timestamp
+
+    try:
+        timestamp = int(s)
+    except ValueError:
+        return None
+
+    try:
+        return datetime.datetime.utcfromtimestamp(timestamp).replace(
+                                                                tzinfo=utc)
+    except (ValueError, OverflowError):
+        return None
+
+#############################################################################
+
+def values_sql(as_of, account_ids=None, key_ids=None):
+    """ Return the SQL used to calculate the annotation values at a moment.
+
+        'as_of' should be a datetime.datetime object.  If 'account_ids' or
+        'key_ids' are supplied, only the annotations for the given Account or
+        AnnotationKey record IDs will be included.
+
+        We return an (sql, params) tuple, where 'sql' is a SELECT statement
+        returning (account_id, key_id, value_id) rows, one for each account
+        and key which had been annotated at that time, and 'params' is the
+        list of parameters to pass along with the SQL statement.  This has the
+        same columns as the CurrentAnnotation table, so it can be used in its
+        place to search or retrieve the annotation values as they were at
+        that moment.
+    """
+    empty_value_id = interning.get_value_id("", create=True)
+
+    snapshot = AnnotationSnapshot.objects.filter(taken_at__lte=as_of) \
+                                         .order_by("-taken_at").first()
+
+    if snapshot == None:
+        # There's no snapshot to start from -> scan the annotation history.
+        return currentAnnotations.latest_values_sql(empty_value_id,
+                                                    as_of=as_of,
+                                                    account_ids=account_ids,
+                                                    key_ids=key_ids)
+
+    # Take the values which haven't changed since the snapshot was taken from
+    # the snapshot, and calculate the remaining values from the history.
+
+    changed_sql,changed_params = _changed_pairs_sql(snapshot, as_of)
+
+    conditions = ["s.snapshot_id = %s", "c.account_id IS NULL"]
+    params     = changed_params + [snapshot.id]
+
+    if account_ids != None:
+        conditions.append(currentAnnotations.in_list_sql("s.account_id",
+                                                         account_ids))
+        params.extend(account_ids)
+
+    if key_ids != None:
+        conditions.append(currentAnnotations.in_list_sql("s.key_id",
+                                                         key_ids))
+        params.extend(key_ids)
+
+    latest_sql,latest_params = currentAnnotations.latest_values_sql(
+                                        empty_value_id,
+                                        as_of=as_of,
+                                        account_ids=account_ids,
+                                        key_ids=key_ids,
+                                        pairs=(changed_sql, changed_params))
+
+    sql = " ".join([
+        "SELECT s.account_id, s.key_id, s.value_id",
+        "FROM " + SnapshotAnnotation._meta.db_table + " s",
+        "LEFT JOIN (" + changed_sql + ") c",
+        "ON c.account_id = s.account_id AND c.key_id = s.key_id",
+        "WHERE " + " AND ".join(conditions),
+        "UNION ALL",
+        latest_sql])
+
+    return (sql, params + latest_params)
+
+#############################################################################
+
+def take_snapshot(as_of=None):
+    """ Take a new snapshot of the annotation values.
+
+        If 'as_of' is supplied, it should be a datetime.datetime object, and
+        the snapshot will hold the annotation values at that time.  Otherwise,
+        the snapshot holds the annotation values as they were a few minutes
+        ago, so that any batches which were still being uploaded when the
+        snapshot was taken are included in the annotation history rather than
+        the snapshot.
+
+        We return the newly-created AnnotationSnapshot object.
+    """
+    if as_of == None:
+        as_of = datetime.datetime.utcnow().replace(tzinfo=utc) - _SETTLE_TIME
+
+    last_annotation_id = _get_last_annotation_id()
+
+    with transaction.atomic():
+        # Note that we calculate the snapshot's values before creating the
+        # snapshot record, so that values_sql() starts from the previous
+        # snapshot, if any, rather than the one we are creating.
+
+        sql,params = values_sql(as_of)
+
+        snapshot = AnnotationSnapshot()
+        snapshot.taken_at           = as_of
+        snapshot.last_annotation_id = last_annotation_id
+        snapshot.save()
+
+        table  = SnapshotAnnotation._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO " + table +
+                       " (snapshot_id, account_id, key_id, value_id)" +
+                       " SELECT %s, account_id, key_id, value_id" +
+                       " FROM (" + sql + ") AS latest",
+                       [snapshot.id] + params)
+
+    return snapshot
+
+#############################################################################
+
+def delete_old_snapshots(num_to_keep):
+    """ Delete all but the 'num_to_keep' most recent snapshots.
+
+        We return the number of snapshots which were deleted.
+    """
+    snapshot_ids = list(AnnotationSnapshot.objects.order_by("-taken_at")
+                                          .values_list("id", flat=True)
+                                          [num_to_keep:])
+    if len(snapshot_ids) == 0:
+        return 0
+
+    with transaction.atomic():
+        SnapshotAnnotation.objects.filter(snapshot_id__in=snapshot_ids) \
+                                  .delete()
+        AnnotationSnapshot.objects.filter(id__in=snapshot_ids).delete()
+
+    return len(snapshot_ids)
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# How far in the past to take a snapshot by default.  A batch's timestamp is
+# set when the upload starts, so any batch which takes longer than this to
+# upload may be missing from the snapshot.
+
+_SETTLE_TIME = datetime.timedelta(minutes=10)
+
+#############################################################################
+
+def _get_last_annotation_id():
+    """ Return the highest Annotation record ID, or zero if there are none.
+
+        Record IDs are allocated before the annotations are committed, so an
+        upload which is still in progress may hold a lower record ID than one
+        which has already been committed.  Under PostgreSQL, we wait for any
+        such uploads to finish by briefly locking the Annotation table, so
+        that every annotation with a record ID up to the one we return has
+        been committed.
+    """
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if connection.vendor == "postgresql":
+            cursor.execute("LOCK TABLE " + Annotation._meta.db_table +
+                           " IN SHARE MODE")
+        cursor.execute("SELECT MAX(id) FROM " + Annotation._meta.db_table)
+        last_id = cursor.fetchone()[0]
+
+    return last_id or 0
+
+#############################################################################
+
+def _changed_pairs_sql(snapshot, as_of):
+    """ Return the SQL used to find the annotations changed since a snapshot.
+
+        We return an (sql, params) tuple, where 'sql' is a SELECT statement
+        returning distinct (account_id, key_id) rows, one for each account and
+        key whose value at 'as_of' may differ from its value in the given
+        snapshot.  This is the case if the account and key:
+
+            * were annotated in a batch uploaded after the snapshot was taken
+              and at or before 'as_of',
+
+            * had an annotation added after the snapshot was taken, in a
+              batch uploaded at or before 'as_of', or
+
+            * had an annotation hidden after the snapshot was taken and at or
+              before 'as_of'.
+
+        Each of these is a separate query so that it can use its own index.
+    """
+    annotation_table = Annotation._meta.db_table
+    batch_table      = AnnotationBatch._meta.db_table
+
+    sql = " ".join([
+        "SELECT x.account_id, x.key_id FROM " + annotation_table + " x",
+        "JOIN " + batch_table + " y ON y.id = x.batch_id",
+        "WHERE y.timestamp > %s AND y.timestamp <= %s",
+        "UNION",
+        "SELECT x.account_id, x.key_id FROM " + annotation_table + " x",
+        "JOIN " + batch_table + " y ON y.id = x.batch_id",
+        "WHERE x.id > %s AND y.timestamp <= %s",
+        "UNION",
+        "SELECT x.account_id, x.key_id FROM " + annotation_table + " x",
+        "WHERE x.hidden_at > %s AND x.hidden_at <= %s"])
+
+    params = [snapshot.taken_at, as_of,
+              snapshot.last_annotation_id, as_of,
+              snapshot.taken_at, as_of]
+
+    return (sql, params)
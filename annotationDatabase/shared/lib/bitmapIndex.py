@@ -0,0 +1,418 @@
+""" annotationDatabase.shared.lib.bitmapIndex
+
+    This module implements an optional in-memory index of the current
+    annotation values, used to answer search queries without going to the
+    database.
+
+    For each of the annotation keys listed in the SEARCH_BITMAP_KEYS setting
+    (a comma-separated list of keys), we hold the set of account IDs which
+    currently have each value for that key.  A search query which only uses
+    these keys, and only uses the "=" and "!=" comparisons, can then be
+    answered by evaluating the LogicalExpression as a series of set
+    intersections, unions and differences.  Any other search query, or any
+    query made while the index is still being loaded, should fall back to
+    searching the database.
+
+    Each "bitmap" in the index is held as a Python set of account IDs rather
+    than a compressed bitmap, as there is no compressed bitmap library we can
+    rely on being installed.  This keeps the memory used by sparse values
+    proportional to the number of accounts which have that value, and lets
+    the index be updated one account at a time.  To stop the index using up
+    too much memory, it holds at most SEARCH_BITMAP_MAX_ENTRIES account IDs in
+    all; if the index grows beyond this, it is emptied and every search goes
+    to the database until the index is next reloaded.
+
+    Note that hidden annotations are held in the CurrentAnnotation table with
+    an empty value, and so are matched by "!=" and negated search terms just
+    as they are when searching the database.
+
+    Note that the index is held separately by each process.  It is loaded in a
+    background thread the first time it is needed, and then kept up to date
+    by reading the AnnotationChange records added since it was last updated.
+    The AnnotationChange records are committed in the same order as their
+    record IDs, so the highest AnnotationChange record ID we have seen tells
+    us whether the index is up to date, without any risk of skipping over a
+    change which was committed late.  We check this at most once every
+    SEARCH_BITMAP_REFRESH_INTERVAL seconds, or straight away after the current
+    process has called changed().
+
+    Changes which rewrite the CurrentAnnotation table without recording
+    AnnotationChanges (for example, rebuilding the table from scratch)
+    increment the generation number in the CurrentAnnotationMark table.  When
+    we see that the generation has changed, we throw the index away and load
+    it again in the background.  As a final safety net, the entire index is
+    also reloaded in the background every SEARCH_BITMAP_MAX_AGE seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db   import connection
+
+from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib    import interning
+
+#############################################################################
+
+def is_enabled():
+    """ Return True if the bitmap index has been enabled in our settings.
+    """
+    return len(_indexed_keys()) > 0
+
+#############################################################################
+
+def search(expression, page=1, rpp=1000, totals_only=False):
+    """ Use the bitmap index to find the accounts matching a search query.
+
+        'expression' is the LogicalExpression to search for, and 'page', 'rpp'
+        and 'totals_only' are the same as for api.functions.search().
+
+        If the index can answer the query, we return a dictionary with the
+        same 'success', 'num_matches', 'num_pages' and 'accounts' entries as
+        api.functions.search().  If the index is not yet loaded or can't
+        answer this query, we return None, and the caller should search the
+        database instead.
+    """
+    index = _get_index()
+    if index == None:
+        return None
+
+    try:
+        matches = index.evaluate(expression)
+    except _Unsupported:
+        return None
+
+    num_matches = len(matches)
+
+    if totals_only:
+        return {'success'     : True,
+                'num_matches' : num_matches}
+
+    if num_matches > settings.SEARCH_BITMAP_MAX_PAGE_IDS:
+        # Too many matches to page through using a list of IDs.
+        return None
+
+    try:
+        page = int(page)
+    except ValueError:
+        page = 1
+    rpp = max(1, int(rpp))
+
+    num_pages = max(1, (num_matches + rpp - 1) // rpp)
+    if page < 1:
+        page = 1
+
+    if page > num_pages:
+        accounts = []
+    else:
+        accounts = list(Account.objects.filter(id__in=list(matches))
+                                       .order_by("address")
+                                       .values_list("address", flat=True)
+                                       [(page-1)*rpp:page*rpp])
+
+    return {'success'     : True,
+            'num_matches' : num_matches,
+            'num_pages'   : num_pages,
+            'accounts'    : accounts}
+
+#############################################################################
+
+def load():
+    """ Load the bitmap index straight away, within the current thread.
+
+        This is normally done automatically in the background; calling load()
+        directly is mainly useful for testing.
+    """
+    global _index, _needs_refresh
+
+    _needs_refresh = False
+
+    index = BitmapIndex(_indexed_keys())
+    index.load()
+    with _lock:
+        _index = index
+
+#############################################################################
+
+def changed():
+    """ Tell the bitmap index that the current annotations have changed.
+
+        This should be called whenever the current process changes any
+        CurrentAnnotation records, so that the next search will bring the
+        index up to date first.
+    """
+    global _needs_refresh
+
+    _needs_refresh = True
+
+#############################################################################
+
+def clear():
+    """ Throw away the bitmap index held by the current process.
+    """
+    global _index
+
+    with _lock:
+        _index = None
+
+#############################################################################
+
+class BitmapIndex(object):
+    """ An in-memory index of the current values for a set of keys.
+    """
+    def __init__(self, keys):
+        """ Standard initialiser.
+
+            'keys' is the list of annotation keys to index.
+        """
+        self._key_ids    = set(interning.get_key_ids(keys, create=False)
+                                        .values())
+        self._accounts   = {} # Maps key ID to {account_id: value_id} dict.
+        self._values     = {} # Maps (key_id, value_id) to set of account IDs.
+        self._universe   = set() # IDs of all accounts with annotations.
+        self._num_ids    = 0 # Number of account IDs held in the index.
+        self._too_large  = False # Has the index grown too large?
+        self._last_id    = 0 # ID of the last AnnotationChange we've applied.
+        self._generation = None
+        self._lock       = threading.Lock()
+        self.loaded_at   = None
+        self.checked_at  = None
+
+        for key_id in self._key_ids:
+            self._accounts[key_id] = {}
+
+
+    def load(self):
+        """ Load the index from the CurrentAnnotation table.
+
+            Note that we find the generation and the last AnnotationChange
+            before reading the CurrentAnnotation table, so that any change
+            made while we are loading will be applied again by the next
+            refresh.  Applying a change twice does no harm.
+        """
+        self.loaded_at   = time.time()
+        self.checked_at  = self.loaded_at
+        self._generation = CurrentAnnotationMark.current_generation()
+        self._last_id    = _last_change_id()
+
+        records = CurrentAnnotation.objects.values_list("account_id",
+                                                        "key_id",
+                                                        "value_id")
+
+        with self._lock:
+            for account_id,key_id,value_id in records.iterator():
+                self._apply(account_id, key_id, value_id)
+
+
+    def refresh(self):
+        """ Apply any new AnnotationChange records to the index.
+        """
+        self.checked_at = time.time()
+
+        records = AnnotationChange.objects.filter(id__gt=self._last_id) \
+                                          .order_by("id") \
+                                          .values_list("id", "account_id",
+                                                       "key_id", "value_id")
+
+        with self._lock:
+            for id,account_id,key_id,value_id in records.iterator():
+                self._apply(account_id, key_id, value_id)
+                self._last_id = id
+
+
+    def is_up_to_date(self):
+        """ Return True if there are no new AnnotationChange records.
+        """
+        self.checked_at = time.time()
+
+        return _last_change_id() <= self._last_id
+
+
+    def is_stale(self):
+        """ Return True if the CurrentAnnotation table has been rewritten.
+
+            If this returns True, the index can no longer be brought up to
+            date by applying the AnnotationChange records, and must be loaded
+            again from scratch.
+        """
+        return CurrentAnnotationMark.current_generation() != self._generation
+
+
+    def evaluate(self, expression):
+        """ Return the set of account IDs matching the given expression.
+
+            We raise an _Unsupported exception if the expression can't be
+            answered using this index, or if the index has grown too large.
+            Note that we return a copy of the matching set, so the caller can
+            use it after we have released our lock.
+        """
+        with self._lock:
+            if self._too_large:
+                raise _Unsupported()
+            return set(expression.to_set(self._convert, self._universe))
+
+
+    def _apply(self, account_id, key_id, value_id):
+        """ Record the current value for the given account and key.
+
+            Note that the caller must hold our lock.
+
+            CurrentAnnotation records are only ever removed by rewriting the
+            table, which means the index must be loaded again from scratch.
+            An account never leaves the universe, just as it never leaves the
+            set of accounts in the CurrentAnnotation table.
+        """
+        if self._too_large:
+            return
+
+        if account_id not in self._universe:
+            self._universe.add(account_id)
+            self._num_ids = self._num_ids + 1
+
+        if key_id in self._key_ids:
+            accounts  = self._accounts[key_id]
+            old_value = accounts.get(account_id)
+            if old_value == None:
+                self._num_ids = self._num_ids + 2
+            elif old_value != value_id:
+                self._values[(key_id, old_value)].discard(account_id)
+
+            accounts[account_id] = value_id
+            self._values.setdefault((key_id, value_id), set()).add(account_id)
+
+        if self._num_ids > settings.SEARCH_BITMAP_MAX_ENTRIES:
+            # Throw away what we have to free up the memory.
+            self._too_large = True
+            self._universe  = set()
+            self._values    = {}
+            for key_id in self._key_ids:
+                self._accounts[key_id] = {}
+
+
+    def _convert(self, variable, comparison, value):
+        """ Return the set of accounts matching a single simple expression.
+
+            This is the converter function passed to
+            LogicalExpression.to_set().
+        """
+        key_id = interning.get_key_id(variable)
+        if key_id not in self._key_ids or comparison not in ["=", "!="]:
+            raise _Unsupported()
+
+        value_id = interning.get_value_id(value)
+        matches  = self._values.get((key_id, value_id), set())
+
+        if comparison == "=":
+            return matches
+        else:
+            return self._accounts[key_id].viewkeys() - matches
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The bitmap index for this process, the lock used to protect it, and whether
+# a background thread is currently loading a new index.
+
+_index         = None
+_lock          = threading.Lock()
+_loading       = False
+_needs_refresh = False
+
+#############################################################################
+
+class _Unsupported(Exception):
+    """ An exception raised when a query can't be answered by the index.
+    """
+    pass
+
+#############################################################################
+
+def _indexed_keys():
+    """ Return the list of annotation keys to be indexed.
+    """
+    keys = []
+    for key in settings.SEARCH_BITMAP_KEYS.split(","):
+        if key.strip() != "":
+            keys.append(key.strip())
+    return keys
+
+#############################################################################
+
+def _get_index():
+    """ Return an up-to-date BitmapIndex, or None if it is not yet loaded.
+
+        If the index hasn't been loaded yet, or is due to be reloaded, we
+        start loading it in the background.  If the CurrentAnnotation table
+        has been rewritten since the index was loaded, we throw the index away
+        and start loading it again.
+    """
+    global _index, _needs_refresh
+
+    with _lock:
+        index = _index
+
+    now = time.time()
+
+    if index == None or now - index.loaded_at > settings.SEARCH_BITMAP_MAX_AGE:
+        _start_loading()
+
+    if index == None:
+        return None
+
+    if (_needs_refresh or
+            now - index.checked_at > settings.SEARCH_BITMAP_REFRESH_INTERVAL):
+        _needs_refresh = False
+        if index.is_stale():
+            with _lock:
+                if _index is index:
+                    _index = None
+            _start_loading()
+            return None
+        if not index.is_up_to_date():
+            index.refresh()
+
+    return index
+
+#############################################################################
+
+def _last_change_id():
+    """ Return the ID of the most recent AnnotationChange record, if any.
+    """
+    last_id = AnnotationChange.objects.order_by("-id") \
+                                      .values_list("id", flat=True)[:1]
+    if len(last_id) == 0:
+        return 0
+    else:
+        return last_id[0]
+
+#############################################################################
+
+def _start_loading():
+    """ Start loading a new copy of the bitmap index in the background.
+    """
+    global _loading
+
+    with _lock:
+        if _loading:
+            return
+        _loading = True
+
+    thread = threading.Thread(target=_load_in_background)
+    thread.daemon = True
+    thread.start()
+
+
+def _load_in_background():
+    """ Load the bitmap index.  This runs in its own thread.
+    """
+    global _loading
+
+    try:
+        load()
+    finally:
+        connection.close()
+        with _lock:
+            _loading = False
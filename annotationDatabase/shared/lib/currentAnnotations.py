@@ -0,0 +1,648 @@
+""" annotationDatabase.shared.lib.currentAnnotations
+
+    This module rebuilds the CurrentAnnotation table, either from scratch or
+    incrementally, and checks that it matches the annotation history.
+
+    The current value for a given account and key is the value of the most
+    recent visible (that is, not hidden) Annotation for that account and key,
+    where "most recent" means the Annotation belonging to the AnnotationBatch
+    with the latest timestamp.  If every Annotation for an account and key has
+    been hidden, the current value is an empty string.
+
+    Rather than working through the annotations one at a time, we let the
+    database calculate the current values using a window function, so the
+    entire rebuild takes a constant number of queries no matter how much
+    annotation history there is.  There are two ways of doing this:
+
+      * rebuild() calculates every current value using a single SQL
+        statement.
+
+      * rebuild_in_chunks() splits the accounts up into ranges of account IDs
+        and calculates the current values for each range separately, using a
+        pool of worker processes.  The results are collected in a staging
+        table.
+
+    Either way, the new values are swapped into the CurrentAnnotation table
+    within a single transaction, so anyone reading the CurrentAnnotation table
+    while the rebuild is in progress will continue to see the old values until
+    the new ones are ready, rather than an empty table.
+
+    Each rebuild records a high-water mark in the CurrentAnnotationMark table:
+    the highest Annotation record ID and the latest "hidden_at" timestamp at
+    the time the rebuild started.  update_incrementally() uses this to
+    recalculate just the (account, key) pairs which have been annotated or
+    hidden since the high-water mark, which makes it a quick way of repairing
+    the CurrentAnnotation table after an incident.
+
+    verify() compares the CurrentAnnotation table against the values
+    calculated from the annotation history, reporting and optionally fixing
+    any mismatches.
+
+    Note that any annotations added while a chunked rebuild is running may not
+    be reflected in the rebuilt table, so the chunked rebuild should be run
+    while the annotation database is quiet, or followed by an incremental
+    update.
+"""
+import datetime
+import multiprocessing
+import uuid
+
+from django.db             import connection, transaction
+from django.db.models      import Max
+from django.utils.timezone import utc
+
+from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib    import interning, searchCache
+from annotationDatabase.shared.lib    import bitmapIndex
+from annotationDatabase.shared.lib    import streamingQueries
+
+from annotationDatabase.api import helpers
+
+#############################################################################
+
+def rebuild():
+    """ Rebuild the CurrentAnnotation table using a single SQL statement.
+
+        We return the number of CurrentAnnotation records in the rebuilt
+        table.
+    """
+    empty_value_id = interning.get_value_id("", create=True)
+
+    sql,params = latest_values_sql(empty_value_id)
+
+    # Note that we take the high-water mark before starting the rebuild, so
+    # that the rebuild includes at least everything up to the mark.
+
+    last_annotation_id,last_hidden_at = _get_high_water_mark()
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        _lock_current_annotations(cursor)
+        cursor.execute("DELETE FROM " + _current_table())
+        cursor.execute("INSERT INTO " + _current_table() +
+                       " (account_id, key_id, value_id) " + sql, params)
+
+        _record_high_water_mark(last_annotation_id, last_hidden_at,
+                                rewritten=True)
+
+    searchCache.clear()
+    bitmapIndex.changed()
+
+    return CurrentAnnotation.objects.count()
+
+#############################################################################
+
+def rebuild_in_chunks(num_workers=1, chunk_size=10000):
+    """ Rebuild the CurrentAnnotation table in chunks, in parallel.
+
+        The parameters are as follows:
+
+            'num_workers'
+
+                The number of worker processes to use.  If this is 1, the
+                chunks will be calculated one at a time within the current
+                process.
+
+            'chunk_size'
+
+                The number of account IDs to include in each chunk.
+
+        We return the number of CurrentAnnotation records in the rebuilt
+        table.
+    """
+    empty_value_id = interning.get_value_id("", create=True)
+
+    last_annotation_id,last_hidden_at = _get_high_water_mark()
+
+    # Each rebuild uses its own staging table, so that two rebuilds running at
+    # once can't overwrite each other's results.
+
+    staging_table = _STAGING_TABLE_PREFIX + uuid.uuid4().hex[:16]
+
+    chunks = [] # List of (min_account_id, max_account_id, empty_value_id,
+                #          staging_table) tuples.
+    for min_account_id,max_account_id in _account_ranges(_annotation_table(),
+                                                         chunk_size):
+        chunks.append((min_account_id, max_account_id, empty_value_id,
+                       staging_table))
+
+    _create_staging_table(staging_table)
+    try:
+        if num_workers <= 1:
+            for chunk in chunks:
+                _rebuild_chunk(chunk)
+        else:
+            # Each worker needs its own database connection, so we close ours
+            # before starting the worker processes.
+            connection.close()
+
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                pool.map(_rebuild_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            _lock_current_annotations(cursor)
+            cursor.execute("DELETE FROM " + _current_table())
+            cursor.execute("INSERT INTO " + _current_table() +
+                           " (account_id, key_id, value_id)" +
+                           " SELECT account_id, key_id, value_id FROM " +
+                           staging_table)
+
+            _record_high_water_mark(last_annotation_id, last_hidden_at,
+                                    rewritten=True)
+    finally:
+        _drop_staging_table(staging_table)
+
+    searchCache.clear()
+    bitmapIndex.changed()
+
+    return CurrentAnnotation.objects.count()
+
+#############################################################################
+
+def update_incrementally(chunk_size=1000):
+    """ Recalculate the current values changed since the last high-water mark.
+
+        We find each (account, key) pair which has been annotated or hidden
+        since the high-water mark was recorded, and recalculate the current
+        value for just those pairs.  The pairs are recalculated 'chunk_size'
+        at a time, with each chunk in its own transaction.
+
+        Upon completion, we record a new high-water mark and return the number
+        of (account, key) pairs which were recalculated.  If no high-water
+        mark has been recorded yet, we return None without changing anything;
+        the caller should do a full rebuild instead.
+    """
+    try:
+        mark = CurrentAnnotationMark.objects.get()
+    except CurrentAnnotationMark.DoesNotExist:
+        return None
+
+    last_annotation_id,last_hidden_at = _get_high_water_mark()
+
+    changed = Annotation.objects.filter(id__gt=mark.last_annotation_id)
+    if mark.last_hidden_at != None:
+        hidden = Annotation.objects.filter(hidden_at__gte=mark.last_hidden_at)
+    else:
+        hidden = Annotation.objects.filter(hidden_at__isnull=False)
+
+    pairs = set(changed.values_list("account_id", "key_id"))
+    pairs.update(hidden.values_list("account_id", "key_id"))
+
+    pairs = sorted(pairs)
+    chunk_size = max(1, chunk_size)
+    for start in range(0, len(pairs), chunk_size):
+        with transaction.atomic():
+            helpers.recalc_current_annotations(
+                                        set(pairs[start:start+chunk_size]))
+        searchCache.flush()
+
+    _record_high_water_mark(last_annotation_id, last_hidden_at)
+
+    return len(pairs)
+
+#############################################################################
+
+def verify(num_workers=1, chunk_size=100000, fix=False, report=None):
+    """ Check that the CurrentAnnotation table matches the annotation history.
+
+        The parameters are as follows:
+
+            'num_workers'
+
+                The number of worker processes to use.  If this is 1, the
+                accounts will be checked within the current process.  Note
+                that SQLite only allows one process to write to the database
+                at a time, so multiple workers can't be used to fix mismatches
+                under SQLite.
+
+            'chunk_size'
+
+                The number of account IDs to check at once.
+
+            'fix'
+
+                If True, any mismatched CurrentAnnotation records will be
+                corrected.
+
+            'report'
+
+                If supplied, this should be a function which will be called
+                for each mismatch we find.  It will be called with a single
+                (kind, account_id, key_id, expected_value_id, actual_value_id)
+                tuple, where 'kind' is one of "missing", "extra" or "wrong".
+                Note that when 'num_workers' is more than 1, this function is
+                called from within the worker processes, so it must be defined
+                at the top level of a module.
+
+        For each chunk of accounts, we stream the expected current values
+        (calculated from the Annotation and AnnotationBatch tables) and the
+        actual CurrentAnnotation records side by side, both sorted by account
+        and key, and compare them as we go.  Under PostgreSQL both sides are
+        read using server-side cursors, so the memory we use doesn't depend on
+        the size of the tables.
+
+        We return a dictionary with the following entries:
+
+            'checked'  The number of (account, key) pairs checked.
+            'missing'  The number of missing CurrentAnnotation records.
+            'extra'    The number of CurrentAnnotation records which don't
+                       have any annotations.
+            'wrong'    The number of CurrentAnnotation records with the wrong
+                       value.
+    """
+    empty_value_id = interning.get_value_id("", create=True)
+
+    chunks = [] # List of (min_account_id, max_account_id, empty_value_id,
+                #          fix, report) tuples.
+    for min_account_id,max_account_id in _account_ranges(
+                                        Account._meta.db_table, chunk_size):
+        chunks.append((min_account_id, max_account_id, empty_value_id,
+                       fix, report))
+
+    if num_workers <= 1:
+        results = map(_verify_chunk, chunks)
+    else:
+        # Each worker needs its own database connection, so we close ours
+        # before starting the worker processes.
+        connection.close()
+
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            results = pool.map(_verify_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    totals = {'checked' : 0,
+              'missing' : 0,
+              'extra'   : 0,
+              'wrong'   : 0}
+    for result in results:
+        for kind in totals.keys():
+            totals[kind] += result[kind]
+    return totals
+
+#############################################################################
+
+def latest_values_sql(empty_value_id, min_account_id=None,
+                      max_account_id=None, as_of=None, account_ids=None,
+                      key_ids=None, pairs=None):
+    """ Return the SQL used to calculate the current annotation values.
+
+        We return an (sql, params) tuple, where 'sql' is a SELECT statement
+        returning (account_id, key_id, value_id) rows, one for each account
+        and key which has been annotated, and 'params' is the list of
+        parameters to pass along with the SQL statement.
+
+        'empty_value_id' is the record ID of the AnnotationValue to use for
+        accounts and keys whose annotations have all been hidden.  If
+        'min_account_id' and 'max_account_id' are supplied, only the accounts
+        with record IDs in that range (inclusive) will be included.
+
+        If 'as_of' is supplied, it should be a datetime.datetime object, and
+        we calculate the annotation values as they were at that moment rather
+        than right now.  Only the annotations in batches uploaded at or before
+        that time are included, and annotations which were hidden after that
+        time are treated as visible.
+
+        If 'account_ids' or 'key_ids' are supplied, only the annotations for
+        the given Account or AnnotationKey record IDs will be included.  If
+        'pairs' is supplied, it should be an (sql, params) tuple, where 'sql'
+        is a SELECT statement returning distinct (account_id, key_id) rows,
+        and only the annotations for those accounts and keys will be included.
+        The pairs are joined against the annotation history, so that the
+        database can look up just the annotations it needs.
+
+        The window function ranks the annotations for each account and key so
+        that the latest visible annotation comes first.  If the top-ranked
+        annotation is hidden, every annotation for that account and key has
+        been hidden.
+    """
+    if as_of == None:
+        hidden        = "a.hidden"
+        hidden_params = []
+    else:
+        hidden        = ("(a.hidden AND (a.hidden_at IS NULL OR " +
+                         "a.hidden_at <= %s))")
+        hidden_params = [as_of]
+
+    conditions = []
+    where_params = []
+
+    if min_account_id != None and max_account_id != None:
+        conditions.append("a.account_id BETWEEN %s AND %s")
+        where_params.extend([min_account_id, max_account_id])
+
+    if as_of != None:
+        conditions.append("b.timestamp <= %s")
+        where_params.append(as_of)
+
+    if account_ids != None:
+        conditions.append(in_list_sql("a.account_id", account_ids))
+        where_params.extend(account_ids)
+
+    if key_ids != None:
+        conditions.append(in_list_sql("a.key_id", key_ids))
+        where_params.extend(key_ids)
+
+    if pairs != None:
+        pairs_sql,pairs_params = pairs
+        pairs_join = " ".join([
+            "JOIN (" + pairs_sql + ") p",
+            "ON p.account_id = a.account_id AND p.key_id = a.key_id"])
+    else:
+        pairs_join   = ""
+        pairs_params = []
+
+    if conditions:
+        where = "WHERE " + " AND ".join(conditions)
+    else:
+        where = ""
+
+    sql = " ".join([
+        "SELECT account_id, key_id,",
+        "CASE WHEN hidden OR value_id IS NULL THEN %s ELSE value_id END",
+        "AS value_id",
+        "FROM (SELECT a.account_id, a.key_id, a.value_id,",
+              hidden + " AS hidden,",
+              "ROW_NUMBER() OVER (PARTITION BY a.account_id, a.key_id",
+                                 "ORDER BY " + hidden + ",",
+                                          "b.timestamp DESC,",
+                                          "a.id DESC) AS row_num",
+              "FROM " + _annotation_table() + " a",
+              "JOIN " + AnnotationBatch._meta.db_table + " b",
+              "ON b.id = a.batch_id",
+              pairs_join,
+              where + ") AS ranked",
+        "WHERE row_num = 1"])
+
+    params = ([empty_value_id] + hidden_params + hidden_params +
+              pairs_params + where_params)
+    return (sql, params)
+
+#############################################################################
+
+def in_list_sql(column, values):
+    """ Return an SQL condition checking that a column is in a list of values.
+
+        The returned condition has one "%s" placeholder for each value.  Note
+        that if the list of values is empty, the condition is always false.
+    """
+    if len(values) == 0:
+        return "1 = 0"
+    return column + " IN (" + ", ".join(["%s"] * len(values)) + ")"
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The prefix for the name of the table used to collect the results of a
+# chunked rebuild.  A random suffix is added to this for each rebuild.
+
+_STAGING_TABLE_PREFIX = "shared_currentannotation_rebuild_"
+
+#############################################################################
+
+def _annotation_table():
+    return Annotation._meta.db_table
+
+
+def _current_table():
+    return CurrentAnnotation._meta.db_table
+
+#############################################################################
+
+def _account_ranges(table, chunk_size):
+    """ Split up the account IDs used by the given table into ranges.
+
+        We return a list of (min_account_id, max_account_id) tuples covering
+        every account ID in the given table's "account_id" column (or "id"
+        column for the Account table itself), with each range covering
+        'chunk_size' account IDs.
+    """
+    if table == Account._meta.db_table:
+        column = "id"
+    else:
+        column = "account_id"
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT MIN(" + column + "), MAX(" + column + ") FROM " +
+                   table)
+    min_account_id,max_account_id = cursor.fetchone()
+
+    ranges = []
+    if min_account_id != None:
+        chunk_size = max(1, chunk_size)
+        for start in range(min_account_id, max_account_id + 1, chunk_size):
+            ranges.append((start, start + chunk_size - 1))
+    return ranges
+
+#############################################################################
+
+def _get_high_water_mark():
+    """ Return the current high-water mark for the Annotation table.
+
+        We return a (last_annotation_id, last_hidden_at) tuple, where
+        'last_annotation_id' is the highest Annotation record ID (or zero if
+        there are no annotations), and 'last_hidden_at' is the latest time at
+        which an annotation was hidden (or None if no annotations have been
+        hidden).
+
+        Record IDs and "hidden_at" timestamps are allocated before the changes
+        are committed, so an upload or hide which is still in progress may
+        hold a lower record ID or an earlier timestamp than one which has
+        already been committed.  Under PostgreSQL, we wait for any such
+        changes to finish by briefly locking the Annotation table, so that
+        every change covered by the returned high-water mark has been
+        committed and won't be skipped by the next incremental update.
+    """
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            cursor = connection.cursor()
+            cursor.execute("LOCK TABLE " + _annotation_table() +
+                           " IN SHARE MODE")
+        results = Annotation.objects.aggregate(Max("id"), Max("hidden_at"))
+
+    return (results['id__max'] or 0, results['hidden_at__max'])
+
+#############################################################################
+
+def _record_high_water_mark(last_annotation_id, last_hidden_at,
+                            rewritten=False):
+    """ Store the given high-water mark into the CurrentAnnotationMark table.
+
+        If 'rewritten' is True, the CurrentAnnotation table has been rewritten
+        from scratch, so we increment the generation number as well.
+    """
+    mark = CurrentAnnotationMark.objects.first()
+    if mark == None:
+        mark = CurrentAnnotationMark()
+    mark.last_annotation_id = last_annotation_id
+    mark.last_hidden_at     = last_hidden_at
+    mark.recorded_at        = datetime.datetime.utcnow().replace(tzinfo=utc)
+    if rewritten:
+        mark.generation = mark.generation + 1
+    mark.save()
+
+
+def _bump_generation():
+    """ Increment the generation number in the CurrentAnnotationMark table.
+
+        If there is no high-water mark yet, we record one which covers none of
+        the annotations, so that the next incremental update recalculates
+        everything.
+    """
+    mark = CurrentAnnotationMark.objects.first()
+    if mark == None:
+        mark = CurrentAnnotationMark()
+        mark.last_annotation_id = 0
+        mark.last_hidden_at     = None
+    mark.recorded_at = datetime.datetime.utcnow().replace(tzinfo=utc)
+    mark.generation  = mark.generation + 1
+    mark.save()
+
+#############################################################################
+
+def _rebuild_chunk(chunk):
+    """ Calculate the current values for a single chunk of accounts.
+
+        'chunk' is a (min_account_id, max_account_id, empty_value_id,
+        staging_table) tuple.  The calculated values are stored into the given
+        staging table.
+
+        Note that this is called within the worker processes, so it takes a
+        single tuple to make it easy to use with multiprocessing.Pool.map().
+    """
+    min_account_id,max_account_id,empty_value_id,staging_table = chunk
+
+    sql,params = latest_values_sql(empty_value_id,
+                                   min_account_id, max_account_id)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO " + staging_table +
+                       " (account_id, key_id, value_id) " + sql, params)
+
+#############################################################################
+
+def _verify_chunk(chunk):
+    """ Check the CurrentAnnotation records for a single chunk of accounts.
+
+        'chunk' is a (min_account_id, max_account_id, empty_value_id, fix,
+        report) tuple, as set up by verify().  We return a dictionary with the
+        number of pairs checked and the number of mismatches of each kind.
+
+        The mismatches to fix are collected as we go, and fixed in a separate
+        transaction once we have finished reading through the chunk.  The
+        recalculation uses the latest annotations, so this is safe even if
+        the annotations have changed in the meantime.
+    """
+    min_account_id,max_account_id,empty_value_id,fix,report = chunk
+
+    expected_sql,expected_params = latest_values_sql(empty_value_id,
+                                                     min_account_id,
+                                                     max_account_id)
+    expected_sql = ("SELECT * FROM (" + expected_sql + ") AS expected " +
+                    "ORDER BY 1, 2")
+
+    actual_sql = ("SELECT account_id, key_id, value_id, id FROM " +
+                  _current_table() + " WHERE account_id BETWEEN %s AND %s " +
+                  "ORDER BY account_id, key_id")
+    actual_params = [min_account_id, max_account_id]
+
+    results = {'checked' : 0,
+               'missing' : 0,
+               'extra'   : 0,
+               'wrong'   : 0}
+
+    to_recalculate = set() # Set of (account_id, key_id) tuples.
+    to_delete      = []    # List of CurrentAnnotation record IDs.
+
+    with transaction.atomic():
+        expected_rows = streamingQueries.stream_rows("verify_expected",
+                                                     expected_sql,
+                                                     expected_params)
+        actual_rows   = streamingQueries.stream_rows("verify_actual",
+                                                     actual_sql,
+                                                     actual_params)
+
+        expected = next(expected_rows, None)
+        actual   = next(actual_rows, None)
+
+        while expected != None or actual != None:
+            if actual == None or (expected != None and
+                                  expected[:2] < actual[:2]):
+                mismatch = ("missing", expected[0], expected[1],
+                            expected[2], None)
+                to_recalculate.add(expected[:2])
+                results['checked'] += 1
+                expected = next(expected_rows, None)
+            elif expected == None or actual[:2] < expected[:2]:
+                mismatch = ("extra", actual[0], actual[1], None, actual[2])
+                to_delete.append(actual[3])
+                actual = next(actual_rows, None)
+            else:
+                if expected[2] != actual[2]:
+                    mismatch = ("wrong", expected[0], expected[1],
+                                expected[2], actual[2])
+                    to_recalculate.add(expected[:2])
+                else:
+                    mismatch = None
+                results['checked'] += 1
+                expected = next(expected_rows, None)
+                actual   = next(actual_rows, None)
+
+            if mismatch != None:
+                results[mismatch[0]] += 1
+                if report != None:
+                    report(mismatch)
+
+    if fix and (to_delete or to_recalculate):
+        with transaction.atomic():
+            if to_delete:
+                # The deletions aren't recorded as AnnotationChanges.
+                CurrentAnnotation.objects.filter(id__in=to_delete).delete()
+                _bump_generation()
+            if to_recalculate:
+                helpers.recalc_current_annotations(to_recalculate)
+        searchCache.clear()
+        bitmapIndex.changed()
+
+    return results
+
+#############################################################################
+
+def _create_staging_table(staging_table):
+    """ Create an empty staging table to collect the rebuilt values.
+    """
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE " + staging_table + " (" +
+                   "account_id integer NOT NULL, " +
+                   "key_id integer NOT NULL, " +
+                   "value_id integer NOT NULL)")
+
+
+def _drop_staging_table(staging_table):
+    """ Drop the given staging table, if it exists.
+    """
+    cursor = connection.cursor()
+    cursor.execute("DROP TABLE IF EXISTS " + staging_table)
+
+#############################################################################
+
+def _lock_current_annotations(cursor):
+    """ Stop anyone else changing the CurrentAnnotation table.
+
+        Under PostgreSQL, this blocks other writers until the current
+        transaction finishes, while still allowing the table to be read.
+    """
+    if connection.vendor == "postgresql":
+        cursor.execute("LOCK TABLE " + _current_table() +
+                       " IN EXCLUSIVE MODE")
@@ -0,0 +1,280 @@
+""" annotationDatabase.shared.lib.interning
+
+    This module maps account addresses, annotation keys and annotation values
+    to the record IDs of the matching Account, AnnotationKey and
+    AnnotationValue records.
+
+    These lookups happen constantly: every annotation that is added, hidden or
+    searched for involves looking up its account, key and value.  The set of
+    annotation keys is small and the same annotation values are used over and
+    over again, so we keep a bounded LRU cache of the record IDs we have seen
+    in each process, and only go to the database when we encounter a string we
+    don't already know about.
+
+    Keeping these caches correct across multiple server processes relies on
+    the following:
+
+      * AnnotationKey and AnnotationValue records are never changed or deleted
+        once they have been created, so a cached key or value ID remains valid
+        forever.
+
+      * We never cache a negative result.  If a string isn't in the database,
+        we look for it again next time, as another process may have added it
+        in the meantime.
+
+      * Account records can be deleted.  We drop deleted accounts from this
+        process's cache straight away, and any other process still holding a
+        stale account ID will fail the foreign key check when it tries to use
+        that ID.  Callers which write to the database should call clear() and
+        try again if this happens.
+
+    Note that annotation keys and values are case-insensitive, so we key our
+    caches on the normalized version of each key and value, as calculated by
+    the AnnotationKey.normalize() and AnnotationValue.normalize() methods.
+"""
+from django.conf              import settings
+from django.db.models.signals import post_delete
+
+from annotationDatabase.shared.models       import *
+from annotationDatabase.shared.lib.lruCache import LRUCache
+
+#############################################################################
+
+def get_account_ids(addresses, create=True):
+    """ Return the record IDs for the given set of Ripple accounts.
+
+        'addresses' should be a list of account addresses.  We return a
+        dictionary mapping each address to the record ID of the Account record
+        for that address.  If 'create' is True, any missing Account records
+        will be created.  Otherwise, any addresses which don't have an Account
+        record will be left out of the returned dictionary.
+    """
+    wanted = {} # Maps address to address.
+    for address in addresses:
+        wanted[address] = address
+
+    return _get_ids(_account_cache(), Account, "address", wanted, create)
+
+#############################################################################
+
+def get_key_ids(keys, create=True):
+    """ Return the record IDs for the given set of annotation keys.
+
+        'keys' should be a list of annotation keys.  We return a dictionary
+        mapping the normalized version of each key to the record ID of the
+        AnnotationKey record for that key.  If 'create' is True, any missing
+        AnnotationKey records will be created.  Otherwise, any keys which don't
+        exist will be left out of the returned dictionary.
+    """
+    return _get_ids(_key_cache(), AnnotationKey, "key",
+                    _normalize(AnnotationKey, keys), create)
+
+#############################################################################
+
+def get_value_ids(values, create=True):
+    """ Return the record IDs for the given set of annotation values.
+
+        'values' should be a list of annotation values.  We return a
+        dictionary mapping the normalized version of each value to the record
+        ID of the AnnotationValue record for that value.  If 'create' is True,
+        any missing AnnotationValue records will be created.  Otherwise, any
+        values which don't exist will be left out of the returned dictionary.
+    """
+    return _get_ids(_value_cache(), AnnotationValue, "value",
+                    _normalize(AnnotationValue, values), create)
+
+#############################################################################
+
+def get_account_id(address, create=False):
+    """ Return the record ID for a single Ripple account.
+
+        We return None if there is no Account record for the given address,
+        and 'create' is False.
+    """
+    return get_account_ids([address], create).get(address)
+
+#############################################################################
+
+def get_key_id(key, create=False):
+    """ Return the record ID for a single annotation key.
+
+        We return None if there is no AnnotationKey record for the given key,
+        and 'create' is False.
+    """
+    return get_key_ids([key], create).get(AnnotationKey.normalize(key))
+
+#############################################################################
+
+def get_value_id(value, create=False):
+    """ Return the record ID for a single annotation value.
+
+        We return None if there is no AnnotationValue record for the given
+        value, and 'create' is False.
+    """
+    return get_value_ids([value], create).get(
+                                            AnnotationValue.normalize(value))
+
+#############################################################################
+
+def clear():
+    """ Throw away everything we have cached in this process.
+
+        This should be called whenever a transaction which may have created
+        new Account, AnnotationKey or AnnotationValue records is rolled back,
+        or a stale record ID is detected.
+    """
+    for cache in _caches.values():
+        cache.clear()
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our per-process caches, indexed by model name.  These are created as they
+# are required.
+
+_caches = {}
+
+#############################################################################
+
+def _get_cache(name):
+    """ Return the LRUCache with the given name, creating it if necessary.
+    """
+    if name not in _caches:
+        _caches[name] = LRUCache(settings.INTERN_CACHE_SIZE)
+    return _caches[name]
+
+
+def _account_cache():
+    return _get_cache("Account")
+
+
+def _key_cache():
+    return _get_cache("AnnotationKey")
+
+
+def _value_cache():
+    return _get_cache("AnnotationValue")
+
+#############################################################################
+
+def _normalize(model, strings):
+    """ Return a dictionary mapping normalized strings to original strings.
+
+        We use the given model's normalize() method to normalize each string.
+        If the same string appears more than once in different forms, the
+        first form we encounter is used.
+    """
+    wanted = {}
+    for s in strings:
+        wanted.setdefault(model.normalize(s), s)
+    return wanted
+
+#############################################################################
+
+def _get_ids(cache, model, field, wanted, create):
+    """ Return the record IDs for a set of strings, using the given cache.
+
+        The parameters are as follows:
+
+            'cache'
+
+                The LRUCache to use for this model.
+
+            'model'
+
+                The Django model class to look up.
+
+            'field'
+
+                The name of the unique text field within that model to match
+                against.
+
+            'wanted'
+
+                A dictionary mapping the normalized version of each string to
+                look for to the string itself.  The normalized version is used
+                as the cache key, and is what we return.
+
+            'create'
+
+                If True, any missing records will be created.
+
+        We return a dictionary mapping the normalized version of each string to
+        the record ID of the matching record.
+    """
+    ids     = {}
+    missing = {}
+    for normalized,s in wanted.items():
+        id = cache.get(normalized)
+        if id != None:
+            ids[normalized] = id
+        else:
+            missing[normalized] = s
+
+    if missing:
+        found = _load_ids(model, field, missing)
+        for normalized,id in found.items():
+            ids[normalized] = id
+            cache.set(normalized, id)
+            del missing[normalized]
+
+    if missing and create:
+        # Note that bulk_create() doesn't call the model's save() method, so we
+        # have to fill in the normalized (and any other derived) fields
+        # ourselves.
+        new_records = []
+        for s in missing.values():
+            record = model(**{field : s})
+            if model != Account:
+                record.update_derived_fields()
+            new_records.append(record)
+        model.objects.bulk_create(new_records)
+        found = _load_ids(model, field, missing)
+        for normalized,id in found.items():
+            ids[normalized] = id
+            cache.set(normalized, id)
+
+    return ids
+
+#############################################################################
+
+def _load_ids(model, field, wanted):
+    """ Load the record IDs for a set of strings from the database.
+
+        'wanted' is a dictionary mapping normalized strings to the original
+        strings to look for.  We return a dictionary mapping each normalized
+        string to the record ID of the matching record, for those strings
+        which exist in the database.
+
+        Note that account addresses are matched exactly, while annotation keys
+        and values are matched against their indexed normalized field.  If
+        more than one record has the same normalized string, we use the oldest
+        one.
+    """
+    if model == Account:
+        normalized_field = field
+    else:
+        normalized_field = "normalized_" + field
+
+    query = model.objects.filter(**{normalized_field + "__in" : wanted.keys()})
+
+    ids = {}
+    for id,normalized in query.order_by("id").values_list("id",
+                                                          normalized_field):
+        ids.setdefault(normalized, id)
+    return ids
+
+#############################################################################
+
+def _account_deleted(sender, instance, **kwargs):
+    """ Signal handler called whenever an Account record is deleted.
+
+        We remove the deleted account from this process's cache.
+    """
+    if "Account" in _caches:
+        _caches["Account"].remove(instance.address)
+
+post_delete.connect(_account_deleted, sender=Account)
@@ -23,16 +23,46 @@
         <=
         >=
         !=
+        ~
+        %
+
+    The "~" comparison is a wildcard match: the value is a pattern where "*"
+    matches any sequence of characters and "?" matches any single character,
+    so "name ~ 'bitst*'" matches every name starting with "bitst".  The "%"
+    comparison is a fuzzy match, finding values which are similar to the
+    given value.  Exactly how similar the values need to be is up to the
+    converter function which compiles the expression.
 
     We provide a function for parsing a string into a LogicalExpression object.
     The LogicalExpression object can then be converted back to a string for
     display, or it can be used to build a Django database query.  You can also
     retrieve a list of the variables used in a LogicalExpression object.
+
+    As well as building a Django query which filters a single set of records,
+    a LogicalExpression can be compiled into an SQL statement which treats
+    each simple expression as a separate set of IDs, and combines these sets
+    using INTERSECT, UNION and EXCEPT.  This lets a single search match
+    against several different records belonging to the same object, such as
+    the various annotations for a single account.  In the same way, a
+    LogicalExpression can be evaluated directly against in-memory sets of IDs.
+
+    The parser's grammar is only built once in each process, and the most
+    recently parsed expressions are kept in an LRU cache, so parsing the same
+    string again doesn't involve pyparsing at all.  The size of this cache is
+    set by the SEARCH_PARSE_CACHE_SIZE setting.  Note that LogicalExpression
+    objects are never changed once they have been created, so it is safe to
+    share them in this way.
 """
+import re
+import threading
+
+from django.conf      import settings
 from django.db.models import Q
 
 import pyparsing as pp
 
+from annotationDatabase.shared.lib.lruCache import LRUCache
+
 #############################################################################
 
 def parse(s):
@@ -45,11 +75,107 @@ def parse(s):
         parsed logical expression, or None if the expression could not be
         parsed.
     """
+    global _parse_cache
+
+    if _parse_cache == None:
+        _parse_cache = LRUCache(settings.SEARCH_PARSE_CACHE_SIZE)
+
+    expression = _parse_cache.get(s, _NOT_CACHED)
+    if expression is _NOT_CACHED:
+        with _parse_lock:
+            try:
+                results = _get_grammar().parseString(s, parseAll=True)
+            except pp.ParseException:
+                results = None
+
+        if results == None:
+            expression = None
+        else:
+            expression = results.asList()[0]
+
+        _parse_cache.set(s, expression)
+
+    return expression
+
+#############################################################################
+
+def wildcard_to_regex(pattern):
+    """ Convert a wildcard pattern into an equivalent regular expression.
+
+        In the wildcard pattern, "*" matches any sequence of characters and
+        "?" matches any single character.  The returned regular expression
+        must match the entire string.
+    """
+    regex = []
+    for ch in pattern:
+        if ch == "*":
+            regex.append(".*")
+        elif ch == "?":
+            regex.append(".")
+        else:
+            regex.append(re.escape(ch))
+    return "^" + "".join(regex) + "$"
+
+#############################################################################
+
+def wildcard_to_like(pattern):
+    """ Convert a wildcard pattern into an equivalent SQL LIKE pattern.
+
+        In the wildcard pattern, "*" matches any sequence of characters and
+        "?" matches any single character.  Any "%", "_" or backslash
+        characters in the pattern are escaped using a backslash, so the
+        returned pattern should be used with "ESCAPE '\\'".
+    """
+    like = []
+    for ch in pattern:
+        if ch == "*":
+            like.append("%")
+        elif ch == "?":
+            like.append("_")
+        elif ch in ["%", "_", "\\"]:
+            like.append("\\" + ch)
+        else:
+            like.append(ch)
+    return "".join(like)
+
+#############################################################################
+#                                                                           #
+#                   I N T E R N A L   D E F I N I T I O N S                 #
+#                                                                           #
+#############################################################################
+
+# Our compiled grammar, LRU cache of parsed expressions, and a lock to stop
+# more than one thread using the grammar at once.  These are created as they
+# are required.
+
+_grammar      = None
+_parse_cache  = None
+_parse_lock   = threading.Lock()
+_NOT_CACHED   = object()
+
+#############################################################################
+
+def _get_grammar():
+    """ Return the pyparsing grammar used to parse logical expressions.
+
+        The grammar is built the first time this function is called, and then
+        reused from then on.  We also enable pyparsing's "packrat" parsing
+        mode, which stops pyparsing from repeatedly parsing the same part of
+        the string as it works through the operators in the grammar.
+    """
+    global _grammar
+
+    if _grammar != None:
+        return _grammar
+
+    pp.ParserElement.enablePackrat()
+
     variable = pp.Word(pp.alphas+"_", pp.alphanums+"_")
 
     comparison_op = (pp.Literal('<=') | pp.Literal('<') |
                      pp.Literal('>=') | pp.Literal('>') |
-                     pp.Literal('!=') | pp.Literal('='))
+                     pp.Literal('!=') | pp.Literal('=') |
+                     pp.Literal('~')  | pp.Literal('%'))
 
     value = pp.quotedString
 
@@ -68,17 +194,8 @@ def parse(s):
                                    (op_or,  2, pp.opAssoc.LEFT,
                                                make_complex_expression)])
 
-    try:
-        results = expression.parseString(s, parseAll=True)
-    except pp.ParseException:
-        return None
-    return results.asList()[0]
-
-#############################################################################
-#                                                                           #
-#                   I N T E R N A L   D E F I N I T I O N S                 #
-#                                                                           #
-#############################################################################
+    _grammar = expression
+    return _grammar
 
 def make_simple_expression(s, loc, tokens):
     """ This parse action is used to build a SimpleExpression object.
@@ -108,6 +225,22 @@ def make_negation_expression(s, loc, tokens):
 
 #############################################################################
 
+def _combine_sql(left, operator, right):
+    """ Combine two (sql, params) tuples using the given set operator.
+
+        'operator' should be one of "INTERSECT", "UNION" or "EXCEPT".  Each
+        SQL statement is wrapped in a sub-query, as not all databases allow
+        the operands of a set operator to be parenthesized.
+    """
+    left_sql,left_params   = left
+    right_sql,right_params = right
+
+    sql = ("SELECT id FROM (" + left_sql + ") AS l " + operator +
+           " SELECT id FROM (" + right_sql + ") AS r")
+    return (sql, left_params + right_params)
+
+#############################################################################
+
 class LogicalExpression(object):
     """ The base class for all expression objects.
 
@@ -121,6 +254,18 @@ class LogicalExpression(object):
         raise RuntimeError("Must be overridden")
 
 
+    def to_signature(self):
+        """ Return an unambiguous representation of the LogicalExpression.
+
+            Unlike to_string(), which doesn't escape quotes within the values,
+            this returns a nested tuple built from the variables, comparisons,
+            values and logical operators in the expression.  Two expressions
+            have the same signature only if they are the same expression, so
+            the signature can be used as (part of) a cache key.
+        """
+        raise RuntimeError("Must be overridden")
+
+
     def to_django_query(self, converter=None):
         """ Convert the LogicalExpression into a Django search query.
 
@@ -175,11 +320,83 @@ class LogicalExpression(object):
         raise RuntimeError("Must be overridden")
 
 
+    def to_sql(self, converter, universe):
+        """ Convert the LogicalExpression into an SQL statement.
+
+            The parameters are as follows:
+
+                'converter'
+
+                    A callable object which converts a simple expression into
+                    an SQL statement.  This should look like this:
+
+                        myConverter(variable, comparison, value)
+
+                    where the parameters are the same as for the converter
+                    passed to to_django_query(), above.  Upon completion, your
+                    converter function should return an (sql, params) tuple,
+                    where 'sql' is an SQL SELECT statement returning a single
+                    column named "id" holding the IDs of the objects which
+                    match the simple expression, and 'params' is a list of
+                    parameters to pass along with the SQL statement.
+
+                'universe'
+
+                    An (sql, params) tuple holding an SQL SELECT statement
+                    which returns the IDs of every object which can be
+                    searched for, again as a single column named "id".  This
+                    is used to calculate the objects which do not match a
+                    negation expression.
+
+            Upon completion, we return an (sql, params) tuple, where 'sql' is
+            an SQL SELECT statement returning the IDs of the objects which
+            match this logical expression, again as a single column named
+            "id", and 'params' is a list of parameters to pass along with the
+            SQL statement.
+        """
+        raise RuntimeError("Must be overridden")
+
+
+    def to_set(self, converter, universe):
+        """ Evaluate the LogicalExpression against in-memory sets of IDs.
+
+            The parameters are as follows:
+
+                'converter'
+
+                    A callable object which returns the set of IDs matching a
+                    simple expression.  This takes the same parameters as the
+                    converter passed to to_django_query(), above, and should
+                    return a Python set (or set-like object) holding the IDs
+                    of the objects which match the simple expression.
+
+                'universe'
+
+                    A set holding the IDs of every object which can be searched
+                    for.  This is used to calculate the objects which do not
+                    match a negation expression.
+
+            Upon completion, we return a set holding the IDs of the objects
+            which match this logical expression.
+        """
+        raise RuntimeError("Must be overridden")
+
+
     def get_variables(self):
         """ Return a list of the variables in this logical expression.
         """
         raise RuntimeError("Must be overridden")
 
+
+    def has_negation(self):
+        """ Return True if this logical expression includes a "not" operator.
+
+            The results of a negated expression depend on the entire universe
+            of objects being searched, not just on the objects which have the
+            expression's variables.
+        """
+        raise RuntimeError("Must be overridden")
+
     # =========================
     # == CONVENIENCE METHODS ==
     # =========================
@@ -202,7 +419,7 @@ class SimpleExpression(LogicalExpression):
     def __init__(self, variable, comparison, value):
         """ Standard initialiser.
         """
-        if comparison not in ["=", "<", ">", "<=", ">=", "!="]:
+        if comparison not in ["=", "<", ">", "<=", ">=", "!=", "~", "%"]:
             raise RuntimeError("Unsupported comparison: " + comparison)
 
         self._variable   = variable
@@ -216,6 +433,12 @@ class SimpleExpression(LogicalExpression):
         return "%s %s '%s'" % (self._variable, self._comparison, self._value)
 
 
+    def to_signature(self):
+        """ Implement LogicalExpression.to_signature().
+        """
+        return ("simple", self._variable, self._comparison, self._value)
+
+
     def to_django_query(self, converter=None):
         """ Implement LogicalExpression.to_django_query().
         """
@@ -243,6 +466,15 @@ class SimpleExpression(LogicalExpression):
             elif self._comparison == "!=":
                 args   = {self._variable : self._value}
                 negate = True
+            elif self._comparison == "~":
+                args   = {self._variable + "__iregex" :
+                                            wildcard_to_regex(self._value)}
+                negate = False
+            elif self._comparison == "%":
+                # There's no fuzzy match lookup in Django, so we fall back to
+                # a substring match.
+                args   = {self._variable + "__icontains" : self._value}
+                negate = False
 
             result = Q(**args)
             if negate:
@@ -251,11 +483,29 @@ class SimpleExpression(LogicalExpression):
             return result
 
 
+    def to_sql(self, converter, universe):
+        """ Implement LogicalExpression.to_sql().
+        """
+        return converter(self._variable, self._comparison, self._value)
+
+
+    def to_set(self, converter, universe):
+        """ Implement LogicalExpression.to_set().
+        """
+        return converter(self._variable, self._comparison, self._value)
+
+
     def get_variables(self):
         """ Implement LogicalExpression.get_variables().
         """
         return [self._variable]
 
+
+    def has_negation(self):
+        """ Implement LogicalExpression.has_negation().
+        """
+        return False
+
 #############################################################################
 
 class ComplexExpression(LogicalExpression):
@@ -294,6 +544,14 @@ class ComplexExpression(LogicalExpression):
                                  self._right_expression.to_string())
 
 
+    def to_signature(self):
+        """ Implement LogicalExpression.to_signature().
+        """
+        return (self._logical_operator,
+                self._left_expression.to_signature(),
+                self._right_expression.to_signature())
+
+
     def to_django_query(self, converter=None):
         """ Implement LogicalExpression.to_django_query().
         """
@@ -306,6 +564,30 @@ class ComplexExpression(LogicalExpression):
             return left_filter | right_filter
 
 
+    def to_sql(self, converter, universe):
+        """ Implement LogicalExpression.to_sql().
+        """
+        left_sql  = self._left_expression.to_sql(converter, universe)
+        right_sql = self._right_expression.to_sql(converter, universe)
+
+        if self._logical_operator == "and":
+            return _combine_sql(left_sql, "INTERSECT", right_sql)
+        elif self._logical_operator == "or":
+            return _combine_sql(left_sql, "UNION", right_sql)
+
+
+    def to_set(self, converter, universe):
+        """ Implement LogicalExpression.to_set().
+        """
+        left_set  = self._left_expression.to_set(converter, universe)
+        right_set = self._right_expression.to_set(converter, universe)
+
+        if self._logical_operator == "and":
+            return left_set & right_set
+        elif self._logical_operator == "or":
+            return left_set | right_set
+
+
     def get_variables(self):
         """ Implement LogicalExpression.get_variables().
         """
@@ -314,6 +596,13 @@ class ComplexExpression(LogicalExpression):
         variables.extend(self._right_expression.get_variables())
         return variables
 
+
+    def has_negation(self):
+        """ Implement LogicalExpression.has_negation().
+        """
+        return (self._left_expression.has_negation() or
+                self._right_expression.has_negation())
+
 #############################################################################
 
 class NegationExpression(LogicalExpression):
@@ -335,6 +624,12 @@ class NegationExpression(LogicalExpression):
         return "not (%s)" % self._expression.to_string()
 
 
+    def to_signature(self):
+        """ Implement LogicalExpression.to_signature().
+        """
+        return ("not", self._expression.to_signature())
+
+
     def to_django_query(self, converter=None):
         """ Implement LogicalExpression.to_django_query().
         """
@@ -342,8 +637,27 @@ class NegationExpression(LogicalExpression):
         return ~filter
 
 
+    def to_sql(self, converter, universe):
+        """ Implement LogicalExpression.to_sql().
+        """
+        return _combine_sql(universe, "EXCEPT",
+                            self._expression.to_sql(converter, universe))
+
+
+    def to_set(self, converter, universe):
+        """ Implement LogicalExpression.to_set().
+        """
+        return universe - self._expression.to_set(converter, universe)
+
+
     def get_variables(self):
         """ Implement LogicalExpression.get_variables().
         """
         return self._expression.get_variables()
 
+
+    def has_negation(self):
+        """ Implement LogicalExpression.has_negation().
+        """
+        return True
+
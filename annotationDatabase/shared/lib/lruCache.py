@@ -0,0 +1,83 @@
+""" annotationDatabase.shared.lib.lruCache
+
+    This module implements a simple, bounded "least recently used" cache.
+
+    An LRUCache object holds up to a given number of entries, mapping keys to
+    values.  Whenever an entry is added to a full cache, the entry which has
+    gone the longest without being used is thrown away to make room for it.
+
+    The cache is safe to use from multiple threads within a single process.
+    Note that each process has its own copy of the cache, so the cache should
+    only be used to hold values which can be safely shared between processes
+    or which are validated when they are used.
+"""
+import collections
+import threading
+
+#############################################################################
+
+class LRUCache(object):
+    """ A bounded least-recently-used cache.
+    """
+    def __init__(self, max_size):
+        """ Standard initialiser.
+
+            'max_size' is the maximum number of entries to hold in the cache.
+        """
+        self._max_size = max(1, max_size)
+        self._entries  = collections.OrderedDict()
+        self._lock     = threading.Lock()
+
+
+    def get(self, key, default=None):
+        """ Return the cached value for the given key.
+
+            If there is no entry in the cache for the given key, we return the
+            supplied default value.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+
+    def set(self, key, value):
+        """ Store the given value into the cache.
+
+            If the cache is full, the least recently used entry will be thrown
+            away.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+    def remove(self, key):
+        """ Remove the entry with the given key, if it exists.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self):
+        """ Remove all the entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    # =========================
+    # == CONVENIENCE METHODS ==
+    # =========================
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
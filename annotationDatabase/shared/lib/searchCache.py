@@ -0,0 +1,253 @@
+""" annotationDatabase.shared.lib.searchCache
+
+    This module implements an optional cache of search results.
+
+    The same search queries tend to be made over and over again, so we can
+    save a lot of work by remembering the results of each search until the
+    annotations it depends on have changed.  The cache is enabled by setting
+    SEARCH_CACHE_TIMEOUT to the maximum number of seconds a result should be
+    kept for; the results are stored in the Django cache named "search", which
+    can be configured using the SEARCH_CACHE_BACKEND and SEARCH_CACHE_LOCATION
+    settings.  Note that when more than one server process is running, this
+    needs to be a cache which is shared between the processes (for example,
+    memcached), or else changes made by one process won't invalidate the
+    results cached by the others.
+
+    Rather than deleting cached results when the annotations change, we keep
+    a "generation number" for each annotation key, and include the current
+    generation number for each key used by a search query in that query's
+    cache key.  Changing the current value of an annotation bumps the
+    generation number for that annotation's key, so any cached search results
+    which used that key are simply never looked up again, while searches which
+    only use other keys are unaffected.
+
+    Searches which include a "not" operator also depend on the set of all
+    accounts which have annotations, so these use an additional "universe"
+    generation number which is bumped whenever an account gains a current
+    value for a key it didn't have one for before.
+
+    The generation numbers only track changes to the current annotation
+    values, so searches of the annotation values as of a moment in the past
+    are never cached: hiding an annotation or adding one to an older batch
+    can change those values without changing any current value.
+
+    To avoid caching results which were read just before a change was
+    committed, changes made within a transaction are only recorded once the
+    transaction has finished.  The code making the changes should call
+    flush() once the transaction has been committed.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf       import settings
+from django.core.cache import get_cache
+from django.db         import connection
+
+from annotationDatabase.shared.models import AnnotationKey
+from annotationDatabase.shared.lib    import interning
+
+#############################################################################
+
+def is_enabled():
+    """ Return True if the search cache has been enabled in our settings.
+    """
+    return settings.SEARCH_CACHE_TIMEOUT > 0
+
+#############################################################################
+
+def make_key(expression, args):
+    """ Calculate the cache key to use for the given search.
+
+        'expression' is the LogicalExpression being searched for, and 'args'
+        is a tuple holding the other search parameters (page number, results
+        per page, etc) which affect the search results.
+
+        We return the cache key, or None if the search can't be cached.  Note
+        that we can't cache the results of a search which uses an annotation
+        key which doesn't exist yet, as we have no generation number to
+        invalidate it with when that key is created.
+
+        The cache key should be calculated before the search is run, and the
+        same key used to store the results, so that a change made while the
+        search is running will invalidate the results.
+    """
+    if not is_enabled():
+        return None
+
+    variables = set([AnnotationKey.normalize(variable)
+                     for variable in expression.get_variables()])
+
+    key_ids = interning.get_key_ids(variables, create=False)
+    if len(key_ids) < len(variables):
+        return None # Uses a key which doesn't exist yet.
+
+    names = ["all"]
+    for key_id in sorted(key_ids.values()):
+        names.append("key-%d" % key_id)
+    if expression.has_negation():
+        names.append("universe")
+
+    generations = _get_generations(names)
+
+    signature = repr((expression.to_signature(), args,
+                      [generations[name] for name in names]))
+    return "search-" + hashlib.sha1(signature).hexdigest()
+
+#############################################################################
+
+def get(cache_key):
+    """ Return the cached results for a search, if any.
+
+        'cache_key' is the cache key for the search, as returned by
+        make_key().  We return the cached search response, or None if the
+        results of this search have not been cached.
+    """
+    if cache_key == None:
+        return None
+
+    return _get_cache().get(cache_key)
+
+#############################################################################
+
+def put(cache_key, response):
+    """ Store the results of a search in the cache.
+
+        'cache_key' is the cache key for the search, as returned by
+        make_key(), and 'response' is the search response to cache.
+    """
+    if cache_key == None:
+        return
+
+    _get_cache().set(cache_key, response, settings.SEARCH_CACHE_TIMEOUT)
+
+#############################################################################
+
+def changed(key_ids, new_accounts=False):
+    """ Record that the current values for the given keys have changed.
+
+        'key_ids' should be a list or set of AnnotationKey record IDs.  If
+        'new_accounts' is True, at least one account may have gained a current
+        value for a key it didn't previously have a value for.
+
+        If we are within a transaction, the change is remembered until flush()
+        is called.  Otherwise, the cached results which depend on these keys
+        are invalidated straight away.
+    """
+    if not is_enabled():
+        return
+
+    pending = _pending()
+    pending['key_ids'].update(key_ids)
+    if new_accounts:
+        pending['universe'] = True
+
+    if not connection.in_atomic_block:
+        flush()
+
+#############################################################################
+
+def flush():
+    """ Invalidate the cached results affected by the changes made so far.
+
+        This should be called once the transaction which changed the current
+        annotations has been committed.
+    """
+    pending = _pending()
+    key_ids  = pending['key_ids']
+    universe = pending['universe']
+
+    pending['key_ids']  = set()
+    pending['universe'] = False
+
+    if not is_enabled():
+        return
+
+    for key_id in key_ids:
+        _bump("key-%d" % key_id)
+    if universe:
+        _bump("universe")
+
+#############################################################################
+
+def clear():
+    """ Invalidate every cached search result.
+
+        This should be called whenever the CurrentAnnotation table is rebuilt.
+    """
+    if not is_enabled():
+        return
+
+    _bump("all")
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The changes made within the current thread's transaction, which haven't
+# been flushed yet.
+
+_thread_data = threading.local()
+
+#############################################################################
+
+def _pending():
+    """ Return the dictionary of pending changes for the current thread.
+    """
+    if not hasattr(_thread_data, "pending"):
+        _thread_data.pending = {'key_ids'  : set(),
+                                'universe' : False}
+    return _thread_data.pending
+
+#############################################################################
+
+def _get_cache():
+    """ Return the Django cache used to hold our search results.
+    """
+    return get_cache("search")
+
+#############################################################################
+
+def _get_generations(names):
+    """ Return the current generation numbers with the given names.
+
+        We return a dictionary mapping each name to its generation number.
+        Any generation numbers which aren't in the cache yet (or have been
+        evicted from it) are started off at the current time, so that we
+        never go back to a generation number which was used before.
+    """
+    cache = _get_cache()
+
+    generations = {}
+    for name,generation in cache.get_many(["search-gen-" + name
+                                           for name in names]).items():
+        generations[name[len("search-gen-"):]] = generation
+
+    for name in names:
+        if name not in generations:
+            cache.add("search-gen-" + name, _initial_generation(), None)
+            generations[name] = cache.get("search-gen-" + name)
+
+    return generations
+
+#############################################################################
+
+def _bump(name):
+    """ Increment the generation number with the given name.
+    """
+    cache = _get_cache()
+
+    try:
+        cache.incr("search-gen-" + name)
+    except ValueError:
+        # The generation number isn't in the cache -> start it off again.
+        cache.set("search-gen-" + name, _initial_generation(), None)
+
+#############################################################################
+
+def _initial_generation():
+    """ Return the generation number to use for a new generation.
+    """
+    return int(time.time() * 1000)
@@ -0,0 +1,40 @@
+""" annotationDatabase.shared.lib.streamingQueries
+
+    This module lets us run SQL queries which return too many rows to hold in
+    memory at once.
+
+    Under PostgreSQL, we use a named (server-side) cursor, so the rows are
+    sent to us in batches as we read through them.  For other databases, we
+    fall back to fetching the rows a batch at a time from an ordinary cursor.
+"""
+from django.db import connection
+
+#############################################################################
+
+def stream_rows(name, sql, params, batch_size=2000):
+    """ Run the given SQL query, and yield the resulting rows one at a time.
+
+        'name' is the name to use for the server-side cursor, 'sql' and
+        'params' are the SQL query to run and the parameters to use for that
+        query, and 'batch_size' is the number of rows to fetch from the
+        database at once.  Each row is yielded as a tuple.
+
+        Note that a server-side cursor can only be used inside a transaction.
+    """
+    if connection.vendor == "postgresql":
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name=name)
+        cursor.itersize = batch_size
+    else:
+        cursor = connection.cursor()
+
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        cursor.close()
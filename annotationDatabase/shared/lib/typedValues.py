@@ -0,0 +1,102 @@
+""" annotationDatabase.shared.lib.typedValues
+
+    This module parses annotation values into numbers and dates.
+
+    All annotation values are stored as strings.  To let searches compare
+    values as numbers or dates rather than as text, each AnnotationValue record
+    also holds the value parsed as a number and as a date, where the value can
+    be parsed in this way.  The functions in this module do the parsing, so
+    that annotation values and search query values are parsed in exactly the
+    same way.
+"""
+import datetime
+import decimal
+import re
+
+from django.utils          import dateparse
+from django.utils.timezone import utc
+
+#############################################################################
+
+# The size of the numbers we can store.  Numbers are held as decimal values
+# with up to NUMBER_MAX_DIGITS digits, NUMBER_DECIMAL_PLACES of which come
+# after the decimal point.  These limits are the largest which all of the
+# supported databases can handle.
+
+NUMBER_MAX_DIGITS     = 65
+NUMBER_DECIMAL_PLACES = 30
+
+#############################################################################
+
+def parse_number(s):
+    """ Attempt to parse the given string as a number.
+
+        We accept integers and decimal numbers, with an optional sign and
+        exponent, for example "42", "-1.5" or "2.5e10".  Leading and trailing
+        whitespace is ignored.
+
+        We return the number as a decimal.Decimal object, so that large
+        numbers such as ledger amounts are held exactly rather than being
+        rounded to the nearest floating-point value.  We return None if the
+        string is not a number, or if the number is too large to be stored.
+    """
+    s = s.strip()
+    if not _NUMBER_RE.match(s):
+        return None
+
+    try:
+        number = decimal.Decimal(s)
+    except decimal.InvalidOperation:
+        return None
+
+    if abs(number) >= _MAX_NUMBER:
+        return None
+    return number
+
+#############################################################################
+
+def parse_date(s):
+    """ Attempt to parse the given string as a date or date/time value.
+
+        We accept ISO 8601 style dates such as "2014-05-01", and date/time
+        values such as "2014-05-01 10:30" or "2014-05-01T10:30:00Z".  Values
+        without a timezone are taken to be in UTC.  Leading and trailing
+        whitespace is ignored.
+
+        We return a timezone-aware datetime.datetime object, or None if the
+        string is not a date.
+    """
+    s = s.strip()
+
+    try:
+        timestamp = dateparse.parse_datetime(s)
+        if timestamp == None:
+            date = dateparse.parse_date(s)
+            if date != None:
+                timestamp = datetime.datetime(date.year, date.month, date.day)
+    except ValueError:
+        return None
+
+    if timestamp == None:
+        return None
+
+    if timestamp.tzinfo == None:
+        timestamp = timestamp.replace(tzinfo=utc)
+    return timestamp
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The regular expression used to check for a number.  We do this ourselves,
+# rather than relying on float(), so that values such as "nan" and "inf" are
+# not treated as numbers.
+
+_NUMBER_RE = re.compile(r"^[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$")
+
+# Numbers at least this large won't fit into the database.
+
+_MAX_NUMBER = decimal.Decimal(10) ** (NUMBER_MAX_DIGITS -
+                                      NUMBER_DECIMAL_PLACES)
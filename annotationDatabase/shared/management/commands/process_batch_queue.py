@@ -0,0 +1,101 @@
+""" annotationDatabase.shared.management.commands.process_batch_queue
+
+    This Python module implements the "process_batch_queue" management command
+    for the annotation database.  It works through the annotation batches which
+    have been queued to be stored in the background, storing the annotations
+    for each batch in turn.
+"""
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db                   import connection
+
+from annotationDatabase.shared.models import *
+
+from annotationDatabase.api import functions
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "process_batch_queue" management command.
+    """
+    args = None
+    help = 'Store the annotation batches queued for background processing.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--workers",
+                    type="int",
+                    default=1,
+                    help="The number of worker processes to run."),
+        make_option("--once",
+                    action="store_true",
+                    default=False,
+                    help="Exit once the queue is empty, rather than " +
+                         "waiting for more batches."),
+        make_option("--poll-interval",
+                    type="float",
+                    default=1.0,
+                    help="How long to wait, in seconds, before checking an " +
+                         "empty queue again."),
+        make_option("--resume",
+                    action="store_true",
+                    default=False,
+                    help="Before starting, return any batches whose " +
+                         "worker has died back to the queue.  Batches " +
+                         "still being processed are left alone."),
+    )
+
+    def handle(self, *args, **kwargs):
+        """ Run our management command.
+        """
+        if len(args) != 0:
+            self.stderr.write("This command takes no arguments.")
+            return
+
+        if kwargs['resume']:
+            # Batches interrupted partway through will pick up where they left
+            # off, as QueuedBatch.num_processed is updated with each chunk.
+            # Note that the workers will claim these batches anyway once the
+            # claim has expired; this just puts them back into the queue.
+            num_resumed = functions.requeue_abandoned_batches()
+            self.stdout.write("Resuming %d batch(es)." % num_resumed)
+
+        num_workers = max(1, kwargs['workers'])
+        once        = kwargs['once']
+        interval    = kwargs['poll_interval']
+
+        if num_workers == 1:
+            _run_worker(once, interval)
+        else:
+            # Each worker needs its own database connection, so we close ours
+            # before starting the worker processes.
+            connection.close()
+
+            workers = []
+            for i in range(num_workers):
+                worker = multiprocessing.Process(target=_run_worker,
+                                                 args=(once, interval))
+                worker.start()
+                workers.append(worker)
+
+            for worker in workers:
+                worker.join()
+
+        self.stdout.write("Done!")
+
+#############################################################################
+
+def _run_worker(once, interval):
+    """ Keep processing queued batches.
+
+        If 'once' is True, we return as soon as the queue is empty.  Otherwise,
+        we wait 'interval' seconds and then check the queue again.
+    """
+    while True:
+        if functions.process_queued_batch():
+            continue
+        if once:
+            break
+        time.sleep(interval)
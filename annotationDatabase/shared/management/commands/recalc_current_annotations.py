@@ -4,9 +4,11 @@
     command for the annotation database.  It allows a system administrator to
     rebuild the CurrentAnnotation table if it gets mucked up.
 """
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 
-from annotationDatabase.shared.models import *
+from annotationDatabase.shared.lib import currentAnnotations
 
 #############################################################################
 
@@ -16,6 +18,29 @@ class Command(BaseCommand):
     args = None
     help = 'Recalculate the list of CurrentAnnotation records.'
 
+    option_list = BaseCommand.option_list + (
+        make_option("--incremental",
+                    action="store_true",
+                    default=False,
+                    help="Only recalculate the annotations added or hidden " +
+                         "since the last time this command was run."),
+        make_option("--chunked",
+                    action="store_true",
+                    default=False,
+                    help="Rebuild the table in chunks of accounts, rather " +
+                         "than using a single SQL statement."),
+        make_option("--workers",
+                    type="int",
+                    default=1,
+                    help="The number of worker processes to use for a " +
+                         "chunked rebuild."),
+        make_option("--chunk-size",
+                    type="int",
+                    default=10000,
+                    help="The number of account IDs to include in each " +
+                         "chunk."),
+    )
+
     def handle(self, *args, **kwargs):
         """ Run our management command.
         """
@@ -23,46 +48,23 @@ class Command(BaseCommand):
             self.stderr.write("This command takes no arguments.")
             return
 
-        CurrentAnnotation.objects.all().delete()
-
-        annotations_to_recalculate = set() # Set of (account, key) tuples.
-
-        for annotation in Annotation.objects.all():
-            annotations_to_recalculate.add((annotation.account,
-                                            annotation.key))
-
-        for account,key in annotations_to_recalculate:
-            cur_value     = None # initially.
-            cur_timestamp = None # ditto.
-            for annotation in Annotation.objects.filter(account=account,
-                                                        key=key):
-                if annotation.hidden: continue
+        if kwargs['incremental']:
+            num_pairs = currentAnnotations.update_incrementally()
+            if num_pairs != None:
+                self.stdout.write("Recalculated %d current annotation(s)." %
+                                  num_pairs)
+                self.stdout.write("Done!")
+                return
+            self.stdout.write("No high-water mark has been recorded; " +
+                              "rebuilding the entire table.")
 
-                timestamp = annotation.batch.timestamp
-                value     = annotation.value
-
-                if cur_value == None:
-                    cur_value     = value
-                    cur_timestamp = timestamp
-                else:
-                    if timestamp > cur_timestamp:
-                        # Use the most recent value.
-                        cur_value     = value
-                        cur_timestamp = timestamp
-
-            if cur_value == None:
-                try:
-                    cur_value = AnnotationValue.objects.get(value="")
-                except orm.AnnotationValue.DoesNotExist:
-                    cur_value = AnnotationValue()
-                    cur_value.value = ""
-                    cur_value.save()
-
-            cur_annotation = CurrentAnnotation()
-            cur_annotation.account = account
-            cur_annotation.key     = key
-            cur_annotation.value   = cur_value
-            cur_annotation.save()
+        if kwargs['chunked']:
+            num_annotations = currentAnnotations.rebuild_in_chunks(
+                                            num_workers=kwargs['workers'],
+                                            chunk_size=kwargs['chunk_size'])
+        else:
+            num_annotations = currentAnnotations.rebuild()
 
+        self.stdout.write("Rebuilt %d current annotation(s)." %
+                          num_annotations)
         self.stdout.write("Done!")
-
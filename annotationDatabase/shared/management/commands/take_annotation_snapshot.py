@@ -0,0 +1,48 @@
+""" annotationDatabase.shared.management.commands.take_annotation_snapshot
+
+    This Python module implements the "take_annotation_snapshot" management
+    command for the annotation database.  It takes a snapshot of the
+    annotation values, which is used to speed up requests for the annotation
+    values as they were at a given moment.  This command is intended to be
+    run periodically, for example once a day from a cron job.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from annotationDatabase.shared.lib import annotationSnapshots
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "take_annotation_snapshot" management command.
+    """
+    args = None
+    help = 'Take a snapshot of the annotation values.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--keep",
+                    type="int",
+                    default=None,
+                    help="The number of snapshots to keep.  Any older " +
+                         "snapshots will be deleted."),
+    )
+
+    def handle(self, *args, **kwargs):
+        """ Run our management command.
+        """
+        if len(args) != 0:
+            self.stderr.write("This command takes no arguments.")
+            return
+
+        snapshot = annotationSnapshots.take_snapshot()
+
+        self.stdout.write("Took snapshot %d of the annotation values as of %s."
+                          % (snapshot.id, snapshot.taken_at))
+
+        if kwargs['keep'] != None:
+            num_deleted = annotationSnapshots.delete_old_snapshots(
+                                                            kwargs['keep'])
+            self.stdout.write("Deleted %d old snapshot(s)." % num_deleted)
+
+        self.stdout.write("Done!")
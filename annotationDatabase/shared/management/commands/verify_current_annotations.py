@@ -0,0 +1,81 @@
+""" annotationDatabase.shared.management.commands.verify_current_annotations
+
+    This Python module implements the "verify_current_annotations" management
+    command for the annotation database.  It checks that the CurrentAnnotation
+    table matches the values implied by the Annotation and AnnotationBatch
+    tables, reporting (and optionally fixing) any mismatches.
+"""
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from annotationDatabase.shared.lib import currentAnnotations
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "verify_current_annotations" management command.
+    """
+    args = None
+    help = 'Check the CurrentAnnotation records against the annotations.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--fix",
+                    action="store_true",
+                    default=False,
+                    help="Correct any mismatched CurrentAnnotation records."),
+        make_option("--quiet",
+                    action="store_true",
+                    default=False,
+                    help="Only report the totals, not each mismatch."),
+        make_option("--workers",
+                    type="int",
+                    default=1,
+                    help="The number of worker processes to use."),
+        make_option("--chunk-size",
+                    type="int",
+                    default=100000,
+                    help="The number of account IDs to check at once."),
+    )
+
+    def handle(self, *args, **kwargs):
+        """ Run our management command.
+        """
+        if len(args) != 0:
+            self.stderr.write("This command takes no arguments.")
+            return
+
+        if kwargs['quiet']:
+            report = None
+        else:
+            report = _report_mismatch
+
+        results = currentAnnotations.verify(num_workers=kwargs['workers'],
+                                            chunk_size=kwargs['chunk_size'],
+                                            fix=kwargs['fix'],
+                                            report=report)
+
+        self.stdout.write("Checked %d current annotation(s)." %
+                          results['checked'])
+        self.stdout.write("  %d missing, %d extra, %d with the wrong value." %
+                          (results['missing'], results['extra'],
+                           results['wrong']))
+        if kwargs['fix']:
+            self.stdout.write("All mismatches have been fixed.")
+        self.stdout.write("Done!")
+
+#############################################################################
+
+def _report_mismatch(mismatch):
+    """ Print out a single mismatch found by currentAnnotations.verify().
+
+        Note that this may be called from within a worker process, so we write
+        directly to sys.stdout.
+    """
+    kind,account_id,key_id,expected_value_id,actual_value_id = mismatch
+
+    sys.stdout.write("%s: account %d, key %d, expected value %s, found %s\n" %
+                     (kind, account_id, key_id, expected_value_id,
+                      actual_value_id))
+    sys.stdout.flush()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+from annotationDatabase.shared.lib import typedValues
+
+#############################################################################
+
+# The number of annotation values to update at once.  Note that each value in
+# a chunk takes up to four query parameters, and SQLite limits a query to 999
+# parameters.
+
+CHUNK_SIZE = 200
+
+#############################################################################
+
+class Migration(DataMigration):
+    """ Our custom data migration.
+
+        We parse each existing annotation value as a number and a date, and
+        store the results into the new 'numeric_value' and 'date_value'
+        fields.
+    """
+    def forwards(self, orm):
+        """ Calculate the numeric and date version of each annotation value.
+
+            Rather than updating each value one at a time, we work through the
+            values in chunks of CHUNK_SIZE record IDs, and update each chunk
+            using a single UPDATE statement.
+        """
+        values = orm.AnnotationValue.objects.all()
+        max_id = values.aggregate(models.Max("id"))['id__max'] or 0
+
+        for first_id in range(1, max_id+1, CHUNK_SIZE):
+            last_id        = first_id + CHUNK_SIZE - 1
+            numeric_values = [] # List of (id, numeric_value) tuples.
+            date_values    = [] # List of (id, date_value) tuples.
+
+            for id,value in values.filter(id__range=(first_id, last_id)) \
+                                  .values_list("id", "value"):
+                numeric_value = typedValues.parse_number(value)
+                date_value    = typedValues.parse_date(value)
+                if numeric_value != None:
+                    numeric_values.append((id, numeric_value))
+                if date_value != None:
+                    date_values.append((id, date_value))
+
+            assignments = []
+            params      = []
+            for field,field_values in [("numeric_value", numeric_values),
+                                       ("date_value",    date_values)]:
+                if len(field_values) == 0:
+                    continue
+                cases = []
+                for id,field_value in field_values:
+                    cases.append("WHEN %s THEN %s")
+                    params.extend([id, field_value])
+                assignments.append("%s = CASE id %s ELSE %s END" %
+                                   (field, " ".join(cases), field))
+
+            if len(assignments) > 0:
+                params.extend([first_id, last_id])
+                db.execute("UPDATE shared_annotationvalue SET " +
+                           ", ".join(assignments) +
+                           " WHERE id BETWEEN %s AND %s", params)
+
+
+    def backwards(self, orm):
+        """ Undo a previous migration.
+        """
+        orm.AnnotationValue.objects.update(numeric_value=None,
+                                           date_value=None)
+
+    models = {
+        u'shared.account': {
+            'Meta': {'object_name': 'Account'},
+            'address': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.User']", 'null': 'True'})
+        },
+        u'shared.annotation': {
+            'Meta': {'object_name': 'Annotation'},
+            'account': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.Account']"}),
+            'batch': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationBatch']"}),
+            'hidden': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'hidden_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'hidden_by': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationKey']"}),
+            'value': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationValue']", 'null': 'True'})
+        },
+        u'shared.annotationbatch': {
+            'Meta': {'object_name': 'AnnotationBatch'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {}),
+            'user_id': ('django.db.models.fields.TextField', [], {})
+        },
+        u'shared.annotationkey': {
+            'Meta': {'object_name': 'AnnotationKey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'}),
+            'normalized_key': ('django.db.models.fields.TextField', [], {'db_index': 'True'})
+        },
+        u'shared.annotationtemplate': {
+            'Meta': {'object_name': 'AnnotationTemplate'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'})
+        },
+        u'shared.annotationtemplateentry': {
+            'Meta': {'object_name': 'AnnotationTemplateEntry'},
+            'annotation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationKey']"}),
+            'choices': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'default': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'field_max_length': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'field_min_length': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'field_required': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'field_size': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'label': ('django.db.models.fields.TextField', [], {}),
+            'public': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'template': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationTemplate']"}),
+            'type': ('django.db.models.fields.TextField', [], {'default': "'field'"})
+        },
+        u'shared.annotationvalue': {
+            'Meta': {'object_name': 'AnnotationValue'},
+            'date_value': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'normalized_value': ('django.db.models.fields.TextField', [], {'db_index': 'True'}),
+            'numeric_value': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '65', 'decimal_places': '30', 'db_index': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'})
+        },
+        u'shared.client': {
+            'Meta': {'object_name': 'Client'},
+            'auth_token': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'})
+        },
+        u'shared.currentannotation': {
+            'Meta': {'unique_together': "[['account', 'key']]", 'object_name': 'CurrentAnnotation', 'index_together': "[['key', 'value']]"},
+            'account': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.Account']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationKey']"}),
+            'value': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.AnnotationValue']"})
+        },
+        u'shared.currentannotationmark': {
+            'Meta': {'object_name': 'CurrentAnnotationMark'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_annotation_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'last_hidden_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'recorded_at': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'shared.queuedbatch': {
+            'Meta': {'object_name': 'QueuedBatch'},
+            'batch': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['shared.AnnotationBatch']", 'unique': 'True'}),
+            'data': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'finished_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'num_annotations': ('django.db.models.fields.IntegerField', [], {}),
+            'num_processed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'queued_at': ('django.db.models.fields.DateTimeField', [], {}),
+            'started_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'status': ('django.db.models.fields.TextField', [], {'default': "'pending'", 'db_index': 'True'})
+        },
+        u'shared.session': {
+            'Meta': {'object_name': 'Session'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_access': ('django.db.models.fields.DateTimeField', [], {}),
+            'session_token': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['shared.User']"})
+        },
+        u'shared.user': {
+            'Meta': {'object_name': 'User'},
+            'blocked': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'password_hash': ('django.db.models.fields.TextField', [], {}),
+            'password_salt': ('django.db.models.fields.TextField', [], {}),
+            'username': ('django.db.models.fields.TextField', [], {'unique': 'True', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['shared']
+    symmetrical = True
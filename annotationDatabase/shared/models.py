@@ -8,6 +8,8 @@ import uuid
 
 from django.db import models
 
+from annotationDatabase.shared.lib import typedValues
+
 #############################################################################
 
 class User(models.Model):
@@ -38,17 +40,86 @@ class User(models.Model):
 
 class AnnotationKey(models.Model):
     """ A single unique annotation key used by one or more annotations.
+
+        Annotation keys are case-insensitive.  To allow keys to be looked up
+        using an index, we store a normalized (lowercase) copy of each key in
+        the 'normalized_key' field; this should be used for all lookups.
     """
-    id  = models.AutoField(primary_key=True)
-    key = models.TextField(unique=True, db_index=True)
+    id             = models.AutoField(primary_key=True)
+    key            = models.TextField(unique=True, db_index=True)
+    normalized_key = models.TextField(db_index=True)
+
+
+    @staticmethod
+    def normalize(key):
+        """ Return the normalized version of the given annotation key.
+        """
+        return key.lower()
+
+
+    def update_derived_fields(self):
+        """ Calculate the normalized version of our key.
+
+            Note that this is called automatically when the AnnotationKey is
+            saved, but must be called explicitly before using bulk_create().
+        """
+        self.normalized_key = AnnotationKey.normalize(self.key)
+
+
+    def save(self, *args, **kwargs):
+        """ Save this AnnotationKey, updating the normalized key as we go.
+        """
+        self.update_derived_fields()
+        super(AnnotationKey, self).save(*args, **kwargs)
 
 #############################################################################
 
 class AnnotationValue(models.Model):
     """ A single unique annotation value used by one or more annotations.
+
+        Annotation values are case-insensitive.  To allow values to be looked
+        up using an index, we store a normalized (lowercase) copy of each value
+        in the 'normalized_value' field; this should be used for all lookups.
+
+        If the value can be parsed as a number or a date, the parsed value is
+        stored in the 'numeric_value' or 'date_value' field, respectively.
+        These are used to compare values as numbers or dates when searching.
+        Numbers are stored as decimal values so that large numbers, such as
+        ledger amounts, are compared exactly.
     """
-    id    = models.AutoField(primary_key=True)
-    value = models.TextField(unique=True, db_index=True)
+    id               = models.AutoField(primary_key=True)
+    value            = models.TextField(unique=True, db_index=True)
+    normalized_value = models.TextField(db_index=True)
+    numeric_value    = models.DecimalField(
+                            max_digits=typedValues.NUMBER_MAX_DIGITS,
+                            decimal_places=typedValues.NUMBER_DECIMAL_PLACES,
+                            null=True, db_index=True)
+    date_value       = models.DateTimeField(null=True, db_index=True)
+
+
+    @staticmethod
+    def normalize(value):
+        """ Return the normalized version of the given annotation value.
+        """
+        return value.lower()
+
+
+    def update_derived_fields(self):
+        """ Calculate the normalized, numeric and date versions of our value.
+
+            Note that this is called automatically when the AnnotationValue is
+            saved, but must be called explicitly before using bulk_create().
+        """
+        self.normalized_value = AnnotationValue.normalize(self.value)
+        self.numeric_value    = typedValues.parse_number(self.value)
+        self.date_value       = typedValues.parse_date(self.value)
+
+
+    def save(self, *args, **kwargs):
+        """ Save this AnnotationValue, updating the derived fields as we go.
+        """
+        self.update_derived_fields()
+        super(AnnotationValue, self).save(*args, **kwargs)
 
 #############################################################################
 
@@ -63,10 +134,55 @@ class Account(models.Model):
 
 class AnnotationBatch(models.Model):
     """ A single batch of uploaded annotations.
+
+        'version' is incremented whenever annotations are added to or hidden
+        within this batch, so that we can tell if the batch has changed.
     """
     id        = models.AutoField(primary_key=True)
     timestamp = models.DateTimeField()
     user_id   = models.TextField()
+    version   = models.IntegerField(default=0)
+
+#############################################################################
+
+class QueuedBatch(models.Model):
+    """ An annotation batch waiting to be processed in the background.
+
+        When a batch of annotations is added asynchronously, the AnnotationBatch
+        record is created straight away and the raw annotations are stored in
+        a QueuedBatch record.  The "process_batch_queue" management command
+        then works through the queue, storing the annotations for each batch.
+
+        Note that 'data' holds the batch's annotations as a JSON string, and
+        is cleared once the batch has been processed.  'num_processed' is
+        updated in the same transaction as each chunk of annotations is
+        stored, so a batch can be resumed if a worker is interrupted.
+
+        A worker claims a batch by setting 'claimed_by' to a unique token, and
+        renews its claim by updating 'heartbeat_at' with each chunk.  If the
+        heartbeat is more than QUEUE_LEASE_TIMEOUT seconds old, the worker is
+        assumed to have died, and another worker can claim the batch and carry
+        on where it left off.  'attempts' counts the number of times the
+        batch has been claimed.
+    """
+    id              = models.AutoField(primary_key=True)
+    batch           = models.OneToOneField(AnnotationBatch)
+    status          = models.TextField(choices=[("pending",    "pending"),
+                                                ("processing", "processing"),
+                                                ("done",       "done"),
+                                                ("failed",     "failed")],
+                                       default="pending",
+                                       db_index=True)
+    data            = models.TextField(null=True)
+    num_annotations = models.IntegerField()
+    num_processed   = models.IntegerField(default=0)
+    error           = models.TextField(null=True)
+    queued_at       = models.DateTimeField()
+    started_at      = models.DateTimeField(null=True)
+    finished_at     = models.DateTimeField(null=True)
+    claimed_by      = models.TextField(null=True)
+    heartbeat_at    = models.DateTimeField(null=True, db_index=True)
+    attempts        = models.IntegerField(default=0)
 
 #############################################################################
 
@@ -83,9 +199,14 @@ class Annotation(models.Model):
     key       = models.ForeignKey(AnnotationKey)
     value     = models.ForeignKey(AnnotationValue, null=True)
     hidden    = models.BooleanField(default=False)
-    hidden_at = models.DateTimeField(null=True)
+    hidden_at = models.DateTimeField(null=True, db_index=True)
     hidden_by = models.TextField(null=True)
 
+    class Meta:
+        index_together = [
+            ["account", "key"],
+        ]
+
 #############################################################################
 
 class CurrentAnnotation(models.Model):
@@ -112,11 +233,106 @@ class CurrentAnnotation(models.Model):
 
 #############################################################################
 
+class CurrentAnnotationMark(models.Model):
+    """ A record of how far the CurrentAnnotation table has been calculated.
+
+        Each time the CurrentAnnotation table is recalculated, we record the
+        highest Annotation record ID and the latest "hidden_at" timestamp which
+        were taken into account.  Only the (account, key) pairs with
+        annotations added or hidden after this high-water mark need to be
+        recalculated to bring the CurrentAnnotation table back up to date.
+
+        'generation' is incremented whenever the CurrentAnnotation table is
+        changed without recording the changes in the AnnotationChange table,
+        for example when the table is rebuilt.  Anything which is kept up to
+        date by reading the AnnotationChange table should start again from
+        scratch when the generation changes.
+
+        There is only ever one CurrentAnnotationMark record.
+    """
+    id                 = models.AutoField(primary_key=True)
+    last_annotation_id = models.IntegerField(default=0)
+    last_hidden_at     = models.DateTimeField(null=True)
+    recorded_at        = models.DateTimeField()
+    generation         = models.IntegerField(default=0)
+
+
+    @staticmethod
+    def current_generation():
+        """ Return the generation number of the CurrentAnnotation table.
+        """
+        generation = CurrentAnnotationMark.objects.values_list("generation",
+                                                               flat=True)[:1]
+        if len(generation) == 0:
+            return 0
+        else:
+            return generation[0]
+
+#############################################################################
+
+class AnnotationChange(models.Model):
+    """ A single change to the current value of an annotation.
+
+        An AnnotationChange record is added whenever an account's current
+        value for an annotation key changes, either because a new annotation
+        was uploaded or because an annotation was hidden.  The records are
+        never deleted or updated, so the record IDs give the order in which
+        the changes were made, and can be used to read through the changes
+        made since a given point.
+    """
+    id         = models.AutoField(primary_key=True)
+    account    = models.ForeignKey(Account)
+    key        = models.ForeignKey(AnnotationKey)
+    value      = models.ForeignKey(AnnotationValue)
+    changed_at = models.DateTimeField()
+
+#############################################################################
+
+class AnnotationSnapshot(models.Model):
+    """ A materialized copy of the annotation values at a given moment.
+
+        Each snapshot holds the value each account had for each annotation key
+        at the 'taken_at' time, taking into account any annotations which had
+        been hidden at that time.  The snapshots are used to find the
+        annotation values as of a given moment without having to scan through
+        the entire annotation history.
+
+        'last_annotation_id' is the highest Annotation record ID at the time
+        the snapshot was taken.  Annotations added to a batch after the
+        snapshot was taken may have a batch timestamp before 'taken_at', so we
+        use this to find them.
+    """
+    id                 = models.AutoField(primary_key=True)
+    taken_at           = models.DateTimeField(db_index=True)
+    last_annotation_id = models.IntegerField(default=0)
+
+#############################################################################
+
+class SnapshotAnnotation(models.Model):
+    """ The value of a single annotation within an AnnotationSnapshot.
+    """
+    id       = models.AutoField(primary_key=True)
+    snapshot = models.ForeignKey(AnnotationSnapshot)
+    account  = models.ForeignKey(Account)
+    key      = models.ForeignKey(AnnotationKey)
+    value    = models.ForeignKey(AnnotationValue)
+
+    class Meta:
+        unique_together = [
+            ["snapshot", "account", "key"],
+        ]
+
+#############################################################################
+
 class AnnotationTemplate(models.Model):
     """ A single uploaded annotation template.
+
+        'version' is incremented each time the template is replaced, so that
+        we can tell if the template has changed.
     """
-    id   = models.AutoField(primary_key=True)
-    name = models.TextField(unique=True, db_index=True)
+    id      = models.AutoField(primary_key=True)
+    name    = models.TextField(unique=True, db_index=True)
+    version = models.IntegerField(default=0)
 
 #############################################################################
 